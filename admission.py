@@ -0,0 +1,173 @@
+"""
+Admission control: cap how many requests of each class run at once across
+all gunicorn workers, so a burst of heavy reports can't occupy every worker
+while customers are placing orders.
+
+Each class has `slots` (requests allowed to run) and `queue` (requests
+allowed to wait for a slot, for at most `timeout` seconds). Both are sets of
+lock files under one directory, held with flock(): a request owns a slot
+while it holds the lock on that slot's file, and the kernel drops the lock if
+the worker dies, so a crash can never leak a slot. A request that finds no
+free slot and no free queue place -- or whose wait times out -- is refused
+and the caller answers 503.
+
+Because a waiting request ties up its (sync) worker too, slots + queue is the
+most workers a class can ever occupy; keep it below the worker count for
+anything but the critical class.
+
+A class with slots=None is unlimited; its requests are only counted.
+"""
+import fcntl
+import os
+import threading
+import time
+
+
+class Rejected(Exception):
+    """No slot became free in time (or the queue was full)."""
+
+    def __init__(self, name, reason, retry_after=1):
+        super().__init__(f'{name}: {reason}')
+        self.name = name
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _LockFiles:
+    """`count` lock files `<directory>/<prefix>.<i>.lock`."""
+
+    def __init__(self, directory, prefix, count):
+        self.paths = [os.path.join(directory, f'{prefix}.{i}.lock') for i in range(count)]
+
+    def try_acquire(self):
+        """Lock a free file; returns its fd, or None if all are held."""
+        for path in self.paths:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o660)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                os.close(fd)
+        return None
+
+    @staticmethod
+    def release(fd):
+        try:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def held(self):
+        """How many are locked right now, by any process (a snapshot)."""
+        n = 0
+        for path in self.paths:
+            try:
+                fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o660)
+            except OSError:
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            except BlockingIOError:
+                n += 1
+            finally:
+                os.close(fd)
+        return n
+
+
+class Ticket:
+    """An admitted request; release() (idempotent) frees its slot."""
+    __slots__ = ('_klass', '_fd', 'waited', '_started')
+
+    def __init__(self, klass, fd, waited):
+        self._klass = klass
+        self._fd = fd
+        self.waited = waited
+        self._started = time.monotonic()
+
+    def release(self):
+        klass, self._klass = self._klass, None
+        if klass is not None:
+            klass._finish(self._fd, time.monotonic() - self._started)
+
+
+class AdmissionClass:
+    def __init__(self, name, directory, slots=None, queue=0, timeout=0.0, poll=0.02):
+        self.name = name
+        self.slots = slots
+        self.queue = queue if slots is not None else 0
+        self.timeout = timeout
+        self.poll = poll
+        if slots is not None:
+            os.makedirs(directory, exist_ok=True)
+            self._slots = _LockFiles(directory, name, slots)
+            self._queue = _LockFiles(directory, f'{name}-queue', self.queue)
+        # this worker's counters
+        self._lock = threading.Lock()
+        self.admitted = self.queued = self.rejected = self.timed_out = 0
+        self.active = 0
+        self.wait_total = self.wait_max = 0.0
+        self.run_total = self.run_max = 0.0
+
+    def acquire(self):
+        """Admit the caller or raise Rejected. Returns a Ticket."""
+        started = time.monotonic()
+        fd = None
+        if self.slots is not None:
+            fd = self._slots.try_acquire()
+            if fd is None:
+                fd = self._wait(started)
+        waited = time.monotonic() - started
+        with self._lock:
+            self.admitted += 1
+            self.active += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+        return Ticket(self, fd, waited)
+
+    def _wait(self, started):
+        place = self._queue.try_acquire() if self.queue else None
+        if place is None:
+            with self._lock:
+                self.rejected += 1
+            raise Rejected(self.name, 'busy', retry_after=max(1, int(self.timeout) or 1))
+        with self._lock:
+            self.queued += 1
+        try:
+            deadline = started + self.timeout
+            while time.monotonic() < deadline:
+                time.sleep(self.poll)
+                fd = self._slots.try_acquire()
+                if fd is not None:
+                    return fd
+        finally:
+            _LockFiles.release(place)
+        with self._lock:
+            self.timed_out += 1
+            self.rejected += 1
+        raise Rejected(self.name, 'timed out waiting for a slot', retry_after=max(1, int(self.timeout) or 1))
+
+    def _finish(self, fd, ran):
+        if fd is not None:
+            _LockFiles.release(fd)
+        with self._lock:
+            self.active -= 1
+            self.run_total += ran
+            self.run_max = max(self.run_max, ran)
+
+    def stats(self):
+        """Shared gauges (all workers) plus this worker's counters."""
+        with self._lock:
+            out = {
+                'slots': self.slots, 'queue': self.queue, 'timeout': self.timeout,
+                'admitted': self.admitted, 'queued_total': self.queued, 'rejected': self.rejected,
+                'timed_out': self.timed_out, 'active_here': self.active,
+                'wait_ms_avg': round(1000 * self.wait_total / self.admitted, 2) if self.admitted else 0.0,
+                'wait_ms_max': round(1000 * self.wait_max, 2),
+                'run_ms_avg': round(1000 * self.run_total / max(1, self.admitted - self.active), 2),
+                'run_ms_max': round(1000 * self.run_max, 2),
+            }
+        if self.slots is not None:
+            out['in_flight'] = self._slots.held()
+            out['queue_depth'] = self._queue.held()
+        return out
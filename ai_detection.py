@@ -0,0 +1,504 @@
+"""
+AI Block Detection
+S.A.M Blocks and Interlocks Inventory System
+
+CPU inference for the trained block detector (see train_block_detector.py).
+Two backends count blocks: onnxruntime over the exported
+models/block_detector[.int8].onnx, which needs neither torch nor ultralytics,
+and the ultralytics YOLO model models/block_detector.pt. The detector is
+loaded once per process on first use rather than at import, so web workers
+that never see an image never pay for it. Uploaded images are decoded and
+sent through the model in one batched forward pass on a small bounded pool:
+inference uses a fixed share of the CPU, and a burst of uploads is refused
+straight away instead of piling up behind the request workers.
+"""
+
+import ast
+import importlib.util
+import io
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+
+MODEL_PATH = os.environ.get('BLOCK_DETECTOR_MODEL', os.path.join(BASE_DIR, 'models', 'block_detector.pt'))
+# ONNX export; the INT8 file is preferred when both exist
+ONNX_MODEL_PATH = os.environ.get('BLOCK_DETECTOR_ONNX') or next(
+    (p for p in (os.path.join(BASE_DIR, 'models', 'block_detector.int8.onnx'),
+                 os.path.join(BASE_DIR, 'models', 'block_detector.onnx')) if os.path.exists(p)),
+    os.path.join(BASE_DIR, 'models', 'block_detector.onnx'))
+# 'onnx', 'torch' or 'auto' (ONNX when the file and onnxruntime are present)
+BACKEND = os.environ.get('AI_BACKEND', 'auto').lower()
+CONFIDENCE = float(os.environ.get('AI_CONFIDENCE', '0.25') or 0.25)
+IOU_THRESHOLD = float(os.environ.get('AI_IOU', '0.7') or 0.7)
+IMAGE_SIZE = int(os.environ.get('AI_IMAGE_SIZE', '640') or 640)
+# images per forward pass; larger uploads are split into several passes
+MAX_BATCH = int(os.environ.get('AI_MAX_BATCH', '16') or 16)
+# inference threads per process, and how many requests may wait for one
+WORKERS = int(os.environ.get('AI_WORKERS', '1') or 1)
+MAX_PENDING = int(os.environ.get('AI_MAX_PENDING', '4') or 4)
+# intra-op threads torch / onnxruntime may use for one forward pass
+INTRA_OP_THREADS = int(os.environ.get('AI_INTRA_OP_THREADS', '2') or 2)
+TIMEOUT_SECONDS = float(os.environ.get('AI_TIMEOUT_SECONDS', '60') or 60)
+# tiled inference for photos much larger than IMAGE_SIZE: tiles of
+# AI_TILE_SIZE px overlapping by AI_TILE_OVERLAP; 'auto' tiles any photo whose
+# longest side exceeds AI_TILE_MIN_SIDE
+TILE_SIZE = int(os.environ.get('AI_TILE_SIZE', '0') or 0) or IMAGE_SIZE
+TILE_OVERLAP = float(os.environ.get('AI_TILE_OVERLAP', '0.2') or 0.2)
+TILE_MIN_SIDE = int(os.environ.get('AI_TILE_MIN_SIDE', '1920') or 1920)
+# boxes from neighbouring tiles are the same block when the smaller one is
+# mostly inside the larger (a block cut by a tile edge has a low IoU)
+TILE_MATCH_THRESHOLD = float(os.environ.get('AI_TILE_MATCH', '0.6') or 0.6)
+
+
+class DetectorUnavailable(RuntimeError):
+    """The model file or the inference libraries are missing."""
+
+
+class DetectorBusy(RuntimeError):
+    """Every inference slot in this process is taken."""
+
+
+_model = None
+_model_lock = threading.Lock()
+
+_executor = None
+_executor_lock = threading.Lock()
+
+_pending = 0
+_stats = {'batches': 0, 'images': 0, 'last_latency_ms': None}
+_stats_lock = threading.Lock()
+
+
+def nms(boxes, scores, iou_threshold=IOU_THRESHOLD, metric='iou'):
+    """Greedy non-maximum suppression over (N, 4) xyxy boxes; returns the
+    indices kept, highest score first. With metric='ios' the overlap is
+    measured against the smaller box (intersection over smaller)."""
+    order = np.argsort(-scores)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    keep = []
+    while order.size:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        w = np.clip(np.minimum(boxes[i, 2], boxes[rest, 2]) - np.maximum(boxes[i, 0], boxes[rest, 0]), 0, None)
+        h = np.clip(np.minimum(boxes[i, 3], boxes[rest, 3]) - np.maximum(boxes[i, 1], boxes[rest, 1]), 0, None)
+        inter = w * h
+        if metric == 'ios':
+            overlap = inter / np.maximum(np.minimum(areas[i], areas[rest]), 1e-9)
+        else:
+            overlap = inter / np.maximum(areas[i] + areas[rest] - inter, 1e-9)
+        order = rest[overlap <= iou_threshold]
+    return np.array(keep, dtype=int)
+
+
+class TorchDetector:
+    """ultralytics YOLO over the .pt weights."""
+    name = 'torch'
+
+    def __init__(self, path):
+        try:
+            import torch
+            from ultralytics import YOLO
+        except ImportError as e:
+            raise DetectorUnavailable('ultralytics is not installed') from e
+        torch.set_num_threads(INTRA_OP_THREADS)
+        self.path = path
+        self.model = YOLO(path)
+
+    def predict(self, images, confidence):
+        out = []
+        for i in range(0, len(images), MAX_BATCH):
+            results = self.model.predict(images[i:i + MAX_BATCH], conf=confidence, iou=IOU_THRESHOLD,
+                                         imgsz=IMAGE_SIZE, device='cpu', verbose=False)
+            for r in results:
+                out.append([{
+                    'class': self.model.names[int(cls)],
+                    'confidence': round(float(conf), 3),
+                    'bbox': [round(float(v), 1) for v in xyxy],
+                } for cls, conf, xyxy in zip(r.boxes.cls.tolist(), r.boxes.conf.tolist(), r.boxes.xyxy.tolist())])
+        return out
+
+
+class OnnxDetector:
+    """onnxruntime over an ultralytics ONNX export (detect or segment head;
+    mask coefficients are ignored since only boxes are counted)."""
+    name = 'onnx'
+
+    def __init__(self, path):
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise DetectorUnavailable('onnxruntime is not installed') from e
+        opts = ort.SessionOptions()
+        opts.intra_op_num_threads = INTRA_OP_THREADS
+        opts.inter_op_num_threads = 1
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.path = path
+        self.session = ort.InferenceSession(path, opts, providers=['CPUExecutionProvider'])
+        inp = self.session.get_inputs()[0]
+        self.input_name = inp.name
+        batch_dim, _, height = inp.shape[0], inp.shape[1], inp.shape[2]
+        # a static export takes one image of a fixed size per run
+        self.fixed_batch = batch_dim if isinstance(batch_dim, int) else None
+        self.size = height if isinstance(height, int) else IMAGE_SIZE
+        meta = self.session.get_modelmeta().custom_metadata_map
+        try:
+            self.names = ast.literal_eval(meta.get('names', '')) or {0: 'block'}
+        except (ValueError, SyntaxError):
+            self.names = {0: 'block'}
+
+    def _letterbox(self, img):
+        from PIL import Image
+        w, h = img.size
+        scale = min(self.size / w, self.size / h)
+        nw, nh = max(1, round(w * scale)), max(1, round(h * scale))
+        pad_x, pad_y = (self.size - nw) // 2, (self.size - nh) // 2
+        canvas = Image.new('RGB', (self.size, self.size), (114, 114, 114))
+        canvas.paste(img.resize((nw, nh), Image.BILINEAR), (pad_x, pad_y))
+        return np.asarray(canvas, dtype=np.float32).transpose(2, 0, 1) / 255.0, scale, pad_x, pad_y
+
+    def predict(self, images, confidence):
+        prepared = [self._letterbox(img) for img in images]
+        step = self.fixed_batch or MAX_BATCH
+        out = []
+        for i in range(0, len(prepared), step):
+            chunk = prepared[i:i + step]
+            preds = self.session.run(None, {self.input_name: np.stack([c[0] for c in chunk])})[0]
+            for (_, scale, pad_x, pad_y), pred in zip(chunk, preds):
+                out.append(self._boxes(pred, scale, pad_x, pad_y, confidence))
+        return out
+
+    def _boxes(self, pred, scale, pad_x, pad_y, confidence):
+        # pred is (4 + classes [+ mask coefficients], anchors)
+        pred = pred.T
+        class_scores = pred[:, 4:4 + len(self.names)]
+        cls = class_scores.argmax(axis=1)
+        conf = class_scores[np.arange(len(cls)), cls]
+        mask = conf > confidence
+        xywh, cls, conf = pred[mask, :4], cls[mask], conf[mask]
+        boxes = np.empty_like(xywh)
+        boxes[:, :2] = xywh[:, :2] - xywh[:, 2:] / 2
+        boxes[:, 2:] = xywh[:, :2] + xywh[:, 2:] / 2
+        boxes = (boxes - [pad_x, pad_y, pad_x, pad_y]) / scale
+        keep = nms(boxes, conf)
+        return [{
+            'class': self.names.get(int(cls[k]), str(int(cls[k]))),
+            'confidence': round(float(conf[k]), 3),
+            'bbox': [round(float(v), 1) for v in boxes[k]],
+        } for k in keep]
+
+
+def _resolve_backend():
+    """Pick (detector class, model path) from AI_BACKEND and the files present."""
+    if BACKEND == 'onnx':
+        return OnnxDetector, ONNX_MODEL_PATH
+    if BACKEND == 'torch':
+        return TorchDetector, MODEL_PATH
+    if os.path.exists(ONNX_MODEL_PATH) and importlib.util.find_spec('onnxruntime'):
+        return OnnxDetector, ONNX_MODEL_PATH
+    return TorchDetector, MODEL_PATH
+
+
+def get_model():
+    """Return the process-wide detector, loading it on first call."""
+    global _model
+    if _model is not None:
+        return _model
+    with _model_lock:
+        if _model is None:
+            cls, path = _resolve_backend()
+            if not os.path.exists(path):
+                raise DetectorUnavailable(f'Model not found at {path}')
+            _model = cls(path)
+    return _model
+
+
+def decode_images(blobs):
+    """Decode raw upload bytes into RGB PIL images. Raises ValueError naming
+    the first image that is not a readable picture."""
+    try:
+        from PIL import Image
+    except ImportError as e:
+        raise DetectorUnavailable('Pillow is not installed') from e
+    images = []
+    for i, blob in enumerate(blobs):
+        try:
+            img = Image.open(io.BytesIO(blob))
+            images.append(img.convert('RGB'))
+        except Exception as e:
+            raise ValueError(f'Image {i + 1} could not be read: {e}') from e
+    return images
+
+
+def predict(images, confidence=None):
+    """Run the detector over decoded `images` and return one
+    {'count', 'detections'} dict per image."""
+    detector = get_model()
+    confidence = CONFIDENCE if confidence is None else confidence
+    return [{'count': len(d), 'detections': d} for d in detector.predict(images, confidence)]
+
+
+def tile_grid(width, height, tile=None, overlap=None):
+    """Top-left-first (x0, y0, x1, y1) tiles covering the image, adjacent
+    tiles sharing `overlap` of their size; edge tiles are shifted inwards
+    rather than padded so every tile is full size when the image allows."""
+    tile = tile or TILE_SIZE
+    overlap = TILE_OVERLAP if overlap is None else overlap
+    step = max(1, int(tile * (1 - overlap)))
+
+    def starts(length):
+        if length <= tile:
+            return [0]
+        return list(range(0, length - tile, step)) + [length - tile]
+
+    return [(x, y, min(x + tile, width), min(y + tile, height))
+            for y in starts(height) for x in starts(width)]
+
+
+class MemmapImage:
+    """Decoded RGB pixels spilled to a temporary memory-mapped .npy file, so
+    tiles are read lazily while inference runs. Use as a context manager to
+    remove the file.
+
+    Pillow decodes the whole photo in one go (crop() loads it first), so the
+    decode itself still peaks at one full copy of the pixels. Strips are
+    converted to RGB one at a time so there is never a second full copy, and
+    the decoded image is released before the first tile is read; from then
+    on only the current batch of tiles is resident."""
+
+    def __init__(self, blob, strip_rows=512):
+        from PIL import Image
+        img = Image.open(io.BytesIO(blob))
+        img.load()
+        self.width, self.height = img.size
+        fd, self.path = tempfile.mkstemp(prefix='ai-tiles-', suffix='.npy')
+        os.close(fd)
+        pixels = np.lib.format.open_memmap(self.path, mode='w+', dtype=np.uint8,
+                                           shape=(self.height, self.width, 3))
+        for y in range(0, self.height, strip_rows):
+            strip = img.crop((0, y, self.width, min(self.height, y + strip_rows)))
+            pixels[y:y + strip_rows] = np.asarray(strip if strip.mode == 'RGB' else strip.convert('RGB'))
+        pixels.flush()
+        del pixels, img, strip
+        self.pixels = np.load(self.path, mmap_mode='r')
+
+    def tile(self, box):
+        from PIL import Image
+        x0, y0, x1, y1 = box
+        return Image.fromarray(np.ascontiguousarray(self.pixels[y0:y1, x0:x1]))
+
+    def close(self):
+        self.pixels = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def merge_tile_detections(tiles, per_tile):
+    """Shift each tile's detections into image coordinates and drop the
+    duplicates seen by more than one tile."""
+    merged = []
+    for (x0, y0, _, _), detections in zip(tiles, per_tile):
+        for d in detections:
+            x1, y1, x2, y2 = d['bbox']
+            merged.append(dict(d, bbox=[round(x1 + x0, 1), round(y1 + y0, 1), round(x2 + x0, 1), round(y2 + y0, 1)]))
+    if not merged:
+        return []
+    boxes = np.array([d['bbox'] for d in merged], dtype=float)
+    scores = np.array([d['confidence'] for d in merged], dtype=float)
+    return [merged[i] for i in nms(boxes, scores, TILE_MATCH_THRESHOLD, metric='ios')]
+
+
+def predict_tiled(blob, confidence=None, tile=None, overlap=None):
+    """Count blocks in one large photo by running the detector over
+    overlapping full-resolution tiles (MAX_BATCH tiles per forward pass)."""
+    detector = get_model()
+    confidence = CONFIDENCE if confidence is None else confidence
+    try:
+        image = MemmapImage(blob)
+    except Exception as e:
+        raise ValueError(f'Image could not be read: {e}') from e
+    with image:
+        tiles = tile_grid(image.width, image.height, tile, overlap)
+        per_tile = []
+        for i in range(0, len(tiles), MAX_BATCH):
+            per_tile.extend(detector.predict([image.tile(b) for b in tiles[i:i + MAX_BATCH]], confidence))
+    detections = merge_tile_detections(tiles, per_tile)
+    return {'count': len(detections), 'detections': detections, 'tiles': len(tiles),
+            'tile_size': tile or TILE_SIZE, 'overlap': TILE_OVERLAP if overlap is None else overlap}
+
+
+def _wants_tiling(blobs, tiled):
+    """Per-image tiling decision; tiled is True, False or 'auto'."""
+    if tiled != 'auto':
+        return [bool(tiled)] * len(blobs)
+    from PIL import Image
+    out = []
+    for i, blob in enumerate(blobs):
+        try:
+            # only the header is parsed here
+            out.append(max(Image.open(io.BytesIO(blob)).size) > TILE_MIN_SIDE)
+        except Exception as e:
+            raise ValueError(f'Image {i + 1} could not be read: {e}') from e
+    return out
+
+
+def _run(blobs, confidence, tiled=False):
+    started = time.perf_counter()
+    results = [None] * len(blobs)
+    tile_flags = _wants_tiling(blobs, tiled)
+    whole = [i for i, t in enumerate(tile_flags) if not t]
+    if whole:
+        for i, r in zip(whole, predict(decode_images([blobs[i] for i in whole]), confidence)):
+            results[i] = r
+    for i in (i for i, t in enumerate(tile_flags) if t):
+        try:
+            results[i] = predict_tiled(blobs[i], confidence)
+        except ValueError as e:
+            raise ValueError(f'Image {i + 1}: {e}') from e
+    elapsed = (time.perf_counter() - started) * 1000
+    with _stats_lock:
+        _stats['batches'] += 1
+        _stats['images'] += len(blobs)
+        _stats['last_latency_ms'] = round(elapsed, 1)
+    return results
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix='ai-detect')
+    return _executor
+
+
+def _release(_future):
+    global _pending
+    with _stats_lock:
+        _pending -= 1
+
+
+def submit(blobs, confidence=None, tiled='auto'):
+    """Queue a detection run for the uploaded images (list of bytes) and
+    return its Future without waiting for it. The Future's result is what
+    detect() returns; unreadable images surface as a ValueError from it.
+
+    Raises DetectorBusy when WORKERS + MAX_PENDING requests are already in
+    flight in this process and DetectorUnavailable when there is no model."""
+    global _pending
+    if _model is None:
+        path = _resolve_backend()[1]
+        if not os.path.exists(path):
+            raise DetectorUnavailable(f'Model not found at {path}')
+    with _stats_lock:
+        if _pending >= WORKERS + MAX_PENDING:
+            raise DetectorBusy('Inference queue is full')
+        _pending += 1
+    try:
+        future = _get_executor().submit(_run, list(blobs), confidence, tiled)
+    except Exception:
+        _release(None)
+        raise
+    future.add_done_callback(_release)
+    return future
+
+
+def detect(blobs, confidence=None, timeout=TIMEOUT_SECONDS, tiled='auto'):
+    """Count blocks in each uploaded image (list of bytes), batched into as
+    few forward passes as possible. Images chosen for tiling (see
+    _wants_tiling) go through predict_tiled instead.
+
+    Blocks the caller until the counts are ready; /ai/detect uses submit()
+    instead so a request thread is not held for the whole run. Raises what
+    submit() raises, ValueError for unreadable images and TimeoutError if the
+    result takes longer than `timeout` seconds."""
+    return submit(blobs, confidence, tiled).result(timeout=timeout)
+
+
+def status():
+    """Model availability and pool counters for /ai/status."""
+    with _stats_lock:
+        stats = dict(_stats, pending=_pending)
+    cls, path = _resolve_backend() if _model is None else (type(_model), _model.path)
+    available = os.path.exists(path)
+    if _model is not None:
+        state = 'ready'
+    elif available:
+        state = 'not_loaded'
+    else:
+        state = 'missing'
+    return {
+        'model_available': available,
+        'model_path': path,
+        'backend': cls.name,
+        'intra_op_threads': INTRA_OP_THREADS,
+        'status': state,
+        'workers': WORKERS,
+        'max_pending': MAX_PENDING,
+        'tile_size': TILE_SIZE,
+        'tile_overlap': TILE_OVERLAP,
+        'tile_min_side': TILE_MIN_SIDE,
+        **stats,
+    }
+
+
+def _label_count(labels_dir, stem):
+    path = os.path.join(labels_dir, f'{stem}.txt')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return sum(1 for line in f if line.strip())
+
+
+if __name__ == '__main__':
+    import argparse
+    from pathlib import Path
+
+    parser = argparse.ArgumentParser(description='Count blocks in photos with the deployed detector')
+    parser.add_argument('images', nargs='+', help='Photos to count')
+    parser.add_argument('--tiled', choices=['auto', 'on', 'off'], default='auto', help='Tiled inference mode')
+    parser.add_argument('--tile', type=int, default=None, help=f'Tile size in px (default: {TILE_SIZE})')
+    parser.add_argument('--overlap', type=float, default=None, help=f'Tile overlap fraction (default: {TILE_OVERLAP})')
+    parser.add_argument('--conf', type=float, default=None, help=f'Confidence threshold (default: {CONFIDENCE})')
+    parser.add_argument('--compare', action='store_true', help='Also run whole-image inference and compare')
+    parser.add_argument('--labels', help='Folder of YOLO label files to score counts against')
+    args = parser.parse_args()
+
+    print(f'Backend: {get_model().name} ({get_model().path})')
+    errors = {'tiled': [], 'whole': []}
+    for path in args.images:
+        blob = Path(path).read_bytes()
+        tile = {'on': True, 'off': False, 'auto': None}[args.tiled]
+        if tile is None:
+            tile = _wants_tiling([blob], 'auto')[0]
+        runs = {}
+        if tile:
+            t = time.perf_counter()
+            r = predict_tiled(blob, args.conf, args.tile, args.overlap)
+            runs['tiled'] = (r['count'], time.perf_counter() - t, f"{r['tiles']} tiles")
+        if not tile or args.compare:
+            t = time.perf_counter()
+            r = predict(decode_images([blob]), args.conf)[0]
+            runs['whole'] = (r['count'], time.perf_counter() - t, 'whole image')
+        expected = _label_count(args.labels, Path(path).stem) if args.labels else None
+        for mode, (count, seconds, detail) in runs.items():
+            line = f'{Path(path).name}: {mode:5} {count:5d} blocks in {seconds * 1000:7.0f} ms ({detail})'
+            if expected is not None:
+                errors[mode].append(abs(count - expected))
+                line += f', labelled {expected}'
+            print(line)
+    for mode, errs in errors.items():
+        if errs:
+            print(f'{mode}: mean absolute count error {sum(errs) / len(errs):.2f} over {len(errs)} labelled images')
@@ -1,15 +1,38 @@
 import os
 import sqlite3
 import csv
+import fcntl
 import io
 import smtplib
 import secrets
+import hashlib
+import sys
+import json
+import contextvars
+import queue
+import random
+import threading
+import time
+import mimetypes
+import tempfile
+import urllib.parse
+from collections import namedtuple, deque
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from contextlib import contextmanager
+import click
 from email.message import EmailMessage
 from datetime import datetime, timedelta
 from flask import (Flask, g, render_template, request, redirect, url_for,
-            flash, jsonify)
+            flash, get_flashed_messages, jsonify, Response, session, send_file, abort,
+            has_request_context)
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
+from markupsafe import Markup
+
+import admission
+import assets
+import compression
+import write_coordinator
 
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 
@@ -37,23 +60,216 @@ login_manager = LoginManager()
 login_manager.login_view = 'login'
 login_manager.init_app(app)
 
+# --- Static assets ---
+# assets.py fingerprints static/ into static/build/ (content-hashed names plus
+# .gz/.br variants); url_for('static', ...) is rewritten through its manifest.
+# Building is a deploy step (`python assets.py`: the Dockerfile and
+# deploy_gunicorn.sh run it); importing the app only reads the manifest, so
+# workers, CLI calls and tests never race to rewrite static/build/. Without a
+# build, plain /static/ URLs are used. nginx normally serves /static/build/
+# itself (see deploy/); the route below is the fallback when Flask serves them.
+app.config['ASSET_FINGERPRINTING'] = os.environ.get('ASSET_FINGERPRINTING', '1').lower() in ('1', 'true', 'yes')
+_asset_manifest = {}
+
+
+def load_asset_manifest():
+    """(Re)read the manifest the last asset build wrote."""
+    global _asset_manifest
+    _asset_manifest = assets.load_manifest(app.static_folder) if app.config['ASSET_FINGERPRINTING'] else {}
+    return _asset_manifest
+
+
+load_asset_manifest()
+
+
+@app.url_defaults
+def fingerprint_static_urls(endpoint, values):
+    if endpoint == 'static' and _asset_manifest:
+        hashed = _asset_manifest.get(values.get('filename'))
+        if hashed:
+            values['filename'] = hashed
+
+
+@app.route(f'/static/{assets.BUILD_DIR}/<path:filename>')
+def static_build(filename):
+    path = safe_join(os.path.join(app.static_folder, assets.BUILD_DIR), filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    encoding = None
+    for enc, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if request.accept_encodings[enc] and os.path.isfile(path + suffix):
+            path, encoding = path + suffix, enc
+            break
+    resp = send_file(path, mimetype=mimetype, conditional=True, etag=True, max_age=assets.IMMUTABLE_MAX_AGE)
+    if encoding:
+        resp.headers['Content-Encoding'] = encoding
+    resp.vary.add('Accept-Encoding')
+    resp.cache_control.public = True
+    resp.cache_control.immutable = True
+    return resp
+
+
+# --- Response compression ---
+# gzip (brotli if installed) for HTML/JSON/CSV when nothing in front of gunicorn
+# compresses -- Railway/Render/Fly. Behind the nginx config in deploy/, nginx
+# passes encoded responses through and the /products cache keys on a
+# normalized Accept-Encoding, so a gzip copy only reaches clients that asked
+# for gzip; COMPRESS_RESPONSES=0 leaves the work to nginx instead. Any other
+# shared cache in front must key on (or honour Vary: Accept-Encoding) too.
+# COMPRESS_MIMETYPES takes 'type[=level],...'.
+app.config['COMPRESS_RESPONSES'] = os.environ.get('COMPRESS_RESPONSES', '1').lower() in ('1', 'true', 'yes')
+app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', '500') or 500)
+app.config['COMPRESS_LEVEL'] = int(os.environ.get('COMPRESS_LEVEL', '6') or 6)
+app.config['COMPRESS_MIMETYPES'] = compression.parse_mimetypes(os.environ.get('COMPRESS_MIMETYPES')) or None
+if app.config['COMPRESS_RESPONSES']:
+    app.wsgi_app = compression.CompressionMiddleware(app.wsgi_app, min_size=app.config['COMPRESS_MIN_SIZE'],
+                                                     level=app.config['COMPRESS_LEVEL'],
+                                                     mimetypes=app.config['COMPRESS_MIMETYPES'])
+
+
+# --- Admission control ---
+# Routes are tagged with a class via @admission_class(...); untagged routes are
+# 'normal'. Each class caps how many of its requests run at once across all
+# workers (see admission.py): reports, audits and CSV import/export are
+# 'heavy' (1 running + 1 waiting up to 5s by default, so with 3 workers at
+# least one is always free for orders), order placement and payments are
+# 'critical' and never limited. Refused requests get a 503 with Retry-After.
+# ADMISSION_<CLASS>_SLOTS / _QUEUE / _TIMEOUT tune a class (slots 0 =
+# unlimited); /admin/metrics/admission reports gauges and counters. Every
+# tagged route needs a login, so anonymous requests skip admission and go
+# straight to the login redirect instead of taking a heavy slot.
+ADMISSION_DEFAULTS = {
+    'critical': (0, 0, 0),
+    'normal': (0, 0, 0),
+    'heavy': (1, 1, 5),
+}
+app.config['ADMISSION_CONTROL'] = os.environ.get('ADMISSION_CONTROL', '1').lower() in ('1', 'true', 'yes')
+app.config['ADMISSION_LOCK_DIR'] = os.environ.get('ADMISSION_LOCK_DIR') or os.path.join(
+    tempfile.gettempdir(), 'sam_blocks_admission')
+
+
+def _admission_classes():
+    classes = {}
+    for name, (slots, queue, timeout) in ADMISSION_DEFAULTS.items():
+        prefix = f'ADMISSION_{name.upper()}'
+        slots = int(os.environ.get(f'{prefix}_SLOTS', slots) or 0)
+        classes[name] = admission.AdmissionClass(
+            name, app.config['ADMISSION_LOCK_DIR'], slots=slots or None,
+            queue=int(os.environ.get(f'{prefix}_QUEUE', queue) or 0),
+            timeout=float(os.environ.get(f'{prefix}_TIMEOUT', timeout) or 0))
+    return classes
+
+
+ADMISSION_CLASSES = _admission_classes()
+
+
+def admission_class(name, methods=None):
+    """Put a view in admission class `name` (only for `methods`, if given)."""
+    if name not in ADMISSION_CLASSES:
+        raise KeyError(f'Unknown admission class {name!r}')
+
+    def decorate(view):
+        view._admission_class = (name, tuple(methods) if methods else None)
+        return view
+    return decorate
+
+
+def _request_admission_class():
+    view = app.view_functions.get(request.endpoint)
+    name, methods = getattr(view, '_admission_class', ('normal', None))
+    if methods and request.method not in methods:
+        return 'normal'
+    return name
+
+
+@app.before_request
+def admit_request():
+    if not app.config['ADMISSION_CONTROL'] or request.endpoint in (None, 'static', 'static_build'):
+        return None
+    if '_user_id' not in session:
+        # anonymous: every tagged view sends it to the login page. The
+        # session is checked rather than current_user so no user query runs
+        # before admission (or before ensure_migrations)
+        return None
+    name = _request_admission_class()
+    try:
+        g._admission = ADMISSION_CLASSES[name].acquire()
+    except admission.Rejected as e:
+        app.logger.warning('Admission refused for %s (%s): %s', request.path, name, e.reason)
+        resp = Response('The server is busy with other reports right now. Please try again in a moment.\n',
+                        status=503, mimetype='text/plain')
+        resp.headers['Retry-After'] = str(e.retry_after)
+        return resp
+    return None
+
+
+@app.after_request
+def hand_over_admission(resp):
+    ticket = g.pop('_admission', None)
+    if ticket is None:
+        return resp
+    if not resp.is_streamed:
+        ticket.release()
+        return resp
+    # streamed responses (CSV export) do their work after the view returns:
+    # keep the slot until the body is exhausted or the server closes it
+    body = resp.response
+
+    def release_when_done():
+        try:
+            yield from body
+        finally:
+            ticket.release()
+    resp.response = release_when_done()
+    resp.call_on_close(ticket.release)
+    return resp
+
+
+@app.teardown_request
+def release_admission(e=None):
+    ticket = g.pop('_admission', None)
+    if ticket is not None:
+        ticket.release()
+
+
 # --- Database helpers ---
-def get_db():
-    """Return a DB connection. If DATABASE_URL is set, return a lightweight
-    Postgres wrapper (using psycopg2) that exposes an execute()/executescript()
-    API compatible with the existing sqlite3 usage. Otherwise return the
-    sqlite3.Connection as before.
-    """
+def get_db(intent=None):
+    """Return the request's DB connection, opening it on first use.
+    See connect_db() for how the backend is chosen. While a view declared
+    @db_intent('read') handles a GET this is its read-only connection (see
+    connect_read_db()); intent='write', or a transaction() block, always
+    gets the primary."""
+    if (intent or g.get('_db_intent')) == 'read' and not g.get('_in_transaction'):
+        db = g.get('_read_database')
+        if db is None:
+            db = g._read_database = connect_read_db()
+        return db
     db = getattr(g, '_database', None)
     if db is not None:
         return db
+    g._database = connect_db()
+    return g._database
+
+
+def connect_db(database_url=None):
+    """Open a new DB connection. If DATABASE_URL is set, return a lightweight
+    Postgres wrapper (using psycopg2) that exposes an execute()/executescript()
+    API compatible with the existing sqlite3 usage. Otherwise return a
+    sqlite3.Connection as before. `database_url` connects to that Postgres
+    database instead (a reporting replica, say).
 
+    Unlike get_db() this needs no app context, so background threads and
+    streaming responses can use it; the caller is responsible for closing it.
+    """
     # Allow an explicit override to force SQLite even when DATABASE_URL is set.
     # This is useful while developing locally or if you want to postpone the
     # Postgres migration temporarily. Set FORCE_SQLITE=1 or FORCE_SQLITE=true
     # to force SQLite mode.
     FORCE_SQLITE = os.environ.get('FORCE_SQLITE')
-    if FORCE_SQLITE and str(FORCE_SQLITE).lower() in ('1', 'true', 'yes'):
+    if database_url:
+        DATABASE_URL = database_url
+    elif FORCE_SQLITE and str(FORCE_SQLITE).lower() in ('1', 'true', 'yes'):
         app.logger.info('FORCE_SQLITE enabled: using local SQLite database regardless of DATABASE_URL')
         DATABASE_URL = None
     else:
@@ -82,6 +298,8 @@ def get_db():
             .execute() and .executescript() similar to sqlite3.Connection so
             the rest of the app doesn't need massive changes.
             """
+            dialect = 'postgres'
+
             def __init__(self, conn):
                 self._conn = conn
 
@@ -109,24 +327,160 @@ def get_db():
             def commit(self):
                 return self._conn.commit()
 
+            def rollback(self):
+                return self._conn.rollback()
+
             def close(self):
                 return self._conn.close()
 
             def cursor(self):
                 return self._conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 
+            def server_cursor(self, sql, params=()):
+                # a named cursor lives on the server: fetchmany() pulls rows
+                # in batches instead of the whole result arriving at execute()
+                cur = self._conn.cursor(name=f'stream_{secrets.token_hex(8)}',
+                                        cursor_factory=psycopg2.extras.RealDictCursor)
+                cur.execute(sql.replace('?', '%s'), params)
+                return cur
+
         conn = psycopg2.connect(DATABASE_URL)
-        g._database = _PGConn(conn)
-        return g._database
+        return _PGConn(conn)
 
     # default: sqlite3
     db = sqlite3.connect(app.config['DATABASE'])
     db.row_factory = sqlite3.Row
-    g._database = db
     return db
 
+
+def db_dialect(db):
+    """'postgres' for the psycopg2 wrapper, 'sqlite' otherwise."""
+    return getattr(db, 'dialect', 'sqlite')
+
+
+def insert_returning_id(db, sql, params=()):
+    """Run an INSERT and return the new row's id. psycopg2's lastrowid is
+    an OID (or None), so on Postgres the id comes from RETURNING id."""
+    if db_dialect(db) == 'postgres':
+        return db.execute(sql + ' RETURNING id', params).fetchone()['id']
+    return db.execute(sql, params).lastrowid
+
+
+def database_key():
+    """Identify the database connect_db() would open, for per-database caches
+    (tests and FORCE_SQLITE switch databases inside one process)."""
+    force_sqlite = str(os.environ.get('FORCE_SQLITE') or '').lower() in ('1', 'true', 'yes')
+    url = (os.environ.get('DATABASE_URL') or '').strip()
+    if url and not force_sqlite:
+        return 'postgres:' + url
+    return 'sqlite:' + app.config['DATABASE']
+
+# --- Connection routing ---
+# Views declare what they do with the database: @db_intent('read') list
+# pages get a read-only connection for GET requests -- on SQLite a second
+# connection with PRAGMA query_only (in WAL mode any number of these read in
+# parallel with the writer), on Postgres one of READ_DATABASE_URLS (a replica
+# pool, picked at random per request) in read-only transactions, or the
+# primary when no replicas are configured. Everything else uses the primary,
+# so the write handlers, which have no read intent, keep committing on it as
+# before. A write that has to happen inside a read view (or that wants
+# commit-or-rollback as one unit, like mark_paid) goes through
+# `with transaction() as db:`, which always runs on the primary, so it can't
+# end up split across connections.
+# Replicas lag: for READ_AFTER_WRITE_SECONDS after a browser's last
+# successful POST (or other unsafe method), its reads stay on the primary so
+# the page it is redirected to shows what it just saved.
+app.config['READ_DATABASE_URLS'] = [u.strip() for u in os.environ.get('READ_DATABASE_URLS', '').split(',') if u.strip()]
+app.config['READ_AFTER_WRITE_SECONDS'] = float(os.environ.get('READ_AFTER_WRITE_SECONDS', '10') or 0)
+
+
+def _read_own_writes():
+    """True while this browser's last write may not have reached a replica."""
+    wrote_at = session.get('_wrote_at') if has_request_context() else None
+    return bool(wrote_at) and time.time() - wrote_at < app.config['READ_AFTER_WRITE_SECONDS']
+
+
+@app.after_request
+def remember_write(resp):
+    if (app.config['READ_DATABASE_URLS'] and app.config['READ_AFTER_WRITE_SECONDS']
+            and request.method not in ('GET', 'HEAD', 'OPTIONS') and resp.status_code < 400):
+        session['_wrote_at'] = round(time.time(), 1)
+    return resp
+
+
+def connect_read_db():
+    if database_key().startswith('postgres:'):
+        urls = app.config['READ_DATABASE_URLS']
+        if not urls or _read_own_writes():
+            return get_db('write')
+        conn = connect_db(random.choice(urls))
+        conn.execute('SET SESSION CHARACTERISTICS AS TRANSACTION READ ONLY')
+        conn.commit()
+        return conn
+    conn = connect_db()
+    conn.execute('PRAGMA query_only = ON')
+    return conn
+
+
+def db_intent(intent):
+    """Declare whether a view reads or writes. 'read' only applies to GET and
+    HEAD requests, so a view that lists on GET and saves on POST can say so."""
+    if intent not in ('read', 'write'):
+        raise ValueError(f'intent must be read or write, not {intent!r}')
+    from functools import wraps
+
+    def decorate(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if intent == 'read' and request.method not in ('GET', 'HEAD'):
+                return view(*args, **kwargs)
+            previous = g.get('_db_intent')
+            g._db_intent = intent
+            try:
+                return view(*args, **kwargs)
+            finally:
+                g._db_intent = previous
+        return wrapper
+    return decorate
+
+
+@contextmanager
+def transaction():
+    """`with transaction() as db:` runs the block on the primary connection,
+    committing at the end or rolling back if it raises. Nested blocks join
+    the outermost one."""
+    db = get_db('write')
+    if g.get('_in_transaction'):
+        yield db
+        return
+    g._in_transaction = True
+    try:
+        yield db
+        db.commit()
+    except BaseException:
+        _rollback_quietly(db)
+        raise
+    finally:
+        g._in_transaction = False
+
+
 @app.teardown_appcontext
 def close_db(e=None):
+    if g.get('_streaming_page'):
+        # the view returned a streamed page that is still being sent;
+        # stream_page() closes the connections when it's done
+        return
+    for conn in g.pop('_close_at_teardown', ()):
+        try:
+            conn.close()
+        except Exception:
+            pass
+    read_db = g.pop('_read_database', None)
+    if read_db is not None and read_db is not getattr(g, '_database', None):
+        try:
+            read_db.close()
+        except Exception:
+            pass
     db = getattr(g, '_database', None)
     if db is not None:
         try:
@@ -162,6 +516,12 @@ def init_db():
             app.logger.info('Applied PostgreSQL schema successfully')
         except Exception as e:
             app.logger.exception('Failed to apply PostgreSQL schema: %s', e)
+        try:
+            install_change_tracking(db)
+            db.commit()
+        except Exception as e:
+            _rollback_quietly(db)
+            app.logger.exception('Failed to install change tracking: %s', e)
 
         # create demo admin if not exists (upsert style)
         try:
@@ -177,6 +537,12 @@ def init_db():
         return
 
     # SQLite path: keep previous behavior and safe PRAGMA-based migrations
+    # WAL is persistent, so this switches the file over once: readers (and the
+    # streamed list pages' open cursors) then never block writers
+    try:
+        db.execute('PRAGMA journal_mode=WAL')
+    except Exception:
+        pass
     try:
         with open('schema.sql', 'r', encoding='utf-8') as f:
             db.executescript(f.read())
@@ -312,6 +678,86 @@ def init_db():
         ''')
     except Exception:
         pass
+    try:
+        notif_cols = [r['name'] for r in db.execute("PRAGMA table_info(notifications)").fetchall()]
+        if 'dedupe_key' not in notif_cols:
+            db.execute("ALTER TABLE notifications ADD COLUMN dedupe_key TEXT")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_notifications_dedupe ON notifications (dedupe_key) WHERE is_read = 0")
+    except Exception:
+        pass
+    # partial indexes so low-stock lookups touch only the low rows, not the catalogue
+    try:
+        db.execute("CREATE INDEX IF NOT EXISTS idx_products_low_stock ON products (qty) WHERE qty <= reorder_level")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_raw_materials_low_stock ON raw_materials (qty) WHERE qty <= reorder_level")
+    except Exception:
+        pass
+    # production: bill of materials per product and recorded batches
+    try:
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS bom_recipes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                product_id INTEGER NOT NULL,
+                material_id INTEGER NOT NULL,
+                qty_per_100 REAL NOT NULL,
+                UNIQUE (product_id, material_id),
+                FOREIGN KEY(product_id) REFERENCES products(id),
+                FOREIGN KEY(material_id) REFERENCES raw_materials(id)
+            )
+        ''')
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS production_batches (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                product_id INTEGER NOT NULL,
+                qty INTEGER NOT NULL,
+                shift TEXT,
+                produced_on TEXT NOT NULL,
+                finished_block_id INTEGER,
+                recorded_by TEXT,
+                note TEXT,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY(product_id) REFERENCES products(id)
+            )
+        ''')
+        db.execute("CREATE INDEX IF NOT EXISTS idx_production_batches_day ON production_batches (produced_on)")
+    except Exception:
+        pass
+    # append-only stock journal + per-product checkpoints
+    try:
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS stock_movements (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                product_id INTEGER NOT NULL,
+                movement_type TEXT NOT NULL,
+                qty_delta INTEGER NOT NULL,
+                qty_after INTEGER NOT NULL,
+                ref_entity TEXT,
+                ref_id INTEGER,
+                created_by TEXT,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        db.execute("CREATE INDEX IF NOT EXISTS idx_stock_movements_product ON stock_movements (product_id, id)")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_stock_movements_created ON stock_movements (created_at)")
+        db.execute('''
+            CREATE TRIGGER IF NOT EXISTS stock_movements_no_update BEFORE UPDATE ON stock_movements
+            BEGIN SELECT RAISE(ABORT, 'stock_movements is append-only'); END
+        ''')
+        db.execute('''
+            CREATE TRIGGER IF NOT EXISTS stock_movements_no_delete BEFORE DELETE ON stock_movements
+            BEGIN SELECT RAISE(ABORT, 'stock_movements is append-only'); END
+        ''')
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS stock_snapshots (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                product_id INTEGER NOT NULL,
+                movement_id INTEGER NOT NULL DEFAULT 0,
+                qty INTEGER NOT NULL,
+                taken_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        db.execute("CREATE INDEX IF NOT EXISTS idx_stock_snapshots_product ON stock_snapshots (product_id, movement_id)")
+    except Exception:
+        pass
     # expenses table (for business expense tracking)
     try:
         db.execute('''
@@ -344,16 +790,119 @@ def init_db():
         ''')
     except Exception:
         pass
+    # which table user_id refers to (users/customers); NULL on old rows
+    try:
+        db.execute("ALTER TABLE password_reset_tokens ADD COLUMN account TEXT")
+    except Exception:
+        pass
+    try:
+        db.execute("CREATE INDEX IF NOT EXISTS idx_password_reset_tokens_expires ON password_reset_tokens (expires_at)")
+    except Exception:
+        pass
+    # token buckets for check_rate_limit(); updated_at is unix time
+    try:
+        db.execute('CREATE TABLE IF NOT EXISTS rate_limits (bucket TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)')
+    except Exception:
+        pass
+    # stored responses for @idempotent routes; status_code NULL = still running
+    try:
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                scope TEXT NOT NULL,
+                idem_key TEXT NOT NULL,
+                request_hash TEXT NOT NULL,
+                status_code INTEGER,
+                location TEXT,
+                content_type TEXT,
+                body TEXT,
+                flashes TEXT,
+                created_at TEXT NOT NULL,
+                expires_at TEXT NOT NULL,
+                UNIQUE (scope, idem_key)
+            )
+        ''')
+        db.execute("CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires ON idempotency_keys (expires_at)")
+    except Exception:
+        pass
+    # yard tablet scans (/api/v1/scan-events); client_event_id makes retries idempotent
+    try:
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS scan_batches (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                device_id TEXT,
+                events INTEGER NOT NULL DEFAULT 0,
+                created_by TEXT,
+                received_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS scan_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                client_event_id TEXT NOT NULL UNIQUE,
+                batch_id INTEGER NOT NULL,
+                event_type TEXT NOT NULL,
+                product_id INTEGER NOT NULL,
+                qty INTEGER NOT NULL,
+                scanned_at TEXT,
+                FOREIGN KEY(batch_id) REFERENCES scan_batches(id)
+            )
+        ''')
+    except Exception:
+        pass
+    # /ai/detect runs in the background; the page polls its row for the result
+    try:
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS ai_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                status TEXT NOT NULL DEFAULT 'pending',
+                product_id INTEGER,
+                result TEXT,
+                error TEXT,
+                created_by TEXT,
+                created_at TEXT NOT NULL,
+                expires_at TEXT NOT NULL,
+                finished_at TEXT
+            )
+        ''')
+    except Exception:
+        pass
+    # change_log + triggers for /api/v1/sync
+    try:
+        install_change_tracking(db)
+        db.commit()
+    except Exception:
+        pass
+    # single-row counter bumped on every catalogue-visible product write
+    try:
+        db.execute("CREATE TABLE IF NOT EXISTS catalogue_version (id INTEGER PRIMARY KEY, version INTEGER NOT NULL DEFAULT 1, updated_at TEXT)")
+        db.execute("INSERT OR IGNORE INTO catalogue_version (id, version, updated_at) VALUES (1, 1, ?)", (_utc_timestamp(),))
+        db.commit()
+    except Exception:
+        pass
+
+
+# Run migrations before first request so existing DBs are updated when app is started via flask run.
+# Once per database per process: re-running the schema on every request turned
+# each page view, even a cached one, into a write transaction.
+_migrated_databases = set()
+_migrations_lock = threading.Lock()
 
 
-# Run migrations before first request so existing DBs are updated when app is started via flask run
 @app.before_request
 def ensure_migrations():
-    try:
-        init_db()
-    except Exception:
-        # swallow errors here; init_db already tries safe PRAGMA checks
-        pass
+    key = database_key()
+    if key in _migrated_databases:
+        return
+    with _migrations_lock:
+        if key in _migrated_databases:
+            return
+        try:
+            init_db()
+            _migrated_databases.add(key)
+        except Exception:
+            # swallow errors here; init_db already tries safe PRAGMA checks
+            pass
 
 @app.cli.command('init-db')
 def init_db_command():
@@ -361,6 +910,59 @@ def init_db_command():
     print("Initialized the database.")
 
 
+def get_forecast(db, days=3 * 365, horizon=14, lead_time=7):
+    import forecasting
+    # the cache is per day; key it on the database too so switching DBs (tests,
+    # FORCE_SQLITE) never serves another database's forecast
+    return forecasting.forecast_catalogue(db, days=days, horizon=horizon, lead_time=lead_time, cache_key=database_key())
+
+
+def apply_forecast_reorder_levels(db, forecast, user='forecast'):
+    """Replace hand-entered reorder levels with the forecast's recommendation,
+    auditing each change. The caller commits. Returns the number changed.
+
+    The forecast may be a cached copy from earlier in the day, so each level
+    is compared against the products table, not the forecast's snapshot."""
+    current = {r['id']: r for r in db.execute('SELECT id, qty, reorder_level FROM products').fetchall()}
+    changed = 0
+    for f in forecast:
+        row = current.get(f['product_id'])
+        if row is None:
+            continue
+        old = row['reorder_level']
+        new = f['recommended_reorder_level']
+        if old == new:
+            continue
+        db.execute('UPDATE products SET reorder_level = ? WHERE id = ?', (new, f['product_id']))
+        db.execute('INSERT INTO product_audit (product_id, user, action, field, old_value, new_value, reason) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                   (f['product_id'], user, 'forecast', 'reorder_level', str(old), str(new), 'demand forecast'))
+        emit_stock_change(db, StockChange('product', f['product_id'], f['name'], row['qty'], row['qty'], old, new, 'forecast'))
+        changed += 1
+    return changed
+
+
+@app.cli.command('forecast')
+@click.option('--days', default=3 * 365, show_default=True, help='Days of sales history to fit on.')
+@click.option('--horizon', default=14, show_default=True, help='Days ahead to forecast.')
+@click.option('--lead-time', default=7, show_default=True, help='Restock lead time in days.')
+@click.option('--apply', 'apply_levels', is_flag=True, help='Write recommended reorder levels to products.')
+def forecast_command(days, horizon, lead_time, apply_levels):
+    """Forecast demand for every product and recommend reorder levels."""
+    db = get_db()
+    started = time.perf_counter()
+    forecast = get_forecast(db, days=days, horizon=horizon, lead_time=lead_time)
+    elapsed = time.perf_counter() - started
+    print(f"{'Product':30} {'MA7':>7} {'MA28':>7} {'Next 7d':>8} {'Reorder':>8} {'Suggested':>9}")
+    for f in forecast:
+        print(f"{f['name'][:30]:30} {f['ma7']:7.1f} {f['ma28']:7.1f} {sum(f['forecast'][:7]):8.1f} "
+              f"{f['reorder_level']:8d} {f['recommended_reorder_level']:9d}")
+    print(f"Forecast {len(forecast)} products over {days} days in {elapsed:.3f}s")
+    if apply_levels:
+        changed = apply_forecast_reorder_levels(db, forecast)
+        db.commit()
+        print(f"Updated reorder level on {changed} products.")
+
+
 # Inject the active DB backend into templates for a small UI banner.
 @app.context_processor
 def inject_db_backend():
@@ -377,6 +979,647 @@ def inject_db_backend():
         return {'db_backend': 'Postgres'}
     return {'db_backend': 'SQLite'}
 
+# --- Streamed list pages ---
+# The long list pages (orders, payments, ledger, trips, breakages) render with
+# stream_page() instead of render_template(): the template is rendered as a
+# stream (Jinja's generate(), as flask.stream_template does) and its rows come
+# from a RowStream, which runs the query only when the template's loop
+# reaches it and then reads STREAM_FETCH_SIZE rows at a time (a server-side
+# cursor on Postgres). The page head goes out before the query runs; after
+# that the rows are sent in pieces of about STREAM_CHUNK_BYTES as they are
+# read, so a request holds one batch of rows and one piece of HTML however
+# long the table is. The read stays open while a slow client downloads the
+# page. That only happens in WAL mode (init_db switches SQLite files to it),
+# where an open read doesn't block writers; if a database is still in
+# rollback-journal mode (WAL unsupported on its filesystem, say) the cursor's
+# SHARED lock would hold every writer off until the download finished, so
+# there a RowStream reads all its rows when the loop reaches it and only the
+# rendering is streamed. The session cookie is saved when the
+# view returns, before the page renders, so stream_page() pops the flashed
+# messages and loads the user up front.
+# Templates must iterate a RowStream exactly once -- use {% for %}...{% else %},
+# never |length or {% if rows %}.
+app.config['STREAM_FETCH_SIZE'] = int(os.environ.get('STREAM_FETCH_SIZE', '500') or 500)
+app.config['STREAM_CHUNK_BYTES'] = int(os.environ.get('STREAM_CHUNK_BYTES', '16384') or 16384)
+
+
+class RowStream:
+    """The rows of `sql` on `db`, fetched in batches while being iterated.
+    Iterate once."""
+
+    def __init__(self, db, sql, params=(), size=None):
+        self.db = db
+        self.sql = sql
+        self.params = params
+        self.size = size or app.config['STREAM_FETCH_SIZE']
+        self.started = False
+
+    def __iter__(self):
+        if self.started:
+            raise RuntimeError('A RowStream can only be iterated once')
+        self.started = True
+        return self._rows()
+
+    def _rows(self):
+        if db_dialect(self.db) == 'postgres':
+            cur = self.db.server_cursor(self.sql, self.params)
+        elif _sqlite_wal(self.db):
+            cur = self.db.execute(self.sql, self.params)
+        else:
+            # rollback journal: don't keep a SHARED lock open between chunks
+            yield from self.db.execute(self.sql, self.params).fetchall()
+            return
+        try:
+            while True:
+                rows = cur.fetchmany(self.size)
+                if not rows:
+                    return
+                yield from rows
+        finally:
+            cur.close()
+
+
+def _sqlite_wal(db):
+    row = db.execute('PRAGMA journal_mode').fetchone()
+    return bool(row) and str(row[0]).lower() == 'wal'
+
+
+def stream_page(template_name, **context):
+    """Like render_template(), but returns a response that streams the page
+    while the RowStreams in `context` are read. The request's connections
+    stay open until the last chunk is sent (see close_db)."""
+    # the session is saved before the page renders: anything the templates
+    # take from it has to be read now. get_flashed_messages() keeps what it
+    # popped on the request, so base.html gets the same messages later.
+    get_flashed_messages()
+    current_user.is_authenticated
+    streams = [v for v in context.values() if isinstance(v, RowStream)]
+    limit = app.config['STREAM_CHUNK_BYTES']
+    template = app.jinja_env.get_or_select_template(template_name)
+    app.update_template_context(context)
+    parts = template.generate(context)
+    # the page renders after the view has returned and its request context
+    # has been popped: every step runs in a copy of the view's context, so
+    # url_for(), g and current_user still work, yet nothing stays pushed on
+    # the worker between chunks
+    view_context = contextvars.copy_context()
+    in_head = True
+    g._streaming_page = True
+
+    def finish():
+        try:
+            parts.close()
+        finally:
+            g._streaming_page = False
+            close_db()
+
+    def next_piece():
+        # the head part by part: the next part may wait on a query. After
+        # that, parts joined into pieces of about `limit` characters.
+        nonlocal in_head
+        if in_head:
+            for part in parts:
+                if any(s.started for s in streams):
+                    in_head = False
+                    break
+                if part:
+                    return part
+            else:
+                return ''
+            buffer, size = [part], len(part)
+        else:
+            buffer, size = [], 0
+        for part in parts:
+            buffer.append(part)
+            size += len(part)
+            if size >= limit:
+                break
+        return ''.join(buffer)
+
+    def pieces():
+        try:
+            while True:
+                piece = view_context.run(next_piece)
+                if not piece:
+                    return
+                yield piece
+                # tells the compression middleware to flush what it holds
+                yield ''
+        finally:
+            view_context.run(finish)
+
+    return app.response_class(pieces(), mimetype='text/html')
+
+
+# --- Query time budgets ---
+# Report views run under a time budget so a huge date range or an unfiltered
+# audit can't hold a worker indefinitely. @query_budget(seconds) bounds every
+# statement the view runs on get_db(): on PostgreSQL through
+# SET LOCAL statement_timeout (so it lasts until the view's transaction ends),
+# on SQLite through a progress handler that interrupts the running statement
+# once the deadline passes. Either way the user gets a "narrow your range"
+# page (503) and the statement that was cut off is logged with its parameters.
+# QUERY_BUDGET_SECONDS is the default budget; 0 turns budgets off.
+app.config['QUERY_BUDGET_SECONDS'] = float(os.environ.get('QUERY_BUDGET_SECONDS', '15') or 0)
+# SQLite VM instructions between deadline checks (roughly a millisecond's work)
+QUERY_BUDGET_CHECK_EVERY = 20000
+
+
+class QueryBudgetExceeded(RuntimeError):
+    """A statement ran past the view's query budget and was cancelled.
+    Raised by @query_budget; the error handler below turns it into the
+    "narrow your range" page."""
+
+    def __init__(self, seconds, statement=None):
+        super().__init__(f'Query budget of {seconds:g}s exceeded')
+        self.seconds = seconds
+        self.statement = statement
+
+
+def _is_query_timeout(e):
+    # SQLite: 'interrupted' from the progress handler; Postgres: SQLSTATE
+    # 57014 query_canceled from statement_timeout
+    return getattr(e, 'pgcode', None) == '57014' or (
+        isinstance(e, sqlite3.OperationalError) and 'interrupted' in str(e).lower())
+
+
+def _statement_of(e):
+    """The SQL (with parameters) a cancelled statement was running, if known."""
+    cursor = getattr(e, 'cursor', None)
+    query = getattr(cursor, 'query', None)
+    if query:
+        return query.decode('utf-8', 'replace') if isinstance(query, bytes) else str(query)
+    return getattr(g, '_query_budget_last_sql', None)
+
+
+def start_query_budget(db, seconds):
+    """Bound statements on `db` to `seconds` from now. Returns a callable that
+    lifts the bound again."""
+    if db_dialect(db) == 'postgres':
+        db.execute(f'SET LOCAL statement_timeout = {max(1, int(seconds * 1000))}')
+        return lambda: None
+    deadline = time.monotonic() + seconds
+
+    def check():
+        if time.monotonic() > deadline:
+            g._query_budget_exceeded = True
+            return 1
+        return 0
+
+    def trace(sql):
+        g._query_budget_last_sql = sql
+    db.set_progress_handler(check, QUERY_BUDGET_CHECK_EVERY)
+    # the trace callback sees each statement with its parameters bound
+    db.set_trace_callback(trace)
+
+    def stop():
+        db.set_progress_handler(None, QUERY_BUDGET_CHECK_EVERY)
+        db.set_trace_callback(None)
+    return stop
+
+
+@app.errorhandler(QueryBudgetExceeded)
+def query_timeout_response(e):
+    app.logger.warning('Query budget of %ss exceeded on %s; cancelled: %s', e.seconds, request.full_path, e.statement)
+    message = f'This report took longer than {e.seconds:g}s and was stopped. Please narrow the date range or add filters.'
+    if request.path.endswith('.json') or request.accept_mimetypes.best == 'application/json':
+        return jsonify({'ok': False, 'error': message}), 503
+    return render_template('query_timeout.html', message=message, retry_url=request.path), 503
+
+
+def query_budget(seconds=None):
+    """Run the view's queries under a time budget (default QUERY_BUDGET_SECONDS).
+    A view that runs past it raises QueryBudgetExceeded, even if the view
+    swallowed the interruption itself (its page would be incomplete)."""
+    from functools import wraps
+
+    def decorate(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            budget = app.config['QUERY_BUDGET_SECONDS'] if seconds is None else seconds
+            if not budget:
+                return view(*args, **kwargs)
+            db = get_db()
+            g._query_budget_exceeded = False
+            stop = start_query_budget(db, budget)
+            try:
+                rv = view(*args, **kwargs)
+            except Exception as e:
+                if not (_is_query_timeout(e) or g.get('_query_budget_exceeded')):
+                    raise
+                _rollback_quietly(db)
+                raise QueryBudgetExceeded(budget, _statement_of(e)) from e
+            finally:
+                stop()
+            if g.get('_query_budget_exceeded'):
+                _rollback_quietly(db)
+                raise QueryBudgetExceeded(budget, g.get('_query_budget_last_sql'))
+            return rv
+        return wrapper
+    return decorate
+
+
+# --- Reporting snapshot ---
+# With REPORT_SNAPSHOT=1, report views decorated with @report_snapshot read a
+# copy of the SQLite database instead of the file order writers are locking.
+# The copy is made with SQLite's online backup API into a temp file that then
+# replaces the snapshot, so open report connections keep their old copy
+# and new ones see the fresh one. The copy runs as one read transaction, which
+# never blocks writers in WAL mode and holds the lock only for the copy
+# otherwise. A background thread in each worker refreshes it once it's older
+# than REPORT_SNAPSHOT_MAX_AGE seconds, and a lock file ensures only one worker
+# copies at a time. `flask refresh-report-snapshot` does the same from cron.
+# Past REPORT_SNAPSHOT_MAX_STALENESS (or before the first copy exists) reports
+# read the live database. On Postgres, REPORT_DATABASE_URL points reports at a
+# replica instead; they use read-only transactions, and the as-of time is the
+# replica's last replayed commit. Pages read from a snapshot show "data as of".
+app.config['REPORT_SNAPSHOT'] = os.environ.get('REPORT_SNAPSHOT', '0').lower() in ('1', 'true', 'yes')
+app.config['REPORT_SNAPSHOT_PATH'] = os.environ.get('REPORT_SNAPSHOT_PATH') or None
+app.config['REPORT_SNAPSHOT_MAX_AGE'] = int(os.environ.get('REPORT_SNAPSHOT_MAX_AGE', '300') or 300)
+app.config['REPORT_SNAPSHOT_MAX_STALENESS'] = int(os.environ.get('REPORT_SNAPSHOT_MAX_STALENESS', '1800') or 1800)
+app.config['REPORT_DATABASE_URL'] = os.environ.get('REPORT_DATABASE_URL') or None
+_snapshot_refresher = None
+_snapshot_refresher_lock = threading.Lock()
+
+
+def report_snapshot_path():
+    return app.config['REPORT_SNAPSHOT_PATH'] or app.config['DATABASE'] + '.report'
+
+
+def _snapshot_age(path):
+    try:
+        return time.time() - os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def refresh_report_snapshot(force=False):
+    """Copy the live SQLite database over the snapshot. Returns False without
+    copying if another worker is copying, or (unless `force`) if the snapshot
+    is already younger than REPORT_SNAPSHOT_MAX_AGE."""
+    path = report_snapshot_path()
+    lock_fd = os.open(path + '.lock', os.O_RDWR | os.O_CREAT, 0o660)
+    try:
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        age = _snapshot_age(path)
+        if not force and age is not None and age < app.config['REPORT_SNAPSHOT_MAX_AGE']:
+            return False
+        started = time.time()
+        tmp = f'{path}.{os.getpid()}.tmp'
+        src = sqlite3.connect(app.config['DATABASE'])
+        dst = sqlite3.connect(tmp)
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+            src.close()
+        # the snapshot's mtime is when its data was read: the "as of" time
+        os.utime(tmp, (started, started))
+        os.replace(tmp, path)
+        return True
+    finally:
+        os.close(lock_fd)
+
+
+def _snapshot_refresher_loop():
+    while True:
+        time.sleep(max(1, app.config['REPORT_SNAPSHOT_MAX_AGE'] / 4))
+        if not app.config['REPORT_SNAPSHOT']:
+            continue
+        try:
+            refresh_report_snapshot()
+        except Exception as e:
+            app.logger.warning('Report snapshot refresh failed: %s', e)
+
+
+def _ensure_snapshot_refresher():
+    global _snapshot_refresher
+    with _snapshot_refresher_lock:
+        if _snapshot_refresher is None or not _snapshot_refresher.is_alive():
+            _snapshot_refresher = threading.Thread(target=_snapshot_refresher_loop, name='report-snapshot', daemon=True)
+            _snapshot_refresher.start()
+
+
+def open_report_db():
+    """A read-only connection for reports and the UTC time its data is from,
+    or (None, None) to read the live database."""
+    if app.config['REPORT_DATABASE_URL'] and db_dialect(get_db()) == 'postgres':
+        conn = connect_db(app.config['REPORT_DATABASE_URL'])
+        try:
+            conn.execute('SET SESSION CHARACTERISTICS AS TRANSACTION READ ONLY')
+            row = conn.execute("SELECT (now() AT TIME ZONE 'utc') AS now, "
+                               "(pg_last_xact_replay_timestamp() AT TIME ZONE 'utc') AS replayed").fetchone()
+        except Exception as e:
+            conn.close()
+            app.logger.warning('Report database unavailable, reading live: %s', e)
+            return None, None
+        as_of = row['replayed'] or row['now']  # NULL replay time: not a standby, so current
+        if (row['now'] - as_of).total_seconds() > app.config['REPORT_SNAPSHOT_MAX_STALENESS']:
+            conn.close()
+            return None, None
+        return conn, as_of
+    if not app.config['REPORT_SNAPSHOT'] or db_dialect(get_db()) != 'sqlite':
+        return None, None
+    _ensure_snapshot_refresher()
+    path = report_snapshot_path()
+    age = _snapshot_age(path)
+    if age is None:
+        try:
+            refresh_report_snapshot()
+        except Exception as e:
+            app.logger.warning('Report snapshot refresh failed: %s', e)
+        age = _snapshot_age(path)
+    if age is None or age > app.config['REPORT_SNAPSHOT_MAX_STALENESS']:
+        return None, None
+    conn = sqlite3.connect(f'file:{urllib.parse.quote(path)}?mode=ro', uri=True)
+    conn.row_factory = sqlite3.Row
+    return conn, datetime.utcfromtimestamp(os.path.getmtime(path))
+
+
+def report_snapshot(view):
+    """Serve GET requests for this view from the reporting snapshot (or
+    replica) when one is configured: it becomes the view's read connection
+    (see db_intent) while the view runs."""
+    from functools import wraps
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return view(*args, **kwargs)
+        conn, as_of = open_report_db()
+        if conn is None:
+            return view(*args, **kwargs)
+        previous = g.pop('_read_database', None), g.get('_db_intent')
+        g._read_database, g._db_intent = conn, 'read'
+        g.data_as_of = as_of
+        try:
+            return view(*args, **kwargs)
+        finally:
+            g._db_intent = previous[1]
+            g.pop('_read_database', None)
+            if previous[0] is not None:
+                g._read_database = previous[0]
+            # closed at teardown, not here: a streamed page is still reading it
+            g.setdefault('_close_at_teardown', []).append(conn)
+    return wrapper
+
+
+@app.context_processor
+def inject_data_as_of():
+    return {'data_as_of': g.get('data_as_of')}
+
+
+@app.cli.command('refresh-report-snapshot')
+def refresh_report_snapshot_command():
+    """Copy the live SQLite database to the reporting snapshot now."""
+    if refresh_report_snapshot(force=True):
+        print(f'Report snapshot written to {report_snapshot_path()}')
+    else:
+        print('Another worker is refreshing the snapshot; skipped.')
+
+
+# --- Credentials ---
+# Password hashing is deliberately CPU-heavy. Hashes run on a small per-worker
+# thread pool (hashlib releases the GIL, and under gevent the hub's real OS
+# thread pool is used), and each one first takes one of
+# PASSWORD_HASH_WORKERS + PASSWORD_HASH_MAX_PENDING flock() slots shared by
+# every worker on the host (see admission.py). A login storm therefore can't
+# tie up every web worker in hashing, even under sync workers where each
+# process only hashes one password at a time: past the cap, and when a hash
+# takes longer than PASSWORD_HASH_TIMEOUT, the request fails fast with
+# CredentialsBusy. PASSWORD_HASH_METHOD takes any werkzeug method string
+# ('scrypt', 'scrypt:65536:8:1', 'pbkdf2:sha256:600000'); stored hashes made
+# with other parameters are upgraded on the next login.
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt') or 'scrypt'
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', '2') or 2)
+app.config['PASSWORD_HASH_MAX_PENDING'] = int(os.environ.get('PASSWORD_HASH_MAX_PENDING', '8') or 8)
+app.config['PASSWORD_HASH_TIMEOUT'] = float(os.environ.get('PASSWORD_HASH_TIMEOUT', '10') or 10)
+
+
+class CredentialsBusy(RuntimeError):
+    """Too many password hashes are already in flight, or one timed out."""
+
+
+class CredentialService:
+    def __init__(self, method, workers=2, max_pending=8, timeout=10.0, lock_dir=None):
+        self.method = method
+        self.timeout = timeout
+        self._slots = admission.AdmissionClass('password-hash', lock_dir or app.config['ADMISSION_LOCK_DIR'],
+                                               slots=workers + max_pending)
+        self._workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+        self._prefix = None
+        self._dummy = None
+
+    def _call(self, fn, *args):
+        try:
+            ticket = self._slots.acquire()
+        except admission.Rejected:
+            raise CredentialsBusy('Too many sign-in attempts right now') from None
+        try:
+            hub_pool = _gevent_threadpool()
+            if hub_pool is not None:
+                from gevent import Timeout
+                try:
+                    return hub_pool.spawn(fn, *args).get(timeout=self.timeout)
+                except Timeout:
+                    raise CredentialsBusy('Password check timed out') from None
+            if self._executor is None:
+                with self._lock:
+                    if self._executor is None:
+                        from concurrent.futures import ThreadPoolExecutor
+                        self._executor = ThreadPoolExecutor(self._workers, thread_name_prefix='password-hash')
+            try:
+                return self._executor.submit(fn, *args).result(timeout=self.timeout)
+            except FuturesTimeoutError:
+                raise CredentialsBusy('Password check timed out') from None
+        finally:
+            ticket.release()
+
+    def hash(self, password):
+        return self._call(generate_password_hash, password, self.method)
+
+    def verify(self, stored, password):
+        """Check `password` against a stored hash. With stored=None a dummy
+        hash is checked instead so unknown accounts take as long as known ones."""
+        if stored is None:
+            if self._dummy is None:
+                self._dummy = self.hash(secrets.token_hex(8))
+            self._call(check_password_hash, self._dummy, password)
+            return False
+        return self._call(check_password_hash, stored, password)
+
+    def needs_rehash(self, stored):
+        if self._prefix is None:
+            self._prefix = self.hash('').split('$', 1)[0]
+        return (stored or '').split('$', 1)[0] != self._prefix
+
+
+def _gevent_threadpool():
+    """The gevent hub's OS-thread pool when threading is monkey-patched (a
+    patched ThreadPoolExecutor would hash on the event loop), else None."""
+    if 'gevent' not in sys.modules:
+        return None
+    from gevent import monkey, get_hub
+    return get_hub().threadpool if monkey.is_module_patched('threading') else None
+
+
+credentials = CredentialService(app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_HASH_WORKERS'],
+                                app.config['PASSWORD_HASH_MAX_PENDING'], app.config['PASSWORD_HASH_TIMEOUT'])
+
+# one round-trip for both account tables; staff accounts win over customers
+# with the same email, as before
+LOGIN_LOOKUP_SQL = (
+    "SELECT id, username, email, password, role, 'users' AS source, 0 AS priority FROM users "
+    "WHERE username = ? OR email = ? "
+    "UNION ALL "
+    "SELECT id, name, email, password, role, 'customers', 1 FROM customers WHERE email = ? "
+    "ORDER BY priority LIMIT 1"
+)
+# the same lookup by email only: a reset link goes to the address that was
+# typed, so a username must never match
+RESET_LOOKUP_SQL = (
+    "SELECT id, email, 'users' AS source, 0 AS priority FROM users WHERE email = ? "
+    "UNION ALL "
+    "SELECT id, email, 'customers', 1 FROM customers WHERE email = ? "
+    "ORDER BY priority LIMIT 1"
+)
+
+
+# --- Rate limiting ---
+# login, register and forgot_password each cost a password hash or an SMTP
+# send, so they are limited per client IP and per account before any of
+# that (or any user lookup) happens. Each limit is a token bucket: `burst`
+# attempts at once, refilled continuously at burst/per seconds, which gives a
+# sliding window without storing attempt history. Buckets live in the
+# rate_limits table so all gunicorn workers share them; a check is a single
+# UPSERT ... RETURNING on the primary key, run on a per-thread connection of
+# its own (autocommit, short busy timeout) so it never joins or blocks the
+# request's transaction. If the table can't be reached the request is let
+# through: the hash pool's CredentialsBusy still bounds the damage.
+# RATE_LIMIT_<ENDPOINT> overrides a rule set, e.g. "ip:20/60,account:5/300".
+app.config['RATE_LIMIT_ENABLED'] = os.environ.get('RATE_LIMIT_ENABLED', '1').lower() in ('1', 'true', 'yes')
+app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', '0') or 0)
+app.config['RATE_LIMIT_SWEEP_SECONDS'] = int(os.environ.get('RATE_LIMIT_SWEEP_SECONDS', '3600') or 3600)
+RateRule = namedtuple('RateRule', 'key burst per')
+DEFAULT_RATE_LIMITS = {
+    'login': 'ip:20/60,account:5/300',
+    'register': 'ip:5/600',
+    'forgot_password': 'ip:5/600,account:3/3600',
+}
+_rate_limit_local = threading.local()
+_last_rate_limit_sweep = 0.0
+
+
+def parse_rate_rules(spec):
+    """'ip:20/60,account:5/300' -> [RateRule('ip', 20, 60.0), ...]"""
+    rules = []
+    for item in (spec or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        key, _, limit = item.partition(':')
+        burst, _, per = limit.partition('/')
+        rules.append(RateRule(key.strip(), int(burst), float(per)))
+    return rules
+
+
+app.config['RATE_LIMITS'] = {name: parse_rate_rules(os.environ.get(f'RATE_LIMIT_{name.upper()}', spec))
+                             for name, spec in DEFAULT_RATE_LIMITS.items()}
+
+
+def client_ip():
+    """The client's address, taken from X-Forwarded-For when TRUSTED_PROXIES
+    reverse proxies (nginx's proxy_params) sit in front of the app."""
+    hops = app.config['TRUSTED_PROXIES']
+    forwarded = [a.strip() for a in request.headers.get('X-Forwarded-For', '').split(',') if a.strip()]
+    if hops and forwarded:
+        return forwarded[-min(hops, len(forwarded))]
+    return request.remote_addr or '-'
+
+
+def _rate_limit_db():
+    conns = getattr(_rate_limit_local, 'conns', None)
+    if conns is None:
+        conns = _rate_limit_local.conns = {}
+    key = database_key()
+    conn = conns.get(key)
+    if conn is None:
+        conn = connect_db()
+        if db_dialect(conn) == 'sqlite':
+            conn.isolation_level = None
+            conn.execute('PRAGMA busy_timeout = 200')
+        conns[key] = conn
+    return conn
+
+
+def take_token(db, bucket, burst, per, now=None):
+    """Take one token from `bucket`. Returns 0 if allowed, else the seconds
+    until a token is available. The caller commits (a no-op in autocommit)."""
+    now = time.time() if now is None else now
+    rate = burst / per
+    least = 'LEAST' if db_dialect(db) == 'postgres' else 'MIN'
+    refilled = f'{least}(?, rate_limits.tokens + (? - rate_limits.updated_at) * ?)'
+    row = db.execute(
+        'INSERT INTO rate_limits (bucket, tokens, updated_at) VALUES (?, ?, ?) '
+        f'ON CONFLICT (bucket) DO UPDATE SET tokens = {refilled} - 1, updated_at = ? '
+        f'WHERE {refilled} >= 1 RETURNING tokens',
+        (bucket, burst - 1, now, burst, now, rate, now, burst, now, rate)).fetchone()
+    if row is not None:
+        return 0
+    row = db.execute('SELECT tokens, updated_at FROM rate_limits WHERE bucket = ?', (bucket,)).fetchone()
+    tokens = min(burst, float(row['tokens']) + (now - float(row['updated_at'])) * rate) if row else burst
+    return max(0.001, (1 - tokens) / rate)
+
+
+def check_rate_limit(name, account=None):
+    """Apply the RATE_LIMITS rules for `name` to this request. Returns 0 if it
+    may proceed, else a Retry-After in seconds."""
+    if not app.config['RATE_LIMIT_ENABLED']:
+        return 0
+    values = {'ip': client_ip(), 'account': (account or '').strip().lower()}
+    wait = 0
+    try:
+        db = _rate_limit_db()
+        for rule in app.config['RATE_LIMITS'].get(name, ()):
+            value = values.get(rule.key)
+            if not value:
+                continue
+            digest = hashlib.sha256(value.encode('utf-8')).hexdigest()[:24]
+            wait = max(wait, take_token(db, f'{name}:{rule.key}:{digest}', rule.burst, rule.per))
+        db.commit()
+        _maybe_sweep_rate_limits(db)
+    except Exception as e:
+        app.logger.warning('Rate limit check failed, allowing request: %s', e)
+        try:
+            _rate_limit_local.conns.pop(database_key(), None).close()
+        except Exception:
+            pass
+        return 0
+    return wait
+
+
+def rate_limited_response(template, retry_after):
+    flash('Too many attempts. Please wait a little and try again.', 'warning')
+    return render_template(template), 429, {'Retry-After': str(max(1, int(retry_after + 0.999)))}
+
+
+def _maybe_sweep_rate_limits(db):
+    """Every RATE_LIMIT_SWEEP_SECONDS drop buckets idle long enough to be full
+    again (the longest window): they carry no state."""
+    global _last_rate_limit_sweep
+    now = time.monotonic()
+    if now - _last_rate_limit_sweep < app.config['RATE_LIMIT_SWEEP_SECONDS']:
+        return
+    _last_rate_limit_sweep = now
+    longest = max((r.per for rules in app.config['RATE_LIMITS'].values() for r in rules), default=0)
+    db.execute('DELETE FROM rate_limits WHERE updated_at < ?', (time.time() - longest,))
+    db.commit()
+
 # --- User Model for flask-login ---
 class User(UserMixin):
     def __init__(self, id_, username, email, role='customer'):
@@ -536,7 +1779,918 @@ def notify_admins_on_order(order_id: int, customer_name: str, product_name: str,
         )
         send_email(subject, body, recipients)
     except Exception as e:
-        app.logger.warning('notify_admins_on_order failed: %s', e)
+        app.logger.warning('notify_admins_on_order failed: %s', e)
+
+# Outgoing mail is handed to a single background sender so a slow SMTP server
+# never holds up the request (or the transaction) that triggered it. Mail
+# about a change made inside a transaction waits in a per-thread pending list
+# (email_after_commit) until that work is over -- app-context teardown, or the
+# end of a group-commit batch -- and only goes out if the change committed.
+_email_queue = queue.Queue()
+_email_worker = None
+_email_worker_lock = threading.Lock()
+_pending_emails = threading.local()
+
+def _email_worker_loop():
+    while True:
+        subject, body, to_emails = _email_queue.get()
+        try:
+            send_email(subject, body, to_emails)
+        except Exception as e:
+            app.logger.warning('Queued email failed: %s', e)
+        finally:
+            _email_queue.task_done()
+
+def enqueue_email(subject: str, body: str, to_emails: list[str]):
+    global _email_worker
+    if not to_emails:
+        return
+    with _email_worker_lock:
+        if _email_worker is None or not _email_worker.is_alive():
+            _email_worker = threading.Thread(target=_email_worker_loop, name='email-sender', daemon=True)
+            _email_worker.start()
+    _email_queue.put((subject, body, list(to_emails)))
+
+def email_after_commit(notification_id, subject: str, body: str, to_emails: list[str]):
+    """Queue an email about notification `notification_id` once the
+    transaction that inserted it is over; it is dropped if that rolled back."""
+    if not to_emails:
+        return
+    pending = getattr(_pending_emails, 'items', None)
+    if pending is None:
+        pending = _pending_emails.items = []
+    pending.append((notification_id, subject, body, list(to_emails)))
+
+def flush_pending_emails():
+    """Hand this thread's pending emails whose notification row committed to
+    the sender. A fresh connection only sees committed rows."""
+    pending = getattr(_pending_emails, 'items', None)
+    if not pending:
+        return
+    _pending_emails.items = []
+    try:
+        conn = connect_db()
+    except Exception as e:
+        app.logger.warning('Pending emails dropped, database unavailable: %s', e)
+        return
+    try:
+        for notification_id, subject, body, to_emails in pending:
+            if conn.execute('SELECT 1 FROM notifications WHERE id = ?', (notification_id,)).fetchone():
+                enqueue_email(subject, body, to_emails)
+    except Exception as e:
+        app.logger.warning('Pending emails dropped: %s', e)
+    finally:
+        conn.close()
+
+@app.teardown_appcontext
+def send_committed_emails(e=None):
+    flush_pending_emails()
+
+# --- Stock change events ---
+# Every stock mutation emits a StockChange carrying the before/after quantity
+# and reorder level of the single item it touched. Product changes are first
+# appended to the stock_movements journal (a failure there aborts the caller's
+# transaction); then listeners registered with @on_stock_change react to it,
+# so threshold checks are incremental (one row per change) instead of a
+# catalogue scan.
+StockChange = namedtuple('StockChange', 'kind item_id name old_qty new_qty old_reorder reorder_level source '
+                                        'ref_entity ref_id user', defaults=(None, None, None))
+
+_stock_listeners = []
+
+def on_stock_change(func):
+    _stock_listeners.append(func)
+    return func
+
+def emit_stock_change(db, event):
+    if event.kind == 'product' and event.old_qty != event.new_qty:
+        record_stock_movement(db, event)
+    for listener in _stock_listeners:
+        try:
+            listener(db, event)
+        except Exception as e:
+            app.logger.warning('Stock listener %s failed: %s', getattr(listener, '__name__', listener), e)
+
+def change_product_stock(db, product_id, delta=None, new_qty=None, source='adjustment',
+                         ref_entity=None, ref_id=None, user=None):
+    """Change a product's qty by `delta` (or set it to `new_qty`) and emit a
+    StockChange. Returns the event, or None if the product doesn't exist.
+    The caller owns the transaction and must commit.
+    """
+    row = db.execute('SELECT id, name, qty, reorder_level FROM products WHERE id = ?', (product_id,)).fetchone()
+    if not row:
+        return None
+    if new_qty is None:
+        # relative update keeps concurrent decrements from overwriting each other
+        db.execute('UPDATE products SET qty = qty + ? WHERE id = ?', (int(delta or 0), product_id))
+        row_after = db.execute('SELECT qty FROM products WHERE id = ?', (product_id,)).fetchone()
+        new_qty = int(row_after['qty'] or 0)
+        old_qty = new_qty - int(delta or 0)
+    else:
+        old_qty = int(row['qty'] or 0)
+        new_qty = int(new_qty)
+        db.execute('UPDATE products SET qty = ? WHERE id = ?', (new_qty, product_id))
+    reorder = int(row['reorder_level'] or 0)
+    event = StockChange('product', product_id, row['name'], old_qty, new_qty, reorder, reorder, source,
+                        ref_entity, ref_id, user)
+    emit_stock_change(db, event)
+    return event
+
+def _current_username():
+    try:
+        return getattr(current_user, 'username', None) or getattr(current_user, 'email', None) or 'unknown'
+    except Exception:
+        # outside a request (CLI, background writer)
+        return 'system'
+
+def _utc_timestamp(dt=None):
+    # same text format as SQLite's CURRENT_TIMESTAMP so string comparisons line up
+    return (dt or datetime.utcnow()).strftime('%Y-%m-%d %H:%M:%S')
+
+# --- Stock movement journal ---
+# stock_movements is append-only and is the source of truth for stock;
+# products.qty is the materialized current value, kept in step by
+# change_product_stock() in the same transaction. Every
+# STOCK_SNAPSHOT_INTERVAL movements of a product a checkpoint row goes into
+# stock_snapshots, so the quantity at any past time is the nearest snapshot
+# plus a sum over at most that many movements.
+MOVEMENT_TYPES = ('sale', 'order', 'breakage', 'adjustment', 'import', 'production', 'loadout', 'receipt')
+STOCK_SNAPSHOT_INTERVAL = int(os.environ.get('STOCK_SNAPSHOT_INTERVAL', '100') or 100)
+
+def record_stock_movement(db, event):
+    movement_type = event.source if event.source in MOVEMENT_TYPES else 'adjustment'
+    now = _utc_timestamp()
+    last_snap = db.execute('SELECT movement_id FROM stock_snapshots WHERE product_id = ? ORDER BY movement_id DESC LIMIT 1',
+                           (event.item_id,)).fetchone()
+    if last_snap is None:
+        # first journaled change: checkpoint the pre-journal quantity as the baseline
+        db.execute('INSERT INTO stock_snapshots (product_id, movement_id, qty, taken_at) VALUES (?, ?, ?, ?)',
+                   (event.item_id, 0, event.old_qty, now))
+        last_movement_id = 0
+    else:
+        last_movement_id = last_snap['movement_id']
+    db.execute('INSERT INTO stock_movements (product_id, movement_type, qty_delta, qty_after, ref_entity, ref_id, created_by, created_at) '
+               'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+               (event.item_id, movement_type, event.new_qty - event.old_qty, event.new_qty,
+                event.ref_entity, event.ref_id, event.user or _current_username(), now))
+    since = db.execute('SELECT COUNT(*) AS c, MAX(id) AS last_id FROM stock_movements WHERE product_id = ? AND id > ?',
+                       (event.item_id, last_movement_id)).fetchone()
+    if since and int(since['c'] or 0) >= STOCK_SNAPSHOT_INTERVAL:
+        db.execute('INSERT INTO stock_snapshots (product_id, movement_id, qty, taken_at) VALUES (?, ?, ?, ?)',
+                   (event.item_id, since['last_id'], event.new_qty, now))
+
+def _unjournaled_stock_flows(db, start_day, end_day):
+    """Stock changes made before the journal started, read from the tables
+    that recorded them: sales and breakages no stock_movements row points at,
+    and qty edits in product_audit older than the product's first journaled
+    change. Returns {product_id: ((sold, broken, adjustments) for days in
+    [start_day, end_day), (the same for every day from start_day on))}."""
+    day = (lambda col: f'date({col})') if db_dialect(db) == 'sqlite' else (lambda col: f'CAST({col} AS DATE)')
+    flows = {}
+
+    for slot, table, date_col in ((0, 'sales', 'sale_date'), (1, 'breakages', 'date')):
+        rows = db.execute(
+            f'SELECT t.product_id, SUM(t.qty) AS total, '
+            f'SUM(CASE WHEN {day("t." + date_col)} < ? THEN t.qty ELSE 0 END) AS in_period FROM {table} t '
+            f'WHERE t.product_id IS NOT NULL AND {day("t." + date_col)} >= ? AND NOT EXISTS ('
+            f'SELECT 1 FROM stock_movements m WHERE m.ref_entity = ? AND m.ref_id = t.id) '
+            f'GROUP BY t.product_id', (end_day, start_day, table)).fetchall()
+        for r in rows:
+            in_period, since_start = flows.setdefault(r['product_id'], ([0, 0, 0], [0, 0, 0]))
+            in_period[slot] += int(r['in_period'] or 0)
+            since_start[slot] += int(r['total'] or 0)
+    rows = db.execute(
+        f'SELECT a.product_id, a.old_value, a.new_value, {day("a.timestamp")} < ? AS in_period FROM product_audit a '
+        f"WHERE a.field = 'qty' AND {day('a.timestamp')} >= ? AND NOT EXISTS ("
+        f'SELECT 1 FROM stock_snapshots s WHERE s.product_id = a.product_id AND s.taken_at <= a.timestamp)',
+        (end_day, start_day)).fetchall()
+    for r in rows:
+        try:
+            old = int(float(r['old_value']))
+        except (TypeError, ValueError):
+            old = 0
+        try:
+            new = int(float(r['new_value']))
+        except (TypeError, ValueError):
+            new = 0
+        in_period, since_start = flows.setdefault(r['product_id'], ([0, 0, 0], [0, 0, 0]))
+        if r['in_period']:
+            in_period[2] += new - old
+        since_start[2] += new - old
+    return {pid: (tuple(w[0]), tuple(w[1])) for pid, w in flows.items()}
+
+def stock_qty_at(db, product_id, at):
+    """Quantity of a product just before timestamp `at` ('YYYY-MM-DD HH:MM:SS'),
+    from the nearest earlier snapshot plus the movements since it. Returns
+    None if the product has no journal yet (its qty never changed)."""
+    snap = db.execute('SELECT movement_id, qty FROM stock_snapshots WHERE product_id = ? AND taken_at < ? '
+                      'ORDER BY movement_id DESC LIMIT 1', (product_id, at)).fetchone()
+    if snap is None:
+        # before the journal started: the baseline is the best we know
+        baseline = db.execute('SELECT qty FROM stock_snapshots WHERE product_id = ? ORDER BY movement_id ASC LIMIT 1',
+                              (product_id,)).fetchone()
+        return int(baseline['qty']) if baseline else None
+    row = db.execute('SELECT COALESCE(SUM(qty_delta), 0) AS s FROM stock_movements WHERE product_id = ? AND id > ? AND created_at < ?',
+                     (product_id, snap['movement_id'], at)).fetchone()
+    return int(snap['qty']) + int(row['s'] or 0)
+
+@on_stock_change
+def low_stock_monitor(db, event):
+    """Raise a notification (and queue an admin email) when an item crosses
+    its reorder level. Alerts are deduplicated per item while still unread."""
+    was_low = event.old_qty is not None and event.old_qty <= (event.old_reorder or 0)
+    is_low = event.new_qty <= (event.reorder_level or 0)
+    if was_low or not is_low:
+        return
+    dedupe_key = f"low_stock:{event.kind}:{event.item_id}"
+    existing = db.execute('SELECT id FROM notifications WHERE dedupe_key = ? AND is_read = 0',
+                          (dedupe_key,)).fetchone()
+    if existing:
+        return
+    label = 'Product' if event.kind == 'product' else 'Raw material'
+    title = f"Low stock: {event.name}"
+    msg = (f"{label}: {event.name}\nQuantity: {event.new_qty} (reorder level {event.reorder_level})\n"
+           f"Triggered by: {event.source}")
+    notification_id = insert_returning_id(
+        db, "INSERT INTO notifications (title, message, level, dedupe_key) VALUES (?, ?, ?, ?)",
+        (title, msg, 'warning', dedupe_key))
+    email_after_commit(notification_id, title, msg + "\n", _get_admin_emails(db))
+
+# --- Production batches ---
+# A batch turns raw materials into finished blocks according to the product's
+# bill of materials (bom_recipes: material qty per 100 blocks). Consumption,
+# the finished_blocks row and the product stock increase all happen in the
+# caller's transaction, so a batch is recorded completely or not at all.
+class ProductionError(ValueError):
+    pass
+
+
+def record_production_batch(db, product_id, qty, shift='', produced_on=None, note='', user=None):
+    """Consume raw materials and add `qty` finished blocks of `product_id`.
+    Raises ProductionError (leaving the caller to roll back) if the product
+    is unknown or a material would go negative. Returns the batch id."""
+    qty = int(qty)
+    if qty <= 0:
+        raise ProductionError('Batch quantity must be positive')
+    product = db.execute('SELECT id, name FROM products WHERE id = ?', (product_id,)).fetchone()
+    if not product:
+        raise ProductionError(f'Unknown product {product_id}')
+    user = user or _current_username()
+    produced_on = produced_on or datetime.utcnow().date().isoformat()
+    recipe = db.execute('SELECT r.material_id, r.qty_per_100, m.name, m.qty, m.reorder_level '
+                        'FROM bom_recipes r JOIN raw_materials m ON r.material_id = m.id WHERE r.product_id = ?',
+                        (product_id,)).fetchall()
+    for line in recipe:
+        need = float(line['qty_per_100']) * qty / 100.0
+        # conditional update: the stock check and the decrement are one statement
+        cur = db.execute('UPDATE raw_materials SET qty = qty - ? WHERE id = ? AND qty >= ?',
+                         (need, line['material_id'], need))
+        if cur.rowcount == 0:
+            raise ProductionError(f"Not enough {line['name']}: need {need:g}, have {float(line['qty'] or 0):g}")
+        old_qty = float(line['qty'] or 0)
+        emit_stock_change(db, StockChange('material', line['material_id'], line['name'], old_qty, old_qty - need,
+                                          float(line['reorder_level'] or 0), float(line['reorder_level'] or 0),
+                                          'production', 'production_batches', None, user))
+    finished_id = insert_returning_id(db, 'INSERT INTO finished_blocks (block_type, qty, date_produced) VALUES (?, ?, ?)',
+                                      (product['name'], qty, produced_on))
+    batch_id = insert_returning_id(
+        db, 'INSERT INTO production_batches (product_id, qty, shift, produced_on, finished_block_id, recorded_by, note) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)', (product_id, qty, shift, produced_on, finished_id, user, note))
+    change_product_stock(db, product_id, qty, source='production', ref_entity='production_batches',
+                         ref_id=batch_id, user=user)
+    return batch_id
+
+
+def plan_material_requirements(db, days=28):
+    """Project raw material depletion from recent sales velocity.
+
+    Velocity (units/day per product over the last `days` days, sales plus
+    orders) is multiplied through the bill-of-materials matrix in one NumPy
+    pass to get the daily burn of every material, and from that the days of
+    cover left. Returns a list of dicts ordered by soonest depletion.
+    """
+    import numpy as np
+
+    since = (datetime.utcnow().date() - timedelta(days=days)).isoformat()
+    products = db.execute('SELECT id FROM products ORDER BY id').fetchall()
+    materials = db.execute('SELECT id, name, qty, reorder_level FROM raw_materials ORDER BY id').fetchall()
+    if not materials:
+        return []
+    p_index = {r['id']: i for i, r in enumerate(products)}
+    m_index = {r['id']: j for j, r in enumerate(materials)}
+
+    sold = np.zeros(len(products))
+    velocity_rows = db.execute(
+        'SELECT product_id, SUM(qty) AS q FROM sales WHERE sale_date >= ? AND product_id IS NOT NULL GROUP BY product_id '
+        'UNION ALL '
+        'SELECT oi.product_id, SUM(oi.qty) AS q FROM order_items oi JOIN orders o ON oi.order_id = o.id '
+        'WHERE o.order_date >= ? GROUP BY oi.product_id', (since, since)).fetchall()
+    for r in velocity_rows:
+        if r['product_id'] in p_index:
+            sold[p_index[r['product_id']]] += float(r['q'] or 0)
+    velocity = sold / float(days)
+
+    bom = np.zeros((len(products), len(materials)))
+    for r in db.execute('SELECT product_id, material_id, qty_per_100 FROM bom_recipes').fetchall():
+        if r['product_id'] in p_index and r['material_id'] in m_index:
+            bom[p_index[r['product_id']], m_index[r['material_id']]] = float(r['qty_per_100']) / 100.0
+
+    burn = velocity @ bom
+    stock = np.array([float(m['qty'] or 0) for m in materials])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cover = np.where(burn > 0, stock / burn, np.inf)
+
+    today = datetime.utcnow().date()
+    plan = []
+    for j in np.argsort(cover, kind='stable'):
+        m = materials[int(j)]
+        days_left = float(cover[j])
+        plan.append({
+            'material_id': m['id'],
+            'name': m['name'],
+            'qty': float(m['qty'] or 0),
+            'reorder_level': float(m['reorder_level'] or 0),
+            'daily_use': round(float(burn[j]), 3),
+            'days_of_cover': None if np.isinf(days_left) else round(days_left, 1),
+            'depletes_on': None if np.isinf(days_left) else (today + timedelta(days=int(days_left))).isoformat(),
+        })
+    return plan
+
+# --- Live notification feed (Server-Sent Events) ---
+# One poller thread per process follows the notifications table by a
+# high-water-mark id and fans new rows out to every open stream through a
+# Condition, so N idle admin tabs cost one cheap query per interval rather
+# than N. Under a gevent worker (see gunicorn.conf.py) the thread and the
+# Condition are cooperative, so thousands of idle streams don't pin workers.
+app.config['SSE_POLL_SECONDS'] = float(os.environ.get('SSE_POLL_SECONDS', '2') or 2)
+# Sync gunicorn workers are killed after --timeout (30s) without a heartbeat,
+# so streams end before that and EventSource reconnects with Last-Event-ID.
+app.config['SSE_MAX_STREAM_SECONDS'] = float(os.environ.get('SSE_MAX_STREAM_SECONDS', '25') or 25)
+# A stream holds its worker for its whole life, which only an async worker
+# class can afford: with the default sync workers three open admin tabs would
+# stall every other request. So the stream is only served when
+# GUNICORN_WORKER_CLASS (read by gunicorn.conf.py) is gevent or eventlet, or
+# SSE_ENABLED=1 says so; otherwise the notifications page polls
+# /admin/notifications/unread every NOTIFICATIONS_POLL_SECONDS.
+ASYNC_WORKER_CLASSES = ('gevent', 'eventlet')
+_sse_default = os.environ.get('GUNICORN_WORKER_CLASS', 'sync').lower().rsplit('.', 1)[-1] in ASYNC_WORKER_CLASSES
+app.config['SSE_ENABLED'] = (os.environ.get('SSE_ENABLED', '1' if _sse_default else '0') or '0').lower() in ('1', 'true', 'yes')
+app.config['NOTIFICATIONS_POLL_SECONDS'] = float(os.environ.get('NOTIFICATIONS_POLL_SECONDS', '30') or 30)
+
+
+class NotificationFeed:
+    def __init__(self, poll_seconds=2.0, backlog=200):
+        self.poll_seconds = poll_seconds
+        self._cond = threading.Condition()
+        self._recent = deque(maxlen=backlog)
+        self._hwm = None
+        self._unread = 0
+        self._thread = None
+        self._subscribers = 0
+
+    def subscribe(self):
+        """Register a stream; the poller runs while at least one is open."""
+        with self._cond:
+            self._subscribers += 1
+            if self._thread is None:
+                self._poll()
+                self._thread = threading.Thread(target=self._run, name='notification-feed', daemon=True)
+                self._thread.start()
+
+    def unsubscribe(self):
+        with self._cond:
+            self._subscribers -= 1
+
+    def _run(self):
+        while True:
+            time.sleep(self.poll_seconds)
+            try:
+                with self._cond:
+                    if self._subscribers <= 0:
+                        self._thread = None
+                        return
+                    self._poll()
+            except Exception as e:
+                app.logger.warning('Notification feed poll failed: %s', e)
+
+    def _poll(self):
+        conn = connect_db()
+        try:
+            if self._hwm is None:
+                row = conn.execute('SELECT MAX(id) AS m FROM notifications').fetchone()
+                self._hwm = int(row['m'] or 0) if row else 0
+                rows = []
+            else:
+                rows = conn.execute('SELECT id, title, message, level, created_at FROM notifications '
+                                    'WHERE id > ? ORDER BY id LIMIT 500', (self._hwm,)).fetchall()
+            unread = conn.execute('SELECT COUNT(*) AS c FROM notifications WHERE is_read = 0').fetchone()['c']
+        finally:
+            conn.close()
+        changed = bool(rows) or int(unread or 0) != self._unread
+        for r in rows:
+            self._recent.append(_notification_payload(r))
+            self._hwm = r['id']
+        self._unread = int(unread or 0)
+        if changed:
+            self._cond.notify_all()
+
+    @property
+    def high_water_mark(self):
+        return self._hwm or 0
+
+    def wait(self, since, unread_seen, timeout):
+        """Block until there are notifications newer than `since` or the unread
+        count differs from `unread_seen`; return (new_rows, unread)."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._hwm > since or self._unread != unread_seen, timeout=timeout)
+            if since < self._hwm and (not self._recent or self._recent[0]['id'] > since + 1):
+                # the client is further behind than the in-memory backlog
+                return None, self._unread
+            return [n for n in self._recent if n['id'] > since], self._unread
+
+
+def _notification_payload(row):
+    created = row['created_at']
+    return {'id': row['id'], 'title': row['title'], 'message': row['message'], 'level': row['level'],
+            'created_at': created.isoformat() if hasattr(created, 'isoformat') else created}
+
+
+notification_feed = NotificationFeed(app.config['SSE_POLL_SECONDS'])
+
+# --- Dashboard data provider ---
+# All scalar counters are folded into a single multi-subquery SELECT and the
+# low-stock lists into one UNION query, so a dashboard costs two round-trips on
+# Postgres instead of one per counter. If the batched statement fails (e.g. a
+# table is missing on an old DB) each section falls back to its own query so
+# one broken table doesn't blank the whole dashboard.
+DASHBOARD_COUNTERS = {
+    'total_products': "SELECT COUNT(*) FROM products",
+    'total_customers': "SELECT COUNT(*) FROM customers",
+    'total_orders': "SELECT COUNT(*) FROM orders",
+    'total_sales': "SELECT COUNT(*) FROM sales",
+    'total_payments': "SELECT COUNT(*) FROM payments",
+    'pending_payments': "SELECT COUNT(*) FROM payments WHERE status = 'Pending'",
+    'total_raw_materials': "SELECT COUNT(*) FROM raw_materials",
+    # per-customer counters take the customer id as their only parameter
+    'my_orders': "SELECT COUNT(*) FROM orders WHERE customer_id = ?",
+    'my_payments': "SELECT COUNT(*) FROM payments p JOIN orders o ON p.order_id = o.id WHERE o.customer_id = ?",
+}
+
+ADMIN_DASHBOARD_COUNTERS = ('total_products', 'total_customers', 'total_sales', 'pending_payments')
+
+LOW_STOCK_QUERIES = {
+    'product': "SELECT 'product' AS kind, id, name, qty, reorder_level FROM products WHERE qty <= reorder_level",
+    'material': "SELECT 'material' AS kind, id, name, qty, reorder_level FROM raw_materials WHERE qty <= reorder_level",
+}
+
+
+def _rollback_quietly(db):
+    # A failed statement aborts the whole transaction on Postgres; roll back so
+    # the fallback queries can still run on the same connection.
+    try:
+        db.rollback()
+    except Exception:
+        pass
+
+
+def _row_to_dict(row):
+    return {k: row[k] for k in row.keys()}
+
+
+def _dashboard_counters(db, names, customer_id=None):
+    """Return ({name: count}, {name: error}) for the requested counters."""
+    counters = {}
+    errors = {}
+    params = []
+    subqueries = []
+    for name in names:
+        sql = DASHBOARD_COUNTERS[name]
+        subqueries.append(f"({sql}) AS {name}")
+        if '?' in sql:
+            params.append(customer_id)
+    if not subqueries:
+        return counters, errors
+    try:
+        row = db.execute('SELECT ' + ', '.join(subqueries), params).fetchone()
+        for name in names:
+            counters[name] = int(row[name] or 0) if row else 0
+        return counters, errors
+    except Exception as e:
+        _rollback_quietly(db)
+        app.logger.warning('Batched dashboard counters failed, falling back per counter: %s', e)
+
+    for name in names:
+        sql = DASHBOARD_COUNTERS[name]
+        try:
+            row = db.execute(f"SELECT ({sql}) AS c", (customer_id,) if '?' in sql else ()).fetchone()
+            counters[name] = int(row['c'] or 0) if row else 0
+        except Exception as e:
+            _rollback_quietly(db)
+            counters[name] = 0
+            errors[name] = str(e)
+            app.logger.error('Dashboard counter %s failed: %s', name, e)
+    return counters, errors
+
+
+def _dashboard_low_stock(db):
+    """Return ({kind: [rows]}, {kind: error}) for low-stock products and materials."""
+    low = {kind: [] for kind in LOW_STOCK_QUERIES}
+    errors = {}
+    try:
+        sql = ' UNION ALL '.join(LOW_STOCK_QUERIES.values()) + ' ORDER BY kind, qty'
+        for r in db.execute(sql).fetchall():
+            low[r['kind']].append(_row_to_dict(r))
+        return low, errors
+    except Exception as e:
+        _rollback_quietly(db)
+        app.logger.warning('Batched low-stock query failed, falling back per table: %s', e)
+
+    for kind, sql in LOW_STOCK_QUERIES.items():
+        try:
+            low[kind] = [_row_to_dict(r) for r in db.execute(sql + ' ORDER BY qty ASC').fetchall()]
+        except Exception as e:
+            _rollback_quietly(db)
+            low[kind] = []
+            errors[f'low_{kind}s'] = str(e)
+            app.logger.error('Low %s query failed: %s', kind, e)
+    return low, errors
+
+
+def get_dashboard_data(counters=(), low_stock=False, customer_id=None, db=None):
+    """Collect dashboard counters and (optionally) low-stock lists.
+
+    Returns a dict with the requested counters as top-level keys plus
+    `low_products`, `low_materials` (when `low_stock` is set) and `errors`,
+    a {section: message} map of anything that had to fall back to zero.
+    """
+    db = db or get_db()
+    data, errors = _dashboard_counters(db, list(counters), customer_id)
+    if low_stock:
+        low, low_errors = _dashboard_low_stock(db)
+        data['low_products'] = low['product']
+        data['low_materials'] = low['material']
+        errors.update(low_errors)
+    data['errors'] = errors
+    return data
+
+# --- Write coordination ---
+# Optional single-writer mode for SQLite deployments with several gunicorn
+# workers (WRITE_COORDINATOR):
+#   off     each request writes and commits on its own connection (default)
+#   thread  writes go to one group-commit writer thread per process
+#   socket  writes go to one writer process for all workers over a Unix socket
+#           (`flask write-coordinator`, see deploy/sam_blocks_writer.service);
+#           if it isn't running, requests fall back to writing themselves.
+# Busy write routes are expressed as operations registered with
+# @write_operation: op(db, **kwargs) -> JSON-serialisable result, no commit.
+# run_write() runs one wherever the mode says and returns its result.
+app.config['WRITE_COORDINATOR'] = (os.environ.get('WRITE_COORDINATOR', 'off') or 'off').lower()
+app.config['WRITE_COORDINATOR_SOCKET'] = os.environ.get('WRITE_COORDINATOR_SOCKET') or os.path.join(BASE_DIR, 'writer.sock')
+app.config['WRITE_BATCH_MAX'] = int(os.environ.get('WRITE_BATCH_MAX', '64') or 64)
+app.config['WRITE_BATCH_WAIT_MS'] = float(os.environ.get('WRITE_BATCH_WAIT_MS', '2') or 2)
+
+WRITE_OPERATIONS = {}
+_write_coordinators = {}
+_write_coordinators_lock = threading.Lock()
+
+
+def write_operation(func):
+    WRITE_OPERATIONS[func.__name__] = func
+    return func
+
+
+def _writer_connection():
+    # autocommit mode: the writer issues BEGIN IMMEDIATE/COMMIT itself
+    db = sqlite3.connect(app.config['DATABASE'], timeout=30, isolation_level=None, check_same_thread=False)
+    db.row_factory = sqlite3.Row
+    # readers keep reading while a batch commits
+    db.execute('PRAGMA journal_mode=WAL')
+    return db
+
+
+def make_group_commit_writer():
+    return write_coordinator.GroupCommitWriter(_writer_connection, WRITE_OPERATIONS,
+                                               max_batch=app.config['WRITE_BATCH_MAX'],
+                                               max_wait=app.config['WRITE_BATCH_WAIT_MS'] / 1000.0,
+                                               after_batch=flush_pending_emails)
+
+
+def _write_coordinator():
+    mode = app.config['WRITE_COORDINATOR']
+    if mode not in ('thread', 'socket'):
+        return None
+    key = (mode, database_key())
+    if key[1].startswith('postgres:'):
+        # Postgres has row-level locking; the coordinator is for SQLite only
+        return None
+    with _write_coordinators_lock:
+        coordinator = _write_coordinators.get(key)
+        if coordinator is None:
+            if mode == 'thread':
+                coordinator = make_group_commit_writer()
+            else:
+                coordinator = write_coordinator.SocketClient(
+                    app.config['WRITE_COORDINATOR_SOCKET'],
+                    exceptions={'ValueError': ValueError, 'ProductionError': ProductionError})
+            _write_coordinators[key] = coordinator
+    return coordinator
+
+
+def run_write(op, **kwargs):
+    """Run write operation `op` and commit it; return its result."""
+    coordinator = _write_coordinator()
+    if coordinator is not None:
+        try:
+            return coordinator.submit(op, kwargs)
+        except write_coordinator.CoordinatorUnavailable as e:
+            app.logger.warning('%s; writing directly', e)
+    db = get_db()
+    try:
+        result = WRITE_OPERATIONS[op](db, **kwargs)
+        db.commit()
+    except Exception:
+        _rollback_quietly(db)
+        raise
+    return result
+
+
+@write_operation
+def place_order(db, customer_id, product_id, qty, account_number='', user=None):
+    """Create a pending order with its item and payment and take the stock.
+    Raises ValueError if the product is unknown or stock is short."""
+    product = db.execute('SELECT id, name, price, qty FROM products WHERE id = ?', (product_id,)).fetchone()
+    if not product:
+        raise ValueError(f'Unknown product {product_id}')
+    available = product['qty']
+    if available is not None and qty > available:
+        raise ValueError(f'Requested quantity ({qty}) exceeds available stock ({available}).')
+    unit_price = product['price']
+    total = unit_price * qty
+    order_id = insert_returning_id(db, 'INSERT INTO orders (customer_id, total, status) VALUES (?, ?, ?)',
+                                   (customer_id, total, 'Pending'))
+    db.execute('INSERT INTO order_items (order_id, product_id, qty, unit_price) VALUES (?, ?, ?, ?)',
+               (order_id, product_id, qty, unit_price))
+    db.execute('INSERT INTO payments (order_id, amount, status, account_number) VALUES (?, ?, ?, ?)',
+               (order_id, total, 'Pending', account_number))
+    if available is not None:
+        change_product_stock(db, product_id, -qty, source='order', ref_entity='orders', ref_id=order_id, user=user)
+    customer = db.execute('SELECT name FROM customers WHERE id = ?', (customer_id,)).fetchone()
+    return {'order_id': order_id, 'total': total, 'product_name': product['name'] or '',
+            'customer_name': (customer['name'] if customer else '') or ''}
+
+
+@write_operation
+def record_sale(db, product_id, qty, amount, buyer_name='', sale_date=None, user=None):
+    sale_date = sale_date or datetime.utcnow().date().isoformat()
+    sale_id = insert_returning_id(db, 'INSERT INTO sales (sale_date, amount, product_id, qty, buyer_name) VALUES (?, ?, ?, ?, ?)',
+                                  (sale_date, amount, product_id, qty, buyer_name))
+    change_product_stock(db, product_id, -qty, source='sale', ref_entity='sales', ref_id=sale_id, user=user)
+    return sale_id
+
+
+@write_operation
+def record_breakage(db, product_id, qty, reason='', reported_by='', date=None, user=None):
+    date = date or datetime.utcnow().isoformat()
+    breakage_id = insert_returning_id(db, 'INSERT INTO breakages (product_id, qty, reason, reported_by, date) VALUES (?, ?, ?, ?, ?)',
+                                      (product_id, qty, reason, reported_by, date))
+    change_product_stock(db, product_id, -qty, source='breakage', ref_entity='breakages', ref_id=breakage_id, user=user)
+    return breakage_id
+
+
+@write_operation
+def record_trip(db, vehicle_no, driver_name='', date=None, amount=0.0, note='', user=None):
+    date = date or datetime.utcnow().date().isoformat()
+    trip_id = insert_returning_id(db, 'INSERT INTO trips (vehicle_no, driver_name, date, amount, note) VALUES (?, ?, ?, ?, ?)',
+                                  (vehicle_no, driver_name, date, amount, note))
+    summary = f"vehicle_no={vehicle_no};driver_name={driver_name};date={date};amount={amount};note={note}"
+    try:
+        db.execute('INSERT INTO audit (entity, entity_id, user, action, field, old_value, new_value, reason) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                   ('trips', trip_id, user or 'unknown', 'create', 'all', '', summary, 'create'))
+    except Exception:
+        pass
+    return trip_id
+
+
+@write_operation
+def add_ledger_entry(db, date, description, qty_in=0, qty_out=0, amount=0.0, user=None):
+    """Append a ledger row; its balance follows the latest entry's. Returns
+    the new balance."""
+    last_entry = db.execute('SELECT balance FROM ledger ORDER BY date DESC, id DESC LIMIT 1').fetchone()
+    previous_balance = last_entry['balance'] if last_entry else 0
+    new_balance = previous_balance + float(amount)
+    db.execute('INSERT INTO ledger (date, description, qty_in, qty_out, amount, balance, created_by) VALUES (?, ?, ?, ?, ?, ?, ?)',
+               (date, description, int(qty_in), int(qty_out), float(amount), new_balance, user))
+    return new_balance
+
+
+@app.cli.command('write-coordinator')
+@click.option('--socket', 'path', default=None, help='Unix socket path (default: WRITE_COORDINATOR_SOCKET)')
+def write_coordinator_command(path):
+    """Run the single SQLite writer that WRITE_COORDINATOR=socket workers submit to."""
+    path = path or app.config['WRITE_COORDINATOR_SOCKET']
+    with app.app_context():
+        init_db()
+    writer = make_group_commit_writer()
+    print(f'Write coordinator listening on {path}')
+    write_coordinator.serve(path, writer)
+
+
+# --- Idempotency keys ---
+# Form POSTs that create money or stock movements (orders, sales, payments)
+# can arrive twice: a double-click, or a browser/app retrying after a dropped
+# connection. @idempotent routes accept a key, from an Idempotency-Key header
+# or the hidden field idempotency_field() renders into the form. The first
+# request with a key claims a row in idempotency_keys (UNIQUE on scope + key)
+# and stores its response there; a repeat replays that response, flash
+# messages included, without running the view again. A repeat that arrives
+# while the first is still running waits up to IDEMPOTENCY_WAIT_SECONDS for
+# it. If the view raises or returns a 5xx the key is released so a retry
+# runs it afresh. Keys expire after IDEMPOTENCY_TTL_HOURS and are swept like
+# reset tokens (`flask purge-idempotency-keys`).
+IDEMPOTENCY_FIELD = '_idempotency_key'
+app.config['IDEMPOTENCY_TTL_HOURS'] = int(os.environ.get('IDEMPOTENCY_TTL_HOURS', '24') or 24)
+app.config['IDEMPOTENCY_WAIT_SECONDS'] = float(os.environ.get('IDEMPOTENCY_WAIT_SECONDS', '5') or 5)
+app.config['IDEMPOTENCY_SWEEP_SECONDS'] = int(os.environ.get('IDEMPOTENCY_SWEEP_SECONDS', '3600') or 3600)
+_last_idempotency_sweep = 0.0
+
+
+def idempotency_field():
+    """Hidden input carrying a fresh idempotency key, for forms posting to
+    @idempotent routes."""
+    return Markup(f'<input type="hidden" name="{IDEMPOTENCY_FIELD}" value="{secrets.token_urlsafe(16)}">')
+
+
+app.jinja_env.globals['idempotency_field'] = idempotency_field
+
+
+def _idempotency_request_hash():
+    form = sorted((k, v) for k, v in request.form.items(multi=True) if k != IDEMPOTENCY_FIELD)
+    h = hashlib.sha256(f'{request.method} {request.path}\n'.encode('utf-8'))
+    h.update(json.dumps(form).encode('utf-8'))
+    h.update(request.get_data(cache=True) if not request.form else b'')
+    return h.hexdigest()
+
+
+def _claim_idempotency_key(db, scope, key, request_hash):
+    """Insert a pending row for (scope, key). Returns None if this request
+    owns the key now, else the existing row."""
+    now = _utc_timestamp()
+    expires = _utc_timestamp(datetime.utcnow() + timedelta(hours=app.config['IDEMPOTENCY_TTL_HOURS']))
+    for _ in range(2):
+        try:
+            db.execute('INSERT INTO idempotency_keys (scope, idem_key, request_hash, created_at, expires_at) '
+                       'VALUES (?, ?, ?, ?, ?)', (scope, key, request_hash, now, expires))
+            db.commit()
+            return None
+        except Exception as e:
+            _rollback_quietly(db)
+            if 'unique' not in str(e).lower() and 'duplicate' not in str(e).lower():
+                raise
+        row = db.execute('SELECT * FROM idempotency_keys WHERE scope = ? AND idem_key = ?', (scope, key)).fetchone()
+        if row is None:
+            continue  # released between our insert and the lookup
+        if str(row['expires_at']) > now:
+            return row
+        db.execute('DELETE FROM idempotency_keys WHERE id = ?', (row['id'],))
+        db.commit()
+    return db.execute('SELECT * FROM idempotency_keys WHERE scope = ? AND idem_key = ?', (scope, key)).fetchone()
+
+
+def _release_idempotency_key(db, scope, key):
+    try:
+        _rollback_quietly(db)
+        db.execute('DELETE FROM idempotency_keys WHERE scope = ? AND idem_key = ?', (scope, key))
+        db.commit()
+    except Exception as e:
+        app.logger.warning('Could not release idempotency key: %s', e)
+
+
+def _replay_idempotent(row):
+    for category, message in json.loads(row['flashes'] or '[]'):
+        flash(message, category)
+    resp = Response(row['body'] or '', status=int(row['status_code']), content_type=row['content_type'])
+    if row['location']:
+        resp.headers['Location'] = row['location']
+    resp.headers['Idempotent-Replayed'] = 'true'
+    return resp
+
+
+def _idempotency_conflict(status, message, retry_after=None):
+    if request.headers.get('Idempotency-Key'):
+        resp = jsonify({'ok': False, 'error': message})
+        resp.status_code = status
+        if retry_after:
+            resp.headers['Retry-After'] = str(retry_after)
+        return resp
+    # a browser form: say so and send them back to a fresh copy of the form
+    flash(message, 'warning')
+    return redirect(_form_page_url())
+
+
+def _form_page_url():
+    """The page a refused form POST came from: the referrer when it is on this
+    site, else the view's own URL if it answers GET (mark_paid, say, is
+    POST-only and its forms live on other pages), else the home page."""
+    if request.referrer:
+        ref = urllib.parse.urlsplit(request.referrer)
+        if ref.netloc in ('', request.host):
+            return urllib.parse.urlunsplit(('', '', ref.path or '/', ref.query, ''))
+    if request.url_rule is not None and 'GET' in request.url_rule.methods:
+        return request.path
+    return url_for('index')
+
+
+def idempotent(view):
+    """Make a POST view safe to retry: see the section comment above.
+    Requests without a key run as before."""
+    from functools import wraps
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key') or request.form.get(IDEMPOTENCY_FIELD)
+        if request.method != 'POST' or not key:
+            return view(*args, **kwargs)
+        key = key.strip()[:200]
+        scope = f'{current_user.get_id() if current_user.is_authenticated else "-"}:{request.endpoint}'
+        request_hash = _idempotency_request_hash()
+        db = get_db()
+        row = _claim_idempotency_key(db, scope, key, request_hash)
+        deadline = time.monotonic() + app.config['IDEMPOTENCY_WAIT_SECONDS']
+        while row is not None and row['status_code'] is None and time.monotonic() < deadline:
+            time.sleep(0.05)
+            row = db.execute('SELECT * FROM idempotency_keys WHERE scope = ? AND idem_key = ?', (scope, key)).fetchone()
+            if row is None:
+                row = _claim_idempotency_key(db, scope, key, request_hash)
+        if row is not None:
+            if row['request_hash'] != request_hash:
+                return _idempotency_conflict(422, 'This form was already submitted with different details. Please submit it again.')
+            if row['status_code'] is None:
+                return _idempotency_conflict(409, 'This request is still being processed.', retry_after=1)
+            return _replay_idempotent(row)
+
+        flashes_before = len(session.get('_flashes', []))
+        try:
+            resp = app.make_response(view(*args, **kwargs))
+        except Exception:
+            _release_idempotency_key(db, scope, key)
+            raise
+        if resp.status_code >= 500 or resp.is_streamed:
+            _release_idempotency_key(db, scope, key)
+            return resp
+        flashes = session.get('_flashes', [])[flashes_before:]
+        try:
+            db.execute('UPDATE idempotency_keys SET status_code = ?, location = ?, content_type = ?, body = ?, flashes = ? '
+                       'WHERE scope = ? AND idem_key = ?',
+                       (resp.status_code, resp.headers.get('Location'), resp.content_type,
+                        resp.get_data(as_text=True), json.dumps([list(f) for f in flashes]), scope, key))
+            db.commit()
+        except Exception as e:
+            # the work is done; a retry will get 409 until the key expires
+            _rollback_quietly(db)
+            app.logger.warning('Could not store idempotent response: %s', e)
+        _maybe_sweep_idempotency_keys(db)
+        return resp
+    return wrapper
+
+
+def purge_idempotency_keys(db, batch_size=500, max_batches=None):
+    """Delete expired keys `batch_size` rows at a time, committing after each
+    batch. Returns the number of rows deleted."""
+    now = _utc_timestamp()
+    total = batches = 0
+    while max_batches is None or batches < max_batches:
+        cur = db.execute('DELETE FROM idempotency_keys WHERE id IN '
+                         '(SELECT id FROM idempotency_keys WHERE expires_at <= ? LIMIT ?)', (now, batch_size))
+        db.commit()
+        deleted = cur.rowcount or 0
+        total += deleted
+        batches += 1
+        if deleted < batch_size:
+            break
+    return total
+
+
+def _maybe_sweep_idempotency_keys(db):
+    """Purge one batch of expired keys at most every IDEMPOTENCY_SWEEP_SECONDS."""
+    global _last_idempotency_sweep
+    now = time.monotonic()
+    if now - _last_idempotency_sweep < app.config['IDEMPOTENCY_SWEEP_SECONDS']:
+        return
+    _last_idempotency_sweep = now
+    try:
+        purge_idempotency_keys(db, max_batches=1)
+    except Exception as e:
+        _rollback_quietly(db)
+        app.logger.warning('Idempotency key sweep failed: %s', e)
+
+
+@app.cli.command('purge-idempotency-keys')
+@click.option('--batch-size', default=500, show_default=True, help='Rows deleted per transaction.')
+def purge_idempotency_keys_command(batch_size):
+    """Delete expired idempotency keys."""
+    deleted = purge_idempotency_keys(get_db(), batch_size=batch_size)
+    print(f"Deleted {deleted} expired idempotency keys.")
+
 
 # --- Routes ---
 @app.route('/')
@@ -553,12 +2707,9 @@ def index():
         pass
     
     # Admin dashboard: show quick stats
-    db = get_db()
-    total_products = db.execute('SELECT COUNT(*) AS c FROM products').fetchone()['c']
-    total_orders = db.execute('SELECT COUNT(*) AS c FROM orders').fetchone()['c']
-    total_customers = db.execute('SELECT COUNT(*) AS c FROM customers').fetchone()['c']
-    return render_template('index.html', total_products=total_products,
-                           total_orders=total_orders, total_customers=total_customers)
+    stats = get_dashboard_data(('total_products', 'total_orders', 'total_customers'))
+    return render_template('index.html', total_products=stats['total_products'],
+                           total_orders=stats['total_orders'], total_customers=stats['total_customers'])
 
 # Auth: login/register/logout
 @app.route('/login', methods=['GET','POST'])
@@ -566,18 +2717,23 @@ def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
+        retry_after = check_rate_limit('login', account=username)
+        if retry_after:
+            return rate_limited_response('auth/login.html', retry_after)
         db = get_db()
-        # allow login using username OR email for users, otherwise check customers by email
-        row = db.execute("SELECT * FROM users WHERE username = ? OR email = ?", (username, username)).fetchone()
-        if not row:
-            row = db.execute("SELECT * FROM customers WHERE email = ?", (username,)).fetchone()
-        if row and check_password_hash(row['password'], password):
-            # sqlite3.Row doesn't implement dict.get, so access columns safely
-            cols = row.keys()
-            username_val = row['username'] if 'username' in cols and row['username'] else (row['name'] if 'name' in cols and row['name'] else '')
-            email_val = row['email'] if 'email' in cols and row['email'] else ''
-            role_val = row['role'] if 'role' in cols and row['role'] else 'customer'
-            user = User(row['id'], username_val, email_val, role_val)
+        # login using username OR email for users, otherwise customers by email
+        row = db.execute(LOGIN_LOOKUP_SQL, (username, username, username)).fetchone()
+        try:
+            ok = credentials.verify(row['password'] if row else None, password)
+            if ok and credentials.needs_rehash(row['password']):
+                table = 'users' if row['source'] == 'users' else 'customers'
+                db.execute(f"UPDATE {table} SET password = ? WHERE id = ?", (credentials.hash(password), row['id']))
+                db.commit()
+        except CredentialsBusy:
+            flash('Too many sign-in attempts right now, please try again in a moment.', 'warning')
+            return render_template('auth/login.html'), 503, {'Retry-After': '2'}
+        if ok:
+            user = User(row['id'], row['username'] or '', row['email'] or '', row['role'] or 'customer')
             login_user(user)
             flash('Logged in successfully', 'success')
             return redirect(url_for('index'))
@@ -591,12 +2747,19 @@ def register():
         email = request.form['email']
         phone = request.form.get('phone', '')
         address = request.form.get('address', '')
-        password = generate_password_hash(request.form['password'])
+        retry_after = check_rate_limit('register')
+        if retry_after:
+            return rate_limited_response('auth/register.html', retry_after)
         db = get_db()
         existing = db.execute("SELECT * FROM customers WHERE email = ?", (email,)).fetchone()
         if existing:
             flash('Email already registered', 'danger')
             return redirect(url_for('register'))
+        try:
+            password = credentials.hash(request.form['password'])
+        except CredentialsBusy:
+            flash('The server is busy, please try again in a moment.', 'warning')
+            return render_template('auth/register.html'), 503, {'Retry-After': '2'}
         # insert with address column (migration ensures column exists)
         db.execute("INSERT INTO customers (name, email, phone, password, address) VALUES (?, ?, ?, ?, ?)",
                    (name, email, phone, password, address))
@@ -614,6 +2777,73 @@ def logout():
 
 
 # --- Forgot Password & Reset ---
+# Only the sha256 of a reset token is stored (under the column's UNIQUE
+# index), so a leaked table can't be used to reset passwords. expires_at is
+# written in _utc_timestamp() format, which compares correctly as text on
+# SQLite and as a timestamp on Postgres, and is indexed for the purge.
+RESET_TOKEN_TTL = timedelta(hours=1)
+app.config['RESET_TOKEN_SWEEP_SECONDS'] = int(os.environ.get('RESET_TOKEN_SWEEP_SECONDS', '3600') or 3600)
+_last_token_sweep = 0.0
+
+
+def _token_digest(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def issue_reset_token(db, account, user_id):
+    """Create a reset token for users/customers row `user_id` and return the
+    plain token for the email link. The caller commits."""
+    token = secrets.token_urlsafe(32)
+    db.execute('INSERT INTO password_reset_tokens (user_id, account, token, expires_at) VALUES (?, ?, ?, ?)',
+               (user_id, account, _token_digest(token), _utc_timestamp(datetime.utcnow() + RESET_TOKEN_TTL)))
+    return token
+
+
+def find_reset_token(db, token):
+    return db.execute('SELECT * FROM password_reset_tokens WHERE token = ? AND used = 0 AND expires_at > ?',
+                      (_token_digest(token), _utc_timestamp())).fetchone()
+
+
+def purge_reset_tokens(db, batch_size=500, max_batches=None):
+    """Delete expired tokens `batch_size` rows at a time, committing after
+    each batch so the sweep never holds a long write lock. Returns the
+    number of rows deleted."""
+    now = _utc_timestamp()
+    total = batches = 0
+    while max_batches is None or batches < max_batches:
+        cur = db.execute('DELETE FROM password_reset_tokens WHERE id IN '
+                         '(SELECT id FROM password_reset_tokens WHERE expires_at <= ? LIMIT ?)', (now, batch_size))
+        db.commit()
+        deleted = cur.rowcount or 0
+        total += deleted
+        batches += 1
+        if deleted < batch_size:
+            break
+    return total
+
+
+def _maybe_sweep_reset_tokens(db):
+    """Purge one batch of expired tokens at most every RESET_TOKEN_SWEEP_SECONDS."""
+    global _last_token_sweep
+    now = time.monotonic()
+    if now - _last_token_sweep < app.config['RESET_TOKEN_SWEEP_SECONDS']:
+        return
+    _last_token_sweep = now
+    try:
+        purge_reset_tokens(db, max_batches=1)
+    except Exception as e:
+        _rollback_quietly(db)
+        app.logger.warning('Reset token sweep failed: %s', e)
+
+
+@app.cli.command('purge-tokens')
+@click.option('--batch-size', default=500, show_default=True, help='Rows deleted per transaction.')
+def purge_tokens_command(batch_size):
+    """Delete expired password reset tokens."""
+    deleted = purge_reset_tokens(get_db(), batch_size=batch_size)
+    print(f"Deleted {deleted} expired reset tokens.")
+
+
 @app.route('/forgot_password', methods=['GET', 'POST'])
 def forgot_password():
     """Generate and send password reset token via email"""
@@ -622,30 +2852,26 @@ def forgot_password():
         if not email:
             flash('Please enter your email address', 'warning')
             return redirect(url_for('forgot_password'))
+        retry_after = check_rate_limit('forgot_password', account=email)
+        if retry_after:
+            return rate_limited_response('auth/forgot_password.html', retry_after)
         
         db = get_db()
         # Check if user exists (check both users and customers tables)
-        user = db.execute("SELECT * FROM users WHERE email = ?", (email,)).fetchone()
-        if not user:
-            user = db.execute("SELECT * FROM customers WHERE email = ?", (email,)).fetchone()
+        user = db.execute(RESET_LOOKUP_SQL, (email, email)).fetchone()
         
         # Always show success message (security best practice - don't reveal if email exists)
         flash('If that email exists, a password reset link has been sent.', 'info')
         
         if user:
-            # Generate secure random token
-            token = secrets.token_urlsafe(32)
-            user_id = user['id']
-            expires_at = (datetime.utcnow() + timedelta(hours=1)).isoformat()
-            
-            # Store token in database
+            # Generate and store a secure random token
             try:
-                db.execute('''INSERT INTO password_reset_tokens (user_id, token, expires_at) 
-                             VALUES (?, ?, ?)''', (user_id, token, expires_at))
+                token = issue_reset_token(db, user['source'], user['id'])
                 db.commit()
             except Exception as e:
                 app.logger.error('Failed to store reset token: %s', e)
                 return redirect(url_for('login'))
+            _maybe_sweep_reset_tokens(db)
             
             # Send reset email
             reset_url = f"{request.host_url.rstrip('/')}/reset_password/{token}"
@@ -681,10 +2907,7 @@ def reset_password(token):
     db = get_db()
     
     # Validate token
-    token_row = db.execute('''
-        SELECT * FROM password_reset_tokens 
-        WHERE token = ? AND used = 0 AND datetime(expires_at) > datetime('now')
-    ''', (token,)).fetchone()
+    token_row = find_reset_token(db, token)
     
     if not token_row:
         flash('Invalid or expired reset link. Please request a new one.', 'danger')
@@ -703,24 +2926,35 @@ def reset_password(token):
             return redirect(url_for('reset_password', token=token))
         
         user_id = token_row['user_id']
-        hashed_password = generate_password_hash(new_password)
+        try:
+            hashed_password = credentials.hash(new_password)
+        except CredentialsBusy:
+            flash('The server is busy, please try again in a moment.', 'warning')
+            return redirect(url_for('reset_password', token=token))
         
-        # Update password in users table first
+        account = token_row['account']
         try:
-            result = db.execute("UPDATE users SET password = ? WHERE id = ?", 
+            if account in ('users', 'customers'):
+                db.execute(f"UPDATE {account} SET password = ? WHERE id = ?", (hashed_password, user_id))
+            else:
+                # token issued before the account column: users table first
+                result = db.execute("UPDATE users SET password = ? WHERE id = ?", 
+                                  (hashed_password, user_id))
+                if result.rowcount == 0:
+                    # Not in users table, try customers table
+                    db.execute("UPDATE customers SET password = ? WHERE id = ?", 
                               (hashed_password, user_id))
-            if result.rowcount == 0:
-                # Not in users table, try customers table
-                db.execute("UPDATE customers SET password = ? WHERE id = ?", 
-                          (hashed_password, user_id))
         except Exception as e:
             app.logger.error('Failed to update password: %s', e)
             flash('Failed to reset password. Please try again.', 'danger')
             return redirect(url_for('forgot_password'))
         
-        # Mark token as used
-        db.execute("UPDATE password_reset_tokens SET used = 1 WHERE id = ?", 
-                  (token_row['id'],))
+        # Spent tokens are deleted rather than kept as used; this also
+        # invalidates any other outstanding links for the account
+        if account:
+            db.execute("DELETE FROM password_reset_tokens WHERE user_id = ? AND account = ?", (user_id, account))
+        else:
+            db.execute("DELETE FROM password_reset_tokens WHERE id = ?", (token_row['id'],))
         db.commit()
         
         flash('Password reset successful! You can now log in with your new password.', 'success')
@@ -729,12 +2963,72 @@ def reset_password(token):
     return render_template('auth/reset_password.html', token=token)
 
 
+# --- Catalogue cache ---
+# The public catalogue only changes when an admin edits products, so anonymous
+# visitors get one rendered copy per catalogue version with a strong ETag and
+# Last-Modified; browsers and nginx revalidate with If-None-Match and get 304s.
+# Stock levels aren't shown on the page, so qty/reorder updates don't bump it.
+app.config['CATALOGUE_CACHE'] = os.environ.get('CATALOGUE_CACHE', '1').lower() in ('1', 'true', 'yes')
+app.config['CATALOGUE_MAX_AGE'] = int(os.environ.get('CATALOGUE_MAX_AGE', '30') or 30)
+
+_catalogue_pages = {}  # database_key() -> (version, body, etag)
+_catalogue_lock = threading.Lock()
+
+
+def catalogue_version(db):
+    """Return (version, updated_at) for the product catalogue."""
+    row = db.execute('SELECT version, updated_at FROM catalogue_version WHERE id = 1').fetchone()
+    if not row:
+        return 0, None
+    updated = row['updated_at']
+    if isinstance(updated, str):
+        try:
+            updated = datetime.strptime(updated[:19], '%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            updated = None
+    return int(row['version']), updated
+
+
+def bump_catalogue_version(db):
+    """Invalidate cached catalogue pages everywhere; the caller commits."""
+    db.execute('UPDATE catalogue_version SET version = version + 1, updated_at = ? WHERE id = 1', (_utc_timestamp(),))
+
+
+def _catalogue_page(db, version):
+    key = database_key()
+    cached = _catalogue_pages.get(key)
+    if cached and cached[0] == version:
+        return cached
+    prods = db.execute("SELECT * FROM products").fetchall()
+    body = render_template('products.html', products=prods)
+    page = (version, body, hashlib.sha1(body.encode('utf-8')).hexdigest())
+    with _catalogue_lock:
+        current = _catalogue_pages.get(key)
+        if not current or current[0] <= version:
+            _catalogue_pages[key] = page
+    return page
+
+
 # Products - list for customers
 @app.route('/products')
+@db_intent('read')
 def products():
     db = get_db()
-    prods = db.execute("SELECT * FROM products").fetchall()
-    return render_template('products.html', products=prods)
+    # signed-in users see their own nav and flashed messages: never share those
+    if not app.config['CATALOGUE_CACHE'] or current_user.is_authenticated or session.get('_flashes'):
+        prods = db.execute("SELECT * FROM products").fetchall()
+        resp = Response(render_template('products.html', products=prods))
+        resp.headers['Cache-Control'] = 'private, no-cache'
+        return resp
+    version, updated_at = catalogue_version(db)
+    _, body, etag = _catalogue_page(db, version)
+    resp = Response(body)
+    resp.set_etag(etag)
+    if updated_at:
+        resp.last_modified = updated_at
+    resp.headers['Cache-Control'] = f"public, max-age={app.config['CATALOGUE_MAX_AGE']}"
+    resp.vary.add('Cookie')
+    return resp.make_conditional(request)
 
 # Admin manage products
 @app.route('/admin/products', methods=['GET','POST'])
@@ -751,6 +3045,7 @@ def admin_products():
         reorder = int(request.form.get('reorder_level', 0) or 0)
         db.execute("INSERT INTO products (name, description, size, price, qty, reorder_level) VALUES (?, ?, ?, ?, ?, ?)",
                    (name, desc, size, price, qty, reorder))
+        bump_catalogue_version(db)
         db.commit()
         flash('Product added', 'success')
         return redirect(url_for('admin_products'))
@@ -772,49 +3067,14 @@ def admin_dashboard():
     low_materials = []
     
     try:
-        db = get_db()
-        app.logger.info('Admin dashboard: DB connection type = %s', type(db).__name__)
-        
-        # Test each query independently with detailed error capture
-        try:
-            row = db.execute("SELECT COUNT(*) as c FROM products").fetchone()
-            total_products = row['c'] if row else 0
-        except Exception as e:
-            errors.append(f"Products count: {e}")
-            app.logger.error('Products count failed: %s', e)
-        
-        try:
-            row = db.execute("SELECT COUNT(*) as c FROM customers").fetchone()
-            total_customers = row['c'] if row else 0
-        except Exception as e:
-            errors.append(f"Customers count: {e}")
-            app.logger.error('Customers count failed: %s', e)
-        
-        try:
-            row = db.execute("SELECT COUNT(*) as c FROM sales").fetchone()
-            total_sales = row['c'] if row else 0
-        except Exception as e:
-            errors.append(f"Sales count: {e}")
-            app.logger.error('Sales count failed: %s', e)
-        
-        try:
-            row = db.execute("SELECT COUNT(*) as c FROM payments WHERE status = ?", ('Pending',)).fetchone()
-            pending_payments = row['c'] if row else 0
-        except Exception as e:
-            errors.append(f"Pending payments: {e}")
-            app.logger.error('Pending payments failed: %s', e)
-        
-        try:
-            low_products = db.execute("SELECT id, name, qty, reorder_level FROM products WHERE qty <= reorder_level ORDER BY qty ASC").fetchall()
-        except Exception as e:
-            errors.append(f"Low products query: {e}")
-            app.logger.error('Low products failed: %s', e)
-        
-        try:
-            low_materials = db.execute("SELECT id, name, qty, reorder_level FROM raw_materials WHERE qty <= reorder_level ORDER BY qty ASC").fetchall()
-        except Exception as e:
-            errors.append(f"Low materials query: {e}")
-            app.logger.error('Low materials failed: %s', e)
+        stats = get_dashboard_data(ADMIN_DASHBOARD_COUNTERS, low_stock=True)
+        total_products = stats['total_products']
+        total_customers = stats['total_customers']
+        total_sales = stats['total_sales']
+        pending_payments = stats['pending_payments']
+        low_products = stats['low_products']
+        low_materials = stats['low_materials']
+        errors.extend(f"{section}: {msg}" for section, msg in stats['errors'].items())
         
         # If we got here without major crash, try rendering template
         try:
@@ -884,6 +3144,28 @@ def admin_dashboard():
     """
     return html
 
+@app.route('/admin/dashboard.json')
+@login_required
+@admin_required
+def admin_dashboard_data():
+    """JSON variant of the admin dashboard for auto-refreshing widgets."""
+    stats = get_dashboard_data(ADMIN_DASHBOARD_COUNTERS, low_stock=True)
+    stats['ok'] = not stats['errors']
+    stats['generated_at'] = datetime.utcnow().isoformat()
+    return jsonify(stats)
+
+
+@app.route('/admin/metrics/admission')
+@admission_class('critical')
+@login_required
+@admin_required
+def admin_admission_metrics():
+    """Per-class admission gauges (in_flight, queue_depth: all workers) and
+    this worker's counters (admitted, rejected, waits, run times)."""
+    return jsonify({'ok': True, 'pid': os.getpid(), 'enabled': app.config['ADMISSION_CONTROL'],
+                    'classes': {name: c.stats() for name, c in ADMISSION_CLASSES.items()}})
+
+
 @app.route('/admin/debug/db')
 @login_required
 @admin_required
@@ -913,27 +3195,42 @@ def admin_debug_db():
 
 # --- CSV export/import for products
 @app.route('/admin/products/export')
+@admission_class('heavy')
 @login_required
 @admin_required
 def admin_products_export():
-    db = get_db()
-    rows = db.execute('SELECT id, name, size, price, qty, reorder_level, description FROM products').fetchall()
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(['id','name','size','price','qty','reorder_level','description'])
-    for r in rows:
-        cols = r.keys()
-        price = r['price'] if 'price' in cols and r['price'] is not None else 0
-        qty = r['qty'] if 'qty' in cols and r['qty'] is not None else 0
-        reorder = r['reorder_level'] if 'reorder_level' in cols and r['reorder_level'] is not None else 0
-        desc = r['description'] if 'description' in cols and r['description'] is not None else ''
-        writer.writerow([r['id'], r['name'], r['size'], price, qty, reorder, desc])
-    resp = app.response_class(output.getvalue(), mimetype='text/csv')
+    # streamed in batches so a big catalogue never sits in memory as one string;
+    # the generator outlives the request, so it uses its own connection
+    def generate():
+        db = connect_db()
+        try:
+            cur = db.execute('SELECT id, name, size, price, qty, reorder_level, description FROM products')
+            output = io.StringIO()
+            writer = csv.writer(output)
+            writer.writerow(['id','name','size','price','qty','reorder_level','description'])
+            while True:
+                rows = cur.fetchmany(500)
+                for r in rows:
+                    price = r['price'] if r['price'] is not None else 0
+                    qty = r['qty'] if r['qty'] is not None else 0
+                    reorder = r['reorder_level'] if r['reorder_level'] is not None else 0
+                    desc = r['description'] if r['description'] is not None else ''
+                    writer.writerow([r['id'], r['name'], r['size'], price, qty, reorder, desc])
+                yield output.getvalue()
+                output.seek(0)
+                output.truncate()
+                if not rows:
+                    break
+        finally:
+            db.close()
+
+    resp = app.response_class(generate(), mimetype='text/csv')
     resp.headers.set('Content-Disposition', 'attachment', filename='products.csv')
     return resp
 
 
 @app.route('/admin/products/import', methods=['GET','POST'])
+@admission_class('heavy', methods=('POST',))
 @login_required
 @admin_required
 def admin_products_import():
@@ -946,6 +3243,7 @@ def admin_products_import():
         stream = io.StringIO(f.stream.read().decode('utf-8'))
         reader = csv.DictReader(stream)
         changed = 0
+        catalogue_changed = False
         for row in reader:
             # prefer id matching, else try name
             pid = row.get('id')
@@ -981,6 +3279,14 @@ def admin_products_import():
                     set_clause = ', '.join([f"{k} = ?" for k in updates.keys()])
                     params = list(updates.values()) + [existing['id']]
                     db.execute(f'UPDATE products SET {set_clause} WHERE id = ?', params)
+                    catalogue_changed = catalogue_changed or bool(set(updates) - {'qty', 'reorder_level'})
+                    if 'qty' in updates or 'reorder_level' in updates:
+                        ek = existing.keys()
+                        old_qty = int(existing['qty'] or 0) if 'qty' in ek else 0
+                        old_reorder = int(existing['reorder_level'] or 0) if 'reorder_level' in ek else 0
+                        emit_stock_change(db, StockChange('product', existing['id'], updates.get('name', existing['name']),
+                                                          old_qty, updates.get('qty', old_qty),
+                                                          old_reorder, updates.get('reorder_level', old_reorder), 'import'))
                     user = getattr(current_user, 'username', None) or getattr(current_user, 'email', None) or 'unknown'
                     for k, v in updates.items():
                         # existing is sqlite3.Row — use keys() to access safely
@@ -992,6 +3298,8 @@ def admin_products_import():
                         except Exception:
                             pass
                     changed += 1
+        if catalogue_changed:
+            bump_catalogue_version(db)
         db.commit()
         flash(f'Import completed, {changed} rows updated', 'success')
         return redirect(url_for('admin_products'))
@@ -1011,8 +3319,12 @@ def admin_routes():
 
 
 @app.route('/admin/audit')
+@admission_class('heavy')
 @login_required
 @admin_required
+@db_intent('read')
+@report_snapshot
+@query_budget()
 def admin_audit():
     db = get_db()
     # filters: product_id, user, field, date range
@@ -1115,8 +3427,12 @@ def admin_audit():
 
 
 @app.route('/admin/reconciliation', methods=['GET','POST'])
+@admission_class('heavy')
 @login_required
 @admin_required
+@db_intent('read')
+@report_snapshot
+@query_budget()
 def admin_reconciliation():
     db = get_db()
     # default: today
@@ -1128,31 +3444,41 @@ def admin_reconciliation():
     if not end:
         end = start
 
-    # gather per-product totals
+    # Opening/closing come from the stock journal (nearest snapshot + bounded
+    # movement sum per product); the period's movements are summed per product
+    # and type in one grouped query, so cost is O(products), not O(history).
+    # Stock changes from before the journal existed are only in sales,
+    # breakages and product_audit; those are added on top (see
+    # _unjournaled_stock_flows).
+    try:
+        period_start = f"{datetime.fromisoformat(start).date().isoformat()} 00:00:00"
+        period_end = f"{(datetime.fromisoformat(end).date() + timedelta(days=1)).isoformat()} 00:00:00"
+    except ValueError:
+        flash('Invalid date range', 'warning')
+        return redirect(url_for('admin_reconciliation'))
+    totals = {}
+    for r in db.execute('SELECT product_id, movement_type, SUM(qty_delta) AS s FROM stock_movements '
+                        'WHERE created_at >= ? AND created_at < ? GROUP BY product_id, movement_type',
+                        (period_start, period_end)).fetchall():
+        totals.setdefault(r['product_id'], {})[r['movement_type']] = int(r['s'] or 0)
+    legacy = _unjournaled_stock_flows(db, period_start[:10], period_end[:10])
     prods = db.execute('SELECT id, name, qty FROM products').fetchall()
     result = []
     for p in prods:
         pid = p['id']
         current_qty = int(p['qty'] or 0)
-        sold_row = db.execute("SELECT SUM(qty) as s FROM sales WHERE date(sale_date) BETWEEN date(?) AND date(?) AND product_id = ?", (start, end, pid)).fetchone()
-        sold = int(sold_row['s'] or 0)
-        broken_row = db.execute("SELECT SUM(qty) as b FROM breakages WHERE date(date) BETWEEN date(?) AND date(?) AND product_id = ?", (start, end, pid)).fetchone()
-        broken = int(broken_row['b'] or 0)
-        # adjustments from audit for field 'qty' during period: sum(new-old)
-        adj_rows = db.execute("SELECT old_value, new_value FROM product_audit WHERE field = 'qty' AND date(timestamp) BETWEEN date(?) AND date(?) AND product_id = ?", (start, end, pid)).fetchall()
-        adjustments = 0
-        for ar in adj_rows:
-            try:
-                oldv = int(float(ar['old_value']))
-            except Exception:
-                oldv = 0
-            try:
-                newv = int(float(ar['new_value']))
-            except Exception:
-                newv = 0
-            adjustments += (newv - oldv)
-        # opening = current + sold + broken - adjustments
-        opening = current_qty + sold + broken - adjustments
+        moved = totals.get(pid, {})
+        in_period, since_start = legacy.get(pid, ((0, 0, 0), (0, 0, 0)))
+        sold = -(moved.get('sale', 0) + moved.get('order', 0) + moved.get('loadout', 0)) + in_period[0]
+        broken = -moved.get('breakage', 0) + in_period[1]
+        adjustments = (moved.get('adjustment', 0) + moved.get('import', 0) + moved.get('production', 0)
+                       + moved.get('receipt', 0)) + in_period[2]
+        opening = stock_qty_at(db, pid, period_start)
+        if opening is None:
+            # no journaled change ever: stock has been flat at its current value
+            opening = current_qty
+        # unwind the pre-journal changes made since the period started
+        opening += since_start[0] + since_start[1] - since_start[2]
         closing = opening - sold - broken + adjustments
         result.append({'id': pid, 'name': p['name'], 'opening': opening, 'sold': sold, 'broken': broken, 'adjustments': adjustments, 'closing': closing, 'current': current_qty})
 
@@ -1164,6 +3490,7 @@ def admin_reconciliation():
 def admin_product_delete(pid):
     db = get_db()
     db.execute("DELETE FROM products WHERE id = ?", (pid,))
+    bump_catalogue_version(db)
     db.commit()
     flash('Product deleted', 'info')
     return redirect(url_for('admin_products'))
@@ -1179,19 +3506,15 @@ def admin_product_adjust(pid):
     except Exception:
         delta = 0
     reason = request.form.get('reason','')
-    # fetch old qty
-    row = db.execute('SELECT * FROM products WHERE id = ?', (pid,)).fetchone()
-    if not row:
+    change = change_product_stock(db, pid, delta, source='adjustment')
+    if not change:
         flash('Product not found', 'warning')
         return redirect(url_for('admin_products'))
-    old_qty = int(row['qty'] or 0)
-    new_qty = old_qty + delta
-    db.execute('UPDATE products SET qty = ? WHERE id = ?', (new_qty, pid))
     # audit
     try:
         user = getattr(current_user, 'username', None) or getattr(current_user, 'email', None) or 'unknown'
         db.execute('INSERT INTO product_audit (product_id, user, action, field, old_value, new_value, reason) VALUES (?, ?, ?, ?, ?, ?, ?)',
-                   (pid, user, 'adjust', 'qty', str(old_qty), str(new_qty), reason))
+                   (pid, user, 'adjust', 'qty', str(change.old_qty), str(change.new_qty), reason))
     except Exception:
         pass
     db.commit()
@@ -1238,6 +3561,9 @@ def admin_product_edit(pid):
                 pass
 
         if old:
+            if int(old_vals.get('qty') or 0) != int(qty) or int(old_vals.get('reorder_level') or 0) != int(reorder):
+                emit_stock_change(db, StockChange('product', pid, name, int(old_vals.get('qty') or 0), int(qty),
+                                                  int(old_vals.get('reorder_level') or 0), int(reorder), 'edit'))
             if str(old_vals.get('price')) != str(price):
                 _log('price', old_vals.get('price'), price, request.form.get('reason',''))
             if int(old_vals.get('qty') or 0) != int(qty):
@@ -1249,6 +3575,7 @@ def admin_product_edit(pid):
             if (old_vals.get('description') or '') != (desc or ''):
                 _log('description', old_vals.get('description'), desc, request.form.get('reason',''))
 
+        bump_catalogue_version(db)
         db.commit()
         flash('Product updated', 'success')
         return redirect(url_for('admin_products'))
@@ -1260,7 +3587,9 @@ def admin_product_edit(pid):
 
 # Orders: customer places order (simple single-product order for demo)
 @app.route('/orders/add', methods=['GET','POST'])
+@admission_class('critical')
 @login_required
+@idempotent
 def add_order():
     db = get_db()
     products = db.execute("SELECT * FROM products").fetchall()
@@ -1269,44 +3598,17 @@ def add_order():
         customer_id = int(request.form['customer_id'])
         product_id = int(request.form['product_id'])
         qty = int(request.form['qty'])
-        product = db.execute("SELECT * FROM products WHERE id = ?", (product_id,)).fetchone()
-        unit_price = product['price']
-        # check inventory qty if available
-        available = product['qty'] if 'qty' in product.keys() else None
-        if available is not None and qty > available:
-            flash(f'Requested quantity ({qty}) exceeds available stock ({available}).', 'danger')
-            return redirect(url_for('add_order'))
-        total = unit_price * qty
-
-        db.execute("INSERT INTO orders (customer_id, total, status) VALUES (?, ?, ?)",
-                   (customer_id, total, 'Pending'))
-        db.commit()
-        order_id = db.execute("SELECT last_insert_rowid() AS id").fetchone()['id']
-        db.execute("INSERT INTO order_items (order_id, product_id, qty, unit_price) VALUES (?, ?, ?, ?)",
-                   (order_id, product_id, qty, unit_price))
-        # create payment entry pending
         account_number = request.form.get('account_number', '')
-        db.execute("INSERT INTO payments (order_id, amount, status, account_number) VALUES (?, ?, ?, ?)",
-                   (order_id, total, 'Pending', account_number))
-        # decrement product qty if tracked
-        try:
-            if 'qty' in product.keys():
-                db.execute("UPDATE products SET qty = qty - ? WHERE id = ?", (qty, product_id))
-        except Exception:
-            pass
-        db.commit()
-        # Prepare details for notifications
-        try:
-            cust_row = db.execute("SELECT name, email FROM customers WHERE id = ?", (customer_id,)).fetchone()
-            customer_name = (cust_row['name'] if cust_row and 'name' in cust_row.keys() else '') or ''
-        except Exception:
-            customer_name = ''
+        # the stock check happens in the same transaction as the decrement
         try:
-            product_name = product['name'] if 'name' in product.keys() else ''
-        except Exception:
-            product_name = ''
+            order = run_write('place_order', customer_id=customer_id, product_id=product_id, qty=qty,
+                              account_number=account_number, user=_current_username())
+        except ValueError as e:
+            flash(str(e), 'danger')
+            return redirect(url_for('add_order'))
         try:
-            notify_admins_on_order(order_id, customer_name, product_name, qty, float(total), account_number)
+            notify_admins_on_order(order['order_id'], order['customer_name'], order['product_name'], qty,
+                                   float(order['total']), account_number)
         except Exception:
             pass
         flash('Order created (Payment Pending).', 'success')
@@ -1341,7 +3643,11 @@ def admin_raw_materials_edit(mid):
         name = request.form['name']
         qty = float(request.form.get('qty', 0))
         reorder = float(request.form.get('reorder_level', 0))
+        old = db.execute('SELECT qty, reorder_level FROM raw_materials WHERE id = ?', (mid,)).fetchone()
         db.execute('UPDATE raw_materials SET name = ?, qty = ?, reorder_level = ? WHERE id = ?', (name, qty, reorder, mid))
+        if old:
+            emit_stock_change(db, StockChange('material', mid, name, float(old['qty'] or 0), qty,
+                                              float(old['reorder_level'] or 0), reorder, 'edit'))
         db.commit()
         flash('Raw material updated', 'success')
         return redirect(url_for('admin_raw_materials'))
@@ -1360,10 +3666,750 @@ def admin_raw_materials_delete(mid):
     return redirect(url_for('admin_raw_materials'))
 
 
+# --- Admin: production batches ---
+@app.route('/admin/production', methods=['GET','POST'])
+@login_required
+@admin_required
+def admin_production():
+    db = get_db()
+    if request.method == 'POST':
+        try:
+            record_production_batch(db, int(request.form['product_id']), int(request.form['qty']),
+                                    shift=request.form.get('shift', '').strip(),
+                                    produced_on=request.form.get('produced_on') or None,
+                                    note=request.form.get('note', ''))
+            db.commit()
+            flash('Production batch recorded', 'success')
+        except (ProductionError, ValueError) as e:
+            _rollback_quietly(db)
+            flash(f'Batch not recorded: {e}', 'danger')
+        return redirect(url_for('admin_production'))
+    batches = db.execute('SELECT b.*, p.name AS product_name FROM production_batches b '
+                         'LEFT JOIN products p ON b.product_id = p.id ORDER BY b.id DESC LIMIT 100').fetchall()
+    recipes = db.execute('SELECT r.id, r.product_id, r.material_id, r.qty_per_100, p.name AS product_name, m.name AS material_name '
+                         'FROM bom_recipes r JOIN products p ON r.product_id = p.id JOIN raw_materials m ON r.material_id = m.id '
+                         'ORDER BY p.name, m.name').fetchall()
+    products = db.execute('SELECT id, name FROM products ORDER BY name').fetchall()
+    materials = db.execute('SELECT id, name FROM raw_materials ORDER BY name').fetchall()
+    try:
+        plan = plan_material_requirements(db)
+    except Exception as e:
+        app.logger.warning('Material requirements plan failed: %s', e)
+        plan = []
+    return render_template('admin/production.html', batches=batches, recipes=recipes, products=products,
+                           materials=materials, plan=plan)
+
+
+@app.route('/admin/production/recipes', methods=['POST'])
+@login_required
+@admin_required
+def admin_production_recipes():
+    """Set one bill-of-materials line; a quantity of 0 removes it."""
+    db = get_db()
+    product_id = int(request.form['product_id'])
+    material_id = int(request.form['material_id'])
+    qty_per_100 = float(request.form.get('qty_per_100', 0) or 0)
+    db.execute('DELETE FROM bom_recipes WHERE product_id = ? AND material_id = ?', (product_id, material_id))
+    if qty_per_100 > 0:
+        db.execute('INSERT INTO bom_recipes (product_id, material_id, qty_per_100) VALUES (?, ?, ?)',
+                   (product_id, material_id, qty_per_100))
+    db.commit()
+    flash('Recipe updated', 'success')
+    return redirect(url_for('admin_production'))
+
+
+@app.route('/api/v1/production/batches', methods=['POST'])
+@login_required
+@admin_required
+def api_production_batches():
+    """Record a whole day's shifts in one transaction.
+
+    Body: {"produced_on": "YYYY-MM-DD", "batches": [{"product_id": 1, "qty": 500,
+    "shift": "morning", "note": ""}, ...]}. Either every batch is recorded or,
+    on the first failure, none are.
+    """
+    payload = request.get_json(silent=True) or {}
+    batches = payload.get('batches')
+    if not isinstance(batches, list) or not batches:
+        return jsonify({'ok': False, 'error': 'batches must be a non-empty list'}), 400
+    db = get_db()
+    ids = []
+    for i, b in enumerate(batches):
+        try:
+            ids.append(record_production_batch(db, int(b['product_id']), int(b['qty']),
+                                               shift=str(b.get('shift') or ''),
+                                               produced_on=b.get('produced_on') or payload.get('produced_on'),
+                                               note=str(b.get('note') or '')))
+        except (ProductionError, KeyError, TypeError, ValueError) as e:
+            _rollback_quietly(db)
+            return jsonify({'ok': False, 'index': i, 'error': str(e)}), 400
+    db.commit()
+    return jsonify({'ok': True, 'batch_ids': ids}), 201
+
+
+@app.route('/admin/production/plan.json')
+@login_required
+@admin_required
+def admin_production_plan():
+    try:
+        days = max(1, int(request.args.get('days', 28)))
+    except ValueError:
+        days = 28
+    return jsonify({'days': days, 'materials': plan_material_requirements(get_db(), days)})
+
+
+# --- Scan event ingestion ---
+# Yard tablets post barcode/QR scans in batches as JSON lines, one event per
+# line: {"client_event_id": "tab3-000123", "type": "loadout", "product_id": 4,
+# "qty": 250, "scanned_at": "2024-05-01T09:12:00"}. Events are validated
+# column-wise in one pass, deduplicated on client_event_id (so a tablet can
+# resend a batch after a timeout), and applied SCAN_CHUNK_SIZE at a time:
+# each chunk is one transaction with a single stock UPDATE per product and
+# one journal movement per product and type. Production scans only add
+# finished stock; material consumption is still recorded with production
+# batches.
+SCAN_EVENT_TYPES = {'loadout': -1, 'breakage': -1, 'production': 1, 'receipt': 1}
+app.config['SCAN_CHUNK_SIZE'] = int(os.environ.get('SCAN_CHUNK_SIZE', '500') or 500)
+app.config['SCAN_MAX_EVENTS'] = int(os.environ.get('SCAN_MAX_EVENTS', '20000') or 20000)
+app.config['SCAN_MAX_CONCURRENT'] = int(os.environ.get('SCAN_MAX_CONCURRENT', '1') or 1)
+app.config['SCAN_RETRY_AFTER'] = int(os.environ.get('SCAN_RETRY_AFTER', '2') or 2)
+
+_scan_slots = threading.BoundedSemaphore(app.config['SCAN_MAX_CONCURRENT'])
+
+
+class ScanBackpressure(RuntimeError):
+    pass
+
+
+def parse_scan_events(body):
+    """Parse a JSON-lines (or JSON array) body into a list of (line, event)
+    pairs and a list of {line, error} rejections for unparsable lines."""
+    text = body.decode('utf-8') if isinstance(body, bytes) else body
+    if text.lstrip().startswith('['):
+        items = json.loads(text)
+        return [(i + 1, item) for i, item in enumerate(items)], []
+    events, rejected = [], []
+    for i, line in enumerate(text.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            events.append((i, json.loads(line)))
+        except ValueError as e:
+            rejected.append({'line': i, 'error': f'invalid JSON: {e}'})
+    return events, rejected
+
+
+def validate_scan_events(db, events):
+    """Check every event at once with numpy column operations. Returns
+    (valid, rejected): valid is a list of dicts with normalised fields."""
+    import numpy as np
+
+    n = len(events)
+    if not n:
+        return [], []
+
+    def column(key):
+        return [e.get(key) if isinstance(e, dict) else None for _, e in events]
+
+    def as_ints(values):
+        out = np.zeros(n, dtype=np.int64)
+        ok = np.zeros(n, dtype=bool)
+        for i, v in enumerate(values):
+            # bools are ints in Python; a scanner sending true is a bug
+            if isinstance(v, bool):
+                continue
+            if isinstance(v, int) or (isinstance(v, str) and v.strip().lstrip('-').isdigit()):
+                out[i], ok[i] = int(v), True
+        return out, ok
+
+    ids = np.array([str(v).strip() if v is not None else '' for v in column('client_event_id')], dtype=object)
+    types = np.array([str(v).strip().lower() if v is not None else '' for v in column('type')], dtype=object)
+    product_ids, pid_ok = as_ints(column('product_id'))
+    qtys, qty_ok = as_ints(column('qty'))
+    known = np.array([r['id'] for r in db.execute('SELECT id FROM products').fetchall()], dtype=np.int64)
+
+    lengths = np.fromiter((len(v) for v in ids), dtype=np.int64, count=n)
+    checks = [
+        (np.array([isinstance(e, dict) for _, e in events]), 'event must be an object'),
+        ((lengths > 0) & (lengths <= 64), 'client_event_id must be 1-64 characters'),
+        (np.isin(types, list(SCAN_EVENT_TYPES)), f"type must be one of {', '.join(SCAN_EVENT_TYPES)}"),
+        (pid_ok & np.isin(product_ids, known), 'unknown product_id'),
+        (qty_ok & (qtys > 0), 'qty must be a positive integer'),
+    ]
+    # a client_event_id repeated inside the batch: keep its first occurrence
+    _, first = np.unique(ids, return_index=True)
+    unique_in_batch = np.zeros(n, dtype=bool)
+    unique_in_batch[first] = True
+    checks.append((unique_in_batch, 'duplicate client_event_id in batch'))
+
+    ok = np.ones(n, dtype=bool)
+    reasons = np.full(n, None, dtype=object)
+    for passed, reason in checks:
+        failed = ok & ~passed
+        reasons[failed] = reason
+        ok &= passed
+    valid, rejected = [], []
+    for i in range(n):
+        line, event = events[i]
+        if ok[i]:
+            valid.append({'client_event_id': ids[i], 'type': types[i], 'product_id': int(product_ids[i]),
+                          'qty': int(qtys[i]), 'scanned_at': str(event.get('scanned_at') or '')[:32] or None})
+        else:
+            rejected.append({'line': line, 'client_event_id': ids[i] or None, 'error': reasons[i]})
+    return valid, rejected
+
+
+def apply_scan_chunk(db, chunk, device_id=None, user=None):
+    """Apply one chunk of validated events in the caller's transaction.
+    Events whose client_event_id is already recorded are skipped. Returns
+    (applied, duplicate_ids)."""
+    ids = [e['client_event_id'] for e in chunk]
+    seen = set()
+    for i in range(0, len(ids), 500):
+        part = ids[i:i + 500]
+        seen.update(r['client_event_id'] for r in db.execute(
+            f"SELECT client_event_id FROM scan_events WHERE client_event_id IN ({', '.join('?' * len(part))})", part))
+    fresh = [e for e in chunk if e['client_event_id'] not in seen]
+    if not fresh:
+        return 0, sorted(seen)
+    batch_id = insert_returning_id(db, 'INSERT INTO scan_batches (device_id, events, created_by) VALUES (?, ?, ?)',
+                                   (device_id, len(fresh), user))
+    db.executemany('INSERT INTO scan_events (client_event_id, batch_id, event_type, product_id, qty, scanned_at) '
+                   'VALUES (?, ?, ?, ?, ?, ?)',
+                   [(e['client_event_id'], batch_id, e['type'], e['product_id'], e['qty'], e['scanned_at']) for e in fresh])
+    deltas = {}
+    for e in fresh:
+        by_type = deltas.setdefault(e['product_id'], {})
+        by_type[e['type']] = by_type.get(e['type'], 0) + SCAN_EVENT_TYPES[e['type']] * e['qty']
+    for product_id, by_type in deltas.items():
+        total = sum(by_type.values())
+        db.execute('UPDATE products SET qty = qty + ? WHERE id = ?', (total, product_id))
+        row = db.execute('SELECT name, qty, reorder_level FROM products WHERE id = ?', (product_id,)).fetchone()
+        reorder = int(row['reorder_level'] or 0)
+        running = int(row['qty'] or 0) - total
+        # one journal movement per type, chained so qty_after stays exact
+        for event_type, delta in sorted(by_type.items()):
+            emit_stock_change(db, StockChange('product', product_id, row['name'], running, running + delta,
+                                              reorder, reorder, event_type, 'scan_batches', batch_id, user))
+            running += delta
+    return len(fresh), sorted(seen)
+
+
+def ingest_scan_events(db, events, device_id=None, user=None, chunk_size=None):
+    """Validate and apply parsed events chunk by chunk, committing each chunk.
+    Raises ScanBackpressure if the database stays locked."""
+    valid, rejected = validate_scan_events(db, events)
+    chunk_size = chunk_size or app.config['SCAN_CHUNK_SIZE']
+    applied, duplicates = 0, []
+    for i in range(0, len(valid), chunk_size):
+        chunk = valid[i:i + chunk_size]
+        for attempt in range(2):
+            try:
+                n, dup = apply_scan_chunk(db, chunk, device_id, user)
+                db.commit()
+                break
+            except Exception as e:
+                _rollback_quietly(db)
+                if 'locked' in str(e).lower() or 'busy' in str(e).lower():
+                    raise ScanBackpressure(str(e)) from e
+                if attempt or 'unique' not in str(e).lower():
+                    raise
+                # another request stored one of these ids since we looked: re-check
+        applied += n
+        duplicates.extend(dup)
+    return {'accepted': applied, 'duplicates': len(duplicates), 'duplicate_ids': duplicates[:100],
+            'rejected': rejected}
+
+
+@app.route('/api/v1/scan-events', methods=['POST'])
+@login_required
+@admin_required
+def api_scan_events():
+    """Ingest a batch of scan events (see the section comment). Responds with
+    accepted/duplicate counts and the rejected lines; 429 + Retry-After when
+    this worker is already ingesting or the database is busy."""
+    retry_after = str(app.config['SCAN_RETRY_AFTER'])
+    if not _scan_slots.acquire(blocking=False):
+        resp = jsonify({'ok': False, 'error': 'ingestion busy, retry later'})
+        resp.headers['Retry-After'] = retry_after
+        return resp, 429
+    try:
+        try:
+            events, unparsable = parse_scan_events(request.get_data(cache=False))
+        except (ValueError, UnicodeDecodeError) as e:
+            return jsonify({'ok': False, 'error': f'invalid body: {e}'}), 400
+        if len(events) > app.config['SCAN_MAX_EVENTS']:
+            return jsonify({'ok': False, 'error': f"at most {app.config['SCAN_MAX_EVENTS']} events per request"}), 413
+        try:
+            result = ingest_scan_events(get_db(), events, device_id=request.headers.get('X-Device-Id'),
+                                        user=_current_username())
+        except ScanBackpressure:
+            resp = jsonify({'ok': False, 'error': 'database busy, retry later'})
+            resp.headers['Retry-After'] = retry_after
+            return resp, 429
+        result['rejected'] = unparsable + result['rejected']
+        result['ok'] = True
+        return jsonify(result)
+    finally:
+        _scan_slots.release()
+
+
+# --- Offline sync ---
+# Mobile clients keep a local copy of the tables in SYNC_TABLES and fetch only
+# what changed. Triggers on those tables keep change_log at one row per
+# (table, row id): its seq is taken from a monotonic counter on every insert,
+# update or delete, op is 'upsert' or 'delete' (a tombstone) and changed_at
+# records when (the row's updated_at, kept out of the tables themselves). GET /api/v1/sync?since=<seq> returns the rows whose seq
+# is newer; POST /api/v1/sync applies queued offline edits, refusing any whose
+# base_seq is older than the row's current seq (someone else changed it since
+# the client last synced). Tombstones older than SYNC_TOMBSTONE_DAYS can be
+# purged (`flask purge-tombstones`); a client whose since predates the purge
+# is told to reset and gets a full copy. Uploads carrying a client_change_id
+# are remembered in sync_uploads, so a retry after a lost reply is not
+# applied twice.
+SYNC_TABLES = {
+    'products': ('id', 'name', 'description', 'size', 'price', 'qty', 'reorder_level'),
+    'trips': ('id', 'vehicle_no', 'driver_name', 'date', 'amount', 'note'),
+    'ledger': ('id', 'date', 'description', 'qty_in', 'qty_out', 'amount', 'balance', 'created_by'),
+}
+# what offline clients may change, per table and op. Stock (products.qty) only
+# moves through the stock journal and ledger balances are computed, so those
+# are read-only here.
+SYNC_WRITABLE = {
+    'products': {'update': ('name', 'description', 'size', 'price', 'reorder_level')},
+    'trips': {'insert': ('vehicle_no', 'driver_name', 'date', 'amount', 'note'),
+              'update': ('vehicle_no', 'driver_name', 'date', 'amount', 'note'),
+              'delete': ()},
+    'ledger': {'insert': ('date', 'description', 'qty_in', 'qty_out', 'amount')},
+}
+app.config['SYNC_PAGE_SIZE'] = int(os.environ.get('SYNC_PAGE_SIZE', '1000') or 1000)
+app.config['SYNC_TOMBSTONE_DAYS'] = int(os.environ.get('SYNC_TOMBSTONE_DAYS', '30') or 30)
+
+_PG_CHANGE_TRACKING = '''
+CREATE OR REPLACE FUNCTION log_row_change() RETURNS trigger AS $$
+DECLARE
+    rid INTEGER;
+    kind TEXT;
+BEGIN
+    IF TG_OP = 'DELETE' THEN rid := OLD.id; kind := 'delete'; ELSE rid := NEW.id; kind := 'upsert'; END IF;
+    INSERT INTO change_log (table_name, row_id, op, changed_at) VALUES (TG_TABLE_NAME, rid, kind, now())
+    ON CONFLICT (table_name, row_id) DO UPDATE
+        SET seq = nextval(pg_get_serial_sequence('change_log', 'seq')), op = EXCLUDED.op, changed_at = EXCLUDED.changed_at;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+'''
+
+
+# On PostgreSQL seq values are taken when the row is written but only become
+# visible at commit, so a long transaction can commit a seq below one a client
+# has already synced past. The write paths here are short single-request
+# transactions; if that changes, hold back entries newer than the oldest open
+# transaction (txid_snapshot_xmin) before handing out seqs.
+def install_change_tracking(db):
+    """Create change_log and its triggers on every SYNC_TABLES table; on first
+    install, log the rows that already exist. The caller commits."""
+    if db_dialect(db) == 'postgres':
+        # function bodies contain ';', so bypass executescript's splitting
+        cur = db.cursor()
+        cur.execute(_PG_CHANGE_TRACKING)
+        for table in SYNC_TABLES:
+            cur.execute(f'DROP TRIGGER IF EXISTS {table}_change_log ON {table}')
+            cur.execute(f'CREATE TRIGGER {table}_change_log AFTER INSERT OR UPDATE OR DELETE ON {table} '
+                        'FOR EACH ROW EXECUTE FUNCTION log_row_change()')
+    else:
+        db.execute('CREATE TABLE IF NOT EXISTS change_log (seq INTEGER PRIMARY KEY AUTOINCREMENT, table_name TEXT NOT NULL, '
+                   'row_id INTEGER NOT NULL, op TEXT NOT NULL, changed_at TEXT NOT NULL)')
+        db.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_change_log_row ON change_log (table_name, row_id)')
+        db.execute('CREATE TABLE IF NOT EXISTS sync_meta (id INTEGER PRIMARY KEY, purged_through INTEGER NOT NULL DEFAULT 0)')
+        db.execute('CREATE TABLE IF NOT EXISTS sync_uploads (client_change_id TEXT PRIMARY KEY, result TEXT NOT NULL, created_at TEXT NOT NULL)')
+        db.execute('INSERT OR IGNORE INTO sync_meta (id, purged_through) VALUES (1, 0)')
+        for table in SYNC_TABLES:
+            for event, ref, op in (('INSERT', 'NEW', 'upsert'), ('UPDATE', 'NEW', 'upsert'), ('DELETE', 'OLD', 'delete')):
+                # INSERT OR REPLACE deletes the old row, so seq always moves forward
+                db.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_change_{event.lower()} AFTER {event} ON {table} BEGIN "
+                           f"INSERT OR REPLACE INTO change_log (table_name, row_id, op, changed_at) "
+                           f"VALUES ('{table}', {ref}.id, '{op}', CURRENT_TIMESTAMP); END")
+    if db.execute('SELECT 1 FROM change_log LIMIT 1').fetchone() is None:
+        for table in SYNC_TABLES:
+            db.execute(f"INSERT INTO change_log (table_name, row_id, op, changed_at) "
+                       f"SELECT '{table}', id, 'upsert', CURRENT_TIMESTAMP FROM {table}")
+
+
+def sync_tables_for(user):
+    """Customers only sync the catalogue; staff get everything."""
+    role = (getattr(user, 'role', '') or '').lower()
+    return list(SYNC_TABLES) if role == 'admin' else ['products']
+
+
+def sync_changes(db, since, tables, limit):
+    """Changes to `tables` after seq `since`, oldest first, at most `limit`.
+    Returns {'seq', 'more', 'reset', 'changes'}; 'changes' holds, per table,
+    the column names once, the changed rows as lists (prefixed by their seq)
+    and the ids deleted."""
+    purged = db.execute('SELECT purged_through FROM sync_meta WHERE id = 1').fetchone()
+    reset = bool(since) and purged is not None and since < int(purged['purged_through'] or 0)
+    if reset:
+        since = 0
+    marks = ', '.join('?' * len(tables))
+    entries = db.execute(f'SELECT seq, table_name, row_id, op FROM change_log WHERE seq > ? AND table_name IN ({marks}) '
+                         'ORDER BY seq LIMIT ?', [since, *tables, limit + 1]).fetchall()
+    more = len(entries) > limit
+    entries = entries[:limit]
+    changes = {}
+    upserts = {}
+    for e in entries:
+        table = e['table_name']
+        part = changes.setdefault(table, {'columns': ['_seq', *SYNC_TABLES[table]], 'rows': [], 'deleted': []})
+        if e['op'] == 'delete':
+            part['deleted'].append(e['row_id'])
+        else:
+            upserts.setdefault(table, {})[e['row_id']] = e['seq']
+    for table, seqs in upserts.items():
+        ids = list(seqs)
+        cols = ', '.join(SYNC_TABLES[table])
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            for row in db.execute(f"SELECT {cols} FROM {table} WHERE id IN ({', '.join('?' * len(chunk))})", chunk):
+                changes[table]['rows'].append([seqs[row['id']], *(row[c] for c in SYNC_TABLES[table])])
+        changes[table]['rows'].sort(key=lambda r: r[0])
+    last = entries[-1]['seq'] if entries else since
+    if not entries:
+        # nothing newer: let the client fast-forward past other tables' changes
+        top = db.execute('SELECT MAX(seq) AS s FROM change_log').fetchone()
+        last = max(since, int(top['s'] or 0)) if not reset else last
+    return {'seq': last, 'more': more, 'reset': reset, 'changes': changes}
+
+
+def _row_seq(db, table, row_id):
+    row = db.execute('SELECT seq, op FROM change_log WHERE table_name = ? AND row_id = ?', (table, row_id)).fetchone()
+    return (int(row['seq']), row['op']) if row else (0, None)
+
+
+def apply_sync_change(db, change, user=None):
+    """Apply one queued offline edit. Returns a result dict whose status is
+    'applied', 'conflict' (with the server's current row) or 'rejected'.
+    The caller commits."""
+    table, op = change.get('table'), change.get('op')
+    allowed = SYNC_WRITABLE.get(table, {})
+    if op not in allowed:
+        return {'status': 'rejected', 'error': f'{op!r} on {table!r} is not allowed offline'}
+    values = change.get('values') or {}
+    unknown = set(values) - set(allowed[op])
+    if unknown:
+        return {'status': 'rejected', 'error': f"read-only or unknown fields: {', '.join(sorted(unknown))}"}
+    if op == 'insert':
+        if table == 'ledger':
+            add_ledger_entry(db, values.get('date') or datetime.utcnow().date().isoformat(), values.get('description') or '',
+                             values.get('qty_in') or 0, values.get('qty_out') or 0, float(values.get('amount') or 0), user=user)
+            row_id = db.execute('SELECT MAX(id) AS id FROM ledger').fetchone()['id']  # add_ledger_entry returns the balance
+        else:
+            row_id = record_trip(db, values.get('vehicle_no') or '', values.get('driver_name') or '', values.get('date'),
+                                 float(values.get('amount') or 0), values.get('note') or '', user=user)
+        return {'status': 'applied', 'id': row_id, 'seq': _row_seq(db, table, row_id)[0]}
+
+    try:
+        row_id = int(change.get('id'))
+        base_seq = int(change.get('base_seq') or 0)
+    except (TypeError, ValueError):
+        return {'status': 'rejected', 'error': 'id and base_seq must be integers'}
+    current_seq, current_op = _row_seq(db, table, row_id)
+    if current_op == 'delete' and op == 'delete':
+        return {'status': 'applied', 'id': row_id, 'seq': current_seq}
+    if current_seq > base_seq:
+        current = db.execute(f"SELECT {', '.join(SYNC_TABLES[table])} FROM {table} WHERE id = ?", (row_id,)).fetchone()
+        return {'status': 'conflict', 'id': row_id, 'seq': current_seq,
+                'current': dict(current) if current else None}
+    old = db.execute(f"SELECT {', '.join(SYNC_TABLES[table])} FROM {table} WHERE id = ?", (row_id,)).fetchone()
+    if old is None:
+        return {'status': 'rejected', 'id': row_id, 'error': 'no such row'}
+    if op == 'delete':
+        db.execute(f'DELETE FROM {table} WHERE id = ?', (row_id,))
+        changed = {'all': ('', '')}
+    else:
+        changed = {k: (old[k], v) for k, v in values.items() if str(old[k]) != str(v)}
+        if changed:
+            db.execute(f"UPDATE {table} SET {', '.join(f'{k} = ?' for k in changed)} WHERE id = ?",
+                       [v for _, v in changed.values()] + [row_id])
+    action = 'sync_delete' if op == 'delete' else 'sync_update'
+    for field, (before, after) in changed.items():
+        if table == 'products':
+            db.execute('INSERT INTO product_audit (product_id, user, action, field, old_value, new_value, reason) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                       (row_id, user or 'unknown', action, field, str(before), str(after), 'offline sync'))
+        else:
+            db.execute('INSERT INTO audit (entity, entity_id, user, action, field, old_value, new_value, reason) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                       (table, row_id, user or 'unknown', action, field, str(before), str(after), 'offline sync'))
+    if table == 'products' and changed:
+        bump_catalogue_version(db)
+    return {'status': 'applied', 'id': row_id, 'seq': _row_seq(db, table, row_id)[0]}
+
+
+def purge_sync_tombstones(db, days=None):
+    """Drop delete markers older than `days`; clients that synced before the
+    newest one dropped must reset. The caller commits. Returns the count."""
+    days = app.config['SYNC_TOMBSTONE_DAYS'] if days is None else days
+    cutoff = _utc_timestamp(datetime.utcnow() - timedelta(days=days))
+    top = db.execute("SELECT COUNT(*) AS c, MAX(seq) AS s FROM change_log WHERE op = 'delete' AND changed_at < ?",
+                     (cutoff,)).fetchone()
+    if not top or not top['c']:
+        db.execute('DELETE FROM sync_uploads WHERE created_at < ?', (cutoff,))
+        return 0
+    db.execute("DELETE FROM change_log WHERE op = 'delete' AND seq <= ? AND changed_at < ?", (top['s'], cutoff))
+    db.execute('UPDATE sync_meta SET purged_through = ? WHERE id = 1 AND purged_through < ?', (top['s'], top['s']))
+    db.execute('DELETE FROM sync_uploads WHERE created_at < ?', (cutoff,))
+    return int(top['c'])
+
+
+@app.cli.command('purge-tombstones')
+@click.option('--days', type=int, default=None, help='keep delete markers this many days (default SYNC_TOMBSTONE_DAYS)')
+def purge_tombstones_command(days):
+    db = get_db()
+    removed = purge_sync_tombstones(db, days)
+    db.commit()
+    print(f'Purged {removed} sync tombstones.')
+
+
+@app.route('/api/v1/sync', methods=['GET'])
+@login_required
+def api_sync():
+    """Changes since ?since=<seq> (0 for a full copy), paged by ?limit."""
+    try:
+        since = max(0, int(request.args.get('since', 0)))
+        limit = max(1, min(int(request.args.get('limit', app.config['SYNC_PAGE_SIZE'])), app.config['SYNC_PAGE_SIZE']))
+    except ValueError:
+        return jsonify({'ok': False, 'error': 'since and limit must be integers'}), 400
+    tables = sync_tables_for(current_user)
+    wanted = [t for t in request.args.get('tables', '').split(',') if t]
+    if wanted:
+        tables = [t for t in tables if t in wanted]
+    if not tables:
+        return jsonify({'ok': False, 'error': 'no tables to sync'}), 400
+    result = sync_changes(get_db(), since, tables, limit)
+    result['ok'] = True
+    return jsonify(result)
+
+
+@app.route('/api/v1/sync', methods=['POST'])
+@login_required
+@admin_required
+def api_sync_upload():
+    """Apply a client's queued edits in order: {"changes": [{"table": "trips",
+    "op": "insert"|"update"|"delete", "id": 12, "base_seq": 340,
+    "values": {...}}, ...]}. Each gets its own result; conflicts and
+    rejections don't stop the rest."""
+    payload = request.get_json(silent=True) or {}
+    changes = payload.get('changes')
+    if not isinstance(changes, list):
+        return jsonify({'ok': False, 'error': 'changes must be a list'}), 400
+    db = get_db()
+    user = _current_username()
+    results = []
+    for change in changes:
+        if not isinstance(change, dict):
+            results.append({'status': 'rejected', 'error': 'change must be an object'})
+            continue
+        client_id = str(change.get('client_change_id') or '') or None
+        seen = client_id and db.execute('SELECT result FROM sync_uploads WHERE client_change_id = ?', (client_id,)).fetchone()
+        if seen:
+            # a retry of an upload whose reply was lost: answer as before
+            results.append(json.loads(seen['result']))
+            continue
+        try:
+            result = apply_sync_change(db, change, user=user)
+        except (TypeError, ValueError) as e:
+            result = {'status': 'rejected', 'error': str(e)}
+        if client_id:
+            result['client_change_id'] = client_id
+            if result['status'] == 'applied':
+                db.execute('INSERT INTO sync_uploads (client_change_id, result, created_at) VALUES (?, ?, ?)',
+                           (client_id, json.dumps(result), _utc_timestamp()))
+        results.append(result)
+    db.commit()
+    top = db.execute('SELECT MAX(seq) AS s FROM change_log').fetchone()
+    return jsonify({'ok': True, 'results': results, 'seq': int(top['s'] or 0)})
+
+
+# --- AI block counting ---
+# Finished ai_jobs rows are kept AI_JOB_RETENTION_HOURS so a slow page can
+# still poll its result, then swept like idempotency keys
+# (`flask purge-ai-jobs`).
+app.config['AI_JOB_RETENTION_HOURS'] = int(os.environ.get('AI_JOB_RETENTION_HOURS', '24') or 24)
+app.config['AI_JOB_SWEEP_SECONDS'] = int(os.environ.get('AI_JOB_SWEEP_SECONDS', '3600') or 3600)
+_last_ai_job_sweep = 0.0
+
+
+def propose_stock_count(db, product_id, counted, images=1, user=None):
+    """Record an AI block count as a *proposed* qty change in product_audit
+    (action 'ai_proposed'); stock is only changed when an admin applies it
+    through the normal adjust form. The caller commits. Returns the proposal,
+    or None if the product does not exist."""
+    row = db.execute('SELECT id, name, qty FROM products WHERE id = ?', (product_id,)).fetchone()
+    if not row:
+        return None
+    current = int(row['qty'] or 0)
+    db.execute('INSERT INTO product_audit (product_id, user, action, field, old_value, new_value, reason) VALUES (?, ?, ?, ?, ?, ?, ?)',
+               (product_id, user or _current_username(), 'ai_proposed', 'qty', str(current), str(counted),
+                f'AI count from {images} image(s)'))
+    return {'product_id': product_id, 'name': row['name'], 'current_qty': current,
+            'counted_qty': counted, 'delta': counted - current}
+
+
+@app.route('/ai/status')
+@login_required
+def ai_status():
+    import ai_detection
+    return jsonify(ai_detection.status())
+
+
+@app.route('/ai/detect', methods=['GET', 'POST'])
+@admission_class('heavy', methods=('POST',))
+@login_required
+@admin_required
+def ai_detect():
+    """Count blocks in one or more uploaded photos (form field `image`,
+    repeatable). `tiled` is 1, 0 or auto (default: tile photos larger than
+    AI_TILE_MIN_SIDE). With `product_id`, the total is also recorded as a
+    proposed stock count for that product.
+
+    Detection runs on the detector pool; the POST answers 202 with a job id
+    straight away and the counts come from polling ai_detect_job."""
+    import ai_detection
+    if request.method == 'GET':
+        products = get_db().execute('SELECT id, name, qty FROM products ORDER BY name').fetchall()
+        return render_template('admin/ai_detect.html', products=products, status=ai_detection.status())
+    files = [f for f in request.files.getlist('image') + request.files.getlist('images') if f and f.filename]
+    if not files:
+        return jsonify({'success': False, 'error': 'Upload at least one image'}), 400
+    try:
+        confidence = float(request.form['confidence']) if request.form.get('confidence') else None
+    except ValueError:
+        return jsonify({'success': False, 'error': 'confidence must be a number'}), 400
+    tiled = {'1': True, 'on': True, 'true': True, '0': False, 'off': False, 'false': False}.get(
+        (request.form.get('tiled') or 'auto').lower(), 'auto')
+    product_id = int(request.form['product_id']) if request.form.get('product_id') else None
+    try:
+        future = ai_detection.submit([f.read() for f in files], confidence=confidence, tiled=tiled)
+    except ai_detection.DetectorBusy as e:
+        return jsonify({'success': False, 'error': str(e)}), 503, {'Retry-After': '5'}
+    except ai_detection.DetectorUnavailable as e:
+        return jsonify({'success': False, 'error': str(e)}), 503
+    now = datetime.utcnow()
+    db = get_db()
+    job_id = insert_returning_id(
+        db, 'INSERT INTO ai_jobs (status, product_id, created_by, created_at, expires_at) VALUES (?, ?, ?, ?, ?)',
+        ('pending', product_id, _current_username(), _utc_timestamp(now),
+         _utc_timestamp(now + timedelta(seconds=ai_detection.TIMEOUT_SECONDS))))
+    db.commit()
+    future.add_done_callback(lambda fut: _finish_ai_job(job_id, fut, [f.filename for f in files]))
+    _maybe_sweep_ai_jobs(db)
+    return jsonify({'success': True, 'job_id': job_id, 'status': 'pending',
+                    'poll_url': url_for('ai_detect_job', job_id=job_id)}), 202
+
+
+def _finish_ai_job(job_id, future, filenames):
+    """Store a finished /ai/detect run on its ai_jobs row, recording the
+    proposed stock count if the job asked for one. Runs on the detector
+    thread, outside any app context, so it opens its own connection and
+    sends any emails queued on this thread itself."""
+    try:
+        results, error = future.result(), None
+    except ValueError as e:
+        results, error = None, str(e)
+    except Exception as e:
+        app.logger.warning('AI detection job %s failed: %s', job_id, e)
+        results, error = None, 'Detection failed'
+    try:
+        conn = connect_db()
+    except Exception as e:
+        app.logger.warning('AI detection job %s dropped, database unavailable: %s', job_id, e)
+        return
+    try:
+        job = conn.execute('SELECT product_id, created_by FROM ai_jobs WHERE id = ?', (job_id,)).fetchone()
+        if results is not None:
+            for name, r in zip(filenames, results):
+                r['filename'] = name
+            total = sum(r['count'] for r in results)
+            proposal = None
+            if job['product_id'] is not None:
+                proposal = propose_stock_count(conn, job['product_id'], total, images=len(results),
+                                               user=job['created_by'])
+            conn.execute("UPDATE ai_jobs SET status = 'done', result = ?, finished_at = ? WHERE id = ?",
+                         (json.dumps({'count': total, 'images': results, 'proposal': proposal}),
+                          _utc_timestamp(), job_id))
+        else:
+            conn.execute("UPDATE ai_jobs SET status = 'failed', error = ?, finished_at = ? WHERE id = ?",
+                         (error, _utc_timestamp(), job_id))
+        conn.commit()
+    except Exception as e:
+        app.logger.warning('AI detection job %s could not be saved: %s', job_id, e)
+    finally:
+        conn.close()
+        flush_pending_emails()
+
+
+def purge_ai_jobs(db, batch_size=500, max_batches=None):
+    """Delete ai_jobs rows older than AI_JOB_RETENTION_HOURS `batch_size`
+    rows at a time, committing after each batch. Returns the number of rows
+    deleted."""
+    cutoff = _utc_timestamp(datetime.utcnow() - timedelta(hours=app.config['AI_JOB_RETENTION_HOURS']))
+    total = batches = 0
+    while max_batches is None or batches < max_batches:
+        cur = db.execute('DELETE FROM ai_jobs WHERE id IN '
+                         '(SELECT id FROM ai_jobs WHERE created_at < ? LIMIT ?)', (cutoff, batch_size))
+        db.commit()
+        deleted = cur.rowcount or 0
+        total += deleted
+        batches += 1
+        if deleted < batch_size:
+            break
+    return total
+
+
+def _maybe_sweep_ai_jobs(db):
+    """Purge one batch of old jobs at most every AI_JOB_SWEEP_SECONDS."""
+    global _last_ai_job_sweep
+    now = time.monotonic()
+    if now - _last_ai_job_sweep < app.config['AI_JOB_SWEEP_SECONDS']:
+        return
+    _last_ai_job_sweep = now
+    try:
+        purge_ai_jobs(db, max_batches=1)
+    except Exception as e:
+        _rollback_quietly(db)
+        app.logger.warning('AI job sweep failed: %s', e)
+
+
+@app.cli.command('purge-ai-jobs')
+@click.option('--batch-size', default=500, show_default=True, help='Rows deleted per transaction.')
+def purge_ai_jobs_command(batch_size):
+    """Delete ai_jobs rows past their retention."""
+    deleted = purge_ai_jobs(get_db(), batch_size=batch_size)
+    print(f"Deleted {deleted} old AI detection jobs.")
+
+
+@app.route('/ai/detect/<int:job_id>')
+@login_required
+@admin_required
+def ai_detect_job(job_id):
+    """Poll an /ai/detect job. Pending jobs answer {'status': 'pending'};
+    finished ones carry the same counts the form used to get inline."""
+    job = get_db().execute('SELECT * FROM ai_jobs WHERE id = ?', (job_id,)).fetchone()
+    if job is None:
+        return jsonify({'success': False, 'error': 'No such job'}), 404
+    if job['status'] == 'done':
+        return jsonify({'success': True, 'job_id': job_id, 'status': 'done', **json.loads(job['result'])})
+    if job['status'] == 'failed':
+        return jsonify({'success': False, 'job_id': job_id, 'status': 'failed', 'error': job['error']})
+    if job['expires_at'] < _utc_timestamp():
+        # the worker that owned it restarted, or the queue is badly backed up
+        return jsonify({'success': False, 'job_id': job_id, 'status': 'timeout', 'error': 'Detection timed out'}), 504
+    return jsonify({'success': True, 'job_id': job_id, 'status': 'pending'}), 202, {'Retry-After': '1'}
+
+
 # --- Admin: sales CRUD ---
 @app.route('/admin/sales', methods=['GET','POST'])
 @login_required
 @admin_required
+@idempotent
 def admin_sales():
     db = get_db()
     if request.method == 'POST':
@@ -1372,10 +4418,8 @@ def admin_sales():
         amount = float(request.form['amount'])
         buyer_name = request.form.get('buyer_name','').strip()
         sale_date = request.form.get('sale_date') or datetime.utcnow().date().isoformat()
-        db.execute('INSERT INTO sales (sale_date, amount, product_id, qty, buyer_name) VALUES (?, ?, ?, ?, ?)', (sale_date, amount, product_id, qty, buyer_name))
-        # decrement product qty
-        db.execute('UPDATE products SET qty = qty - ? WHERE id = ?', (qty, product_id))
-        db.commit()
+        run_write('record_sale', product_id=product_id, qty=qty, amount=amount, buyer_name=buyer_name,
+                  sale_date=sale_date, user=_current_username())
         flash('Sale recorded', 'success')
         return redirect(url_for('admin_sales'))
     # simple search and pagination
@@ -1412,9 +4456,9 @@ def admin_sales_edit(sid):
             old_pid = old['product_id']
             # restore old qty then deduct new qty
             if old_pid:
-                db.execute('UPDATE products SET qty = qty + ? WHERE id = ?', (old_qty, old_pid))
+                change_product_stock(db, old_pid, old_qty, source='sale', ref_entity='sales', ref_id=sid)
         db.execute('UPDATE sales SET sale_date = ?, amount = ?, product_id = ?, qty = ?, buyer_name = ? WHERE id = ?', (sale_date, amount, product_id, qty, buyer_name, sid))
-        db.execute('UPDATE products SET qty = qty - ? WHERE id = ?', (qty, product_id))
+        change_product_stock(db, product_id, -qty, source='sale', ref_entity='sales', ref_id=sid)
         db.commit()
         flash('Sale updated', 'success')
         return redirect(url_for('admin_sales'))
@@ -1430,7 +4474,7 @@ def admin_sales_delete(sid):
     db = get_db()
     row = db.execute('SELECT * FROM sales WHERE id = ?', (sid,)).fetchone()
     if row and row['product_id']:
-        db.execute('UPDATE products SET qty = qty + ? WHERE id = ?', (row['qty'] or 0, row['product_id']))
+        change_product_stock(db, row['product_id'], row['qty'] or 0, source='sale', ref_entity='sales', ref_id=sid)
     db.execute('DELETE FROM sales WHERE id = ?', (sid,))
     db.commit()
     flash('Sale deleted', 'info')
@@ -1449,16 +4493,14 @@ def admin_breakages():
         reason = request.form.get('reason','')
         reported_by = request.form.get('reported_by','')
         date = request.form.get('date') or datetime.utcnow().isoformat()
-        db.execute('INSERT INTO breakages (product_id, qty, reason, reported_by, date) VALUES (?, ?, ?, ?, ?)', (product_id, qty, reason, reported_by, date))
-        # decrement product stock to account for breakage
-        db.execute('UPDATE products SET qty = qty - ? WHERE id = ?', (qty, product_id))
-        db.commit()
+        run_write('record_breakage', product_id=product_id, qty=qty, reason=reason, reported_by=reported_by,
+                  date=date, user=_current_username())
         flash('Breakage recorded and stock adjusted', 'success')
         return redirect(url_for('admin_breakages'))
     # list breakages
-    rows = db.execute('SELECT b.*, p.name as product_name FROM breakages b LEFT JOIN products p ON b.product_id = p.id ORDER BY b.date DESC').fetchall()
-    products = db.execute('SELECT * FROM products').fetchall()
-    return render_template('admin/breakages_manage.html', breakages=rows, products=products)
+    rows = RowStream(db, 'SELECT b.*, p.name as product_name FROM breakages b LEFT JOIN products p ON b.product_id = p.id ORDER BY b.date DESC')
+    products = db.execute('SELECT id, name FROM products').fetchall()
+    return stream_page('admin/breakages_manage.html', breakages=rows, products=products)
 
 
 @app.route('/admin/breakages/delete/<int:bid>', methods=['POST'])
@@ -1469,7 +4511,7 @@ def admin_breakages_delete(bid):
     row = db.execute('SELECT * FROM breakages WHERE id = ?', (bid,)).fetchone()
     if row:
         # restore stock when deleting a breakage record
-        db.execute('UPDATE products SET qty = qty + ? WHERE id = ?', (row['qty'] or 0, row['product_id']))
+        change_product_stock(db, row['product_id'], row['qty'] or 0, source='breakage', ref_entity='breakages', ref_id=bid)
         db.execute('DELETE FROM breakages WHERE id = ?', (bid,))
         db.commit()
         flash('Breakage entry removed and stock restored', 'info')
@@ -1485,22 +4527,135 @@ def admin_notifications():
         action = request.form.get('action')
         if action == 'mark_read':
             try:
-                nid = int(request.form.get('id', 0))
-                db.execute('UPDATE notifications SET is_read = 1 WHERE id = ?', (nid,))
+                ids = [int(i) for i in request.form.getlist('id') if str(i).strip()]
+                mark_notifications_read(db, ids)
                 db.commit()
-                flash('Notification marked as read', 'success')
+                flash('Notification marked as read' if len(ids) == 1 else f'{len(ids)} notifications marked as read', 'success')
             except Exception:
                 flash('Failed to mark as read', 'warning')
         elif action == 'mark_all':
             try:
-                db.execute('UPDATE notifications SET is_read = 1 WHERE is_read = 0')
+                mark_notifications_read(db)
                 db.commit()
                 flash('All notifications marked as read', 'success')
             except Exception:
                 flash('Failed to mark all as read', 'warning')
         return redirect(url_for('admin_notifications'))
     rows = db.execute('SELECT * FROM notifications ORDER BY created_at DESC, id DESC LIMIT 200').fetchall()
-    return render_template('admin/notifications.html', notifications=rows)
+    return render_template('admin/notifications.html', notifications=rows,
+                           latest_id=max((r['id'] for r in rows), default=0),
+                           sse_enabled=app.config['SSE_ENABLED'],
+                           poll_seconds=app.config['NOTIFICATIONS_POLL_SECONDS'])
+
+
+def mark_notifications_read(db, ids=None):
+    """Mark the given notification ids (or all, when ids is None) as read in
+    one statement per 500 ids. The caller commits."""
+    if ids is None:
+        db.execute('UPDATE notifications SET is_read = 1 WHERE is_read = 0')
+        return
+    ids = list(ids)
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        db.execute(f"UPDATE notifications SET is_read = 1 WHERE id IN ({', '.join('?' * len(chunk))})", chunk)
+
+
+@app.route('/admin/notifications/unread')
+@login_required
+@admin_required
+def admin_notifications_unread():
+    """The unread count; with ?since=<id> also the notifications newer than
+    that id (what the page polls when streaming is off)."""
+    db = get_db()
+    row = db.execute('SELECT COUNT(*) AS c FROM notifications WHERE is_read = 0').fetchone()
+    payload = {'unread': int(row['c'] or 0) if row else 0}
+    since = request.args.get('since', type=int)
+    if since is not None:
+        payload['notifications'] = [_notification_payload(r) for r in db.execute(
+            'SELECT id, title, message, level, created_at FROM notifications '
+            'WHERE id > ? ORDER BY id LIMIT 200', (since,)).fetchall()]
+    return jsonify(payload)
+
+
+@app.route('/admin/notifications/mark_read', methods=['POST'])
+@login_required
+@admin_required
+def admin_notifications_mark_read():
+    """Batched mark-read for the live feed: JSON {"ids": [...]} or {"all": true}."""
+    payload = request.get_json(silent=True) or {}
+    db = get_db()
+    try:
+        if payload.get('all'):
+            mark_notifications_read(db)
+        else:
+            mark_notifications_read(db, [int(i) for i in payload.get('ids') or []])
+        db.commit()
+    except (TypeError, ValueError):
+        return jsonify({'ok': False, 'error': 'ids must be a list of integers'}), 400
+    row = db.execute('SELECT COUNT(*) AS c FROM notifications WHERE is_read = 0').fetchone()
+    return jsonify({'ok': True, 'unread': int(row['c'] or 0) if row else 0})
+
+
+@app.route('/admin/notifications/stream')
+@login_required
+@admin_required
+def admin_notifications_stream():
+    """Server-Sent Events feed of new notifications and the unread count."""
+    if not app.config['SSE_ENABLED']:
+        # 204 tells EventSource (say, a tab opened before a config change)
+        # to stop reconnecting; the page polls instead
+        return Response(status=204)
+    since = request.headers.get('Last-Event-ID') or request.args.get('since')
+    try:
+        since = int(since)
+    except (TypeError, ValueError):
+        since = None
+    max_seconds = app.config['SSE_MAX_STREAM_SECONDS']
+    poll_seconds = app.config['SSE_POLL_SECONDS']
+
+    def _event(name, data, event_id=None):
+        head = f"id: {event_id}\n" if event_id is not None else ''
+        return f"{head}event: {name}\ndata: {json.dumps(data)}\n\n"
+
+    def generate(since):
+        notification_feed.subscribe()
+        try:
+            if since is None:
+                since = notification_feed.high_water_mark
+            yield from _stream(since)
+        finally:
+            notification_feed.unsubscribe()
+
+    def _stream(since):
+        deadline = time.monotonic() + max_seconds
+        unread_seen = -1
+        yield f"retry: {int(poll_seconds * 1000)}\n\n"
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            rows, unread = notification_feed.wait(since, unread_seen, timeout=min(remaining, 15))
+            if rows is None:
+                conn = connect_db()
+                try:
+                    rows = [_notification_payload(r) for r in conn.execute(
+                        'SELECT id, title, message, level, created_at FROM notifications '
+                        'WHERE id > ? ORDER BY id LIMIT 200', (since,)).fetchall()]
+                finally:
+                    conn.close()
+            for n in rows:
+                since = max(since, n['id'])
+                yield _event('notification', n, n['id'])
+            if unread != unread_seen:
+                unread_seen = unread
+                yield _event('unread', {'unread': unread})
+            elif not rows:
+                yield ": keepalive\n\n"
+
+    resp = Response(generate(since), mimetype='text/event-stream')
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no'  # let nginx pass events straight through
+    return resp
 
 
 # --- Admin: expenses CRUD ---
@@ -1590,6 +4745,7 @@ def admin_expenses_delete(eid):
 @app.route('/admin/customers')
 @login_required
 @admin_required
+@db_intent('read')
 def admin_customers():
     db = get_db()
     # simple search and pagination
@@ -1610,6 +4766,7 @@ def admin_customers():
 # Customer-facing: my orders and payments
 @app.route('/my/orders')
 @login_required
+@db_intent('read')
 def my_orders():
     db = get_db()
     # if current_user is admin, show all orders; else show only their orders (customers use email to match)
@@ -1632,6 +4789,7 @@ def my_orders():
 
 @app.route('/my/payments')
 @login_required
+@db_intent('read')
 def my_payments():
     db = get_db()
     if getattr(current_user, 'role', '').lower() == 'admin':
@@ -1666,45 +4824,46 @@ def customer_dashboard():
         flash('Customer record not found', 'warning')
         return redirect(url_for('products'))
 
-    cust_id = customer['id']
-    total_products = db.execute('SELECT COUNT(*) as c FROM products').fetchone()['c']
-    my_orders = db.execute('SELECT COUNT(*) as c FROM orders WHERE customer_id = ?', (cust_id,)).fetchone()['c']
-    my_payments = db.execute("SELECT COUNT(*) as c FROM payments p JOIN orders o ON p.order_id = o.id WHERE o.customer_id = ?", (cust_id,)).fetchone()['c']
-    return render_template('customer_dashboard.html', total_products=total_products, my_orders=my_orders, my_payments=my_payments)
+    stats = get_dashboard_data(('total_products', 'my_orders', 'my_payments'), customer_id=customer['id'], db=db)
+    return render_template('customer_dashboard.html', total_products=stats['total_products'],
+                           my_orders=stats['my_orders'], my_payments=stats['my_payments'])
 
 @app.route('/orders')
 @login_required
+@db_intent('read')
 def orders_list():
     db = get_db()
-    rows = db.execute(""" 
+    rows = RowStream(db, """ 
         SELECT o.id, o.order_date, o.total, o.status, c.name as customer
         FROM orders o LEFT JOIN customers c ON o.customer_id = c.id
         ORDER BY o.order_date DESC
-    """).fetchall()
-    return render_template('orders_list.html', orders=rows)
+    """)
+    return stream_page('orders_list.html', orders=rows)
 
 # Payments admin view
 @app.route('/payments')
 @login_required
 @admin_required
+@db_intent('read')
 def payments_list():
     db = get_db()
-    rows = db.execute(""" 
+    rows = RowStream(db, """ 
         SELECT p.id, p.order_id, p.amount, p.date_paid, p.status, c.name as customer
         FROM payments p
         JOIN orders o ON p.order_id = o.id
         LEFT JOIN customers c ON o.customer_id = c.id
         ORDER BY p.date_paid DESC
-    """).fetchall()
-    return render_template('payments_list.html', payments=rows)
+    """)
+    return stream_page('payments_list.html', payments=rows)
 
 @app.route('/payments/mark_paid/<int:pid>', methods=['POST'])
+@admission_class('critical')
 @login_required
 @admin_required
+@idempotent
 def mark_paid(pid):
-    db = get_db()
-    db.execute("UPDATE payments SET status = 'Paid', date_paid = ? WHERE id = ?", (datetime.utcnow().isoformat(), pid))
-    db.commit()
+    with transaction() as db:
+        db.execute("UPDATE payments SET status = 'Paid', date_paid = ? WHERE id = ?", (datetime.utcnow().isoformat(), pid))
     flash('Payment marked as Paid', 'success')
     return redirect(url_for('payments_list'))
 
@@ -1720,32 +4879,15 @@ def trips():
         date = request.form.get('date') or datetime.utcnow().date().isoformat()
         amount = float(request.form.get('amount',0))
         note = request.form.get('note','')
-        db.execute("INSERT INTO trips (vehicle_no, driver_name, date, amount, note) VALUES (?, ?, ?, ?, ?)",
-                   (vehicle_no, driver_name, date, amount, note))
-        db.commit()
-        # Try to find the inserted trip id in a DB-agnostic way
-        try:
-            new_row = db.execute("SELECT id FROM trips WHERE vehicle_no = ? AND date = ? AND amount = ? ORDER BY id DESC LIMIT 1",
-                                 (vehicle_no, date, amount)).fetchone()
-            new_id = new_row['id'] if new_row else None
-        except Exception:
-            new_id = None
-        # Insert a generic audit entry capturing the creation
-        try:
-            user = getattr(current_user, 'username', None) or getattr(current_user, 'email', None) or 'unknown'
-            summary = f"vehicle_no={vehicle_no};driver_name={driver_name};date={date};amount={amount};note={note}"
-            db.execute('INSERT INTO audit (entity, entity_id, user, action, field, old_value, new_value, reason) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
-                       ('trips', new_id, user, 'create', 'all', '', summary, 'create'))
-        except Exception:
-            pass
-        db.commit()
+        run_write('record_trip', vehicle_no=vehicle_no, driver_name=driver_name, date=date, amount=amount,
+                  note=note, user=_current_username())
         flash('Trip recorded', 'success')
         return redirect(url_for('trips'))
-    rows = db.execute("SELECT * FROM trips ORDER BY date DESC").fetchall()
+    rows = RowStream(db, "SELECT * FROM trips ORDER BY date DESC")
     # calculate totals per vehicle for today
     today = datetime.utcnow().date().isoformat()
     totals_today = db.execute("SELECT vehicle_no, SUM(amount) as total FROM trips WHERE date = ? GROUP BY vehicle_no", (today,)).fetchall()
-    return render_template('trips.html', trips=rows, totals_today=totals_today)
+    return stream_page('trips.html', trips=rows, totals_today=totals_today)
 
 
 @app.route('/trips/edit/<int:tid>', methods=['GET','POST'])
@@ -1837,8 +4979,12 @@ def notes():
 
 # Sales report: daily and monthly
 @app.route('/sales')
+@admission_class('heavy')
 @login_required
 @admin_required
+@db_intent('read')
+@report_snapshot
+@query_budget()
 def sales_report():
     db = get_db()
     # Monthly totals
@@ -1862,6 +5008,22 @@ def sales_report():
     day_totals = [r['total'] for r in rows_d]
     return render_template('sales.html', months=months, totals=totals, days=days, day_totals=day_totals)
 
+@app.route('/admin/forecast.json')
+@admission_class('heavy')
+@login_required
+@admin_required
+@query_budget()
+def admin_forecast():
+    """Per-product demand forecast and recommended reorder levels (cached per day)."""
+    try:
+        days = min(max(28, int(request.args.get('days', 3 * 365))), 10 * 365)
+        horizon = min(max(1, int(request.args.get('horizon', 14))), 90)
+        lead_time = min(max(1, int(request.args.get('lead_time', 7))), 90)
+    except ValueError:
+        return jsonify({'ok': False, 'error': 'days, horizon and lead_time must be integers'}), 400
+    forecast = get_forecast(get_db(), days=days, horizon=horizon, lead_time=lead_time)
+    return jsonify({'ok': True, 'days': days, 'horizon': horizon, 'lead_time': lead_time, 'products': forecast})
+
 # Backward-compat: legacy link name used in old templates
 @app.route('/financial_reports')
 @login_required
@@ -1893,13 +5055,18 @@ def seed_demo_sales():
 @app.route('/ledger')
 @login_required
 @admin_required
+@db_intent('read')
+@report_snapshot
 def ledger():
     db = get_db()
-    entries = db.execute('''
+    entries = RowStream(db, '''
         SELECT * FROM ledger 
         ORDER BY date DESC, id DESC
-    ''').fetchall()
-    return render_template('ledger.html', entries=entries)
+    ''')
+    # the newest entry's balance, known before the rows are streamed
+    latest = db.execute('SELECT balance FROM ledger ORDER BY date DESC, id DESC LIMIT 1').fetchone()
+    return stream_page('ledger.html', entries=entries,
+                       current_balance=latest['balance'] if latest else None)
 
 @app.route('/ledger/add', methods=['GET', 'POST'])
 @login_required
@@ -1912,19 +5079,9 @@ def ledger_add():
         qty_out = request.form.get('qty_out', 0) or 0
         amount = request.form.get('amount', 0) or 0
         
-        db = get_db()
-        
-        # Calculate new balance based on previous balance
-        last_entry = db.execute('SELECT balance FROM ledger ORDER BY date DESC, id DESC LIMIT 1').fetchone()
-        previous_balance = last_entry['balance'] if last_entry else 0
-        new_balance = previous_balance + float(amount)
-        
-        # Insert new entry
-        db.execute('''
-            INSERT INTO ledger (date, description, qty_in, qty_out, amount, balance, created_by)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (date, description, int(qty_in), int(qty_out), float(amount), new_balance, current_user.username))
-        db.commit()
+        # the balance read and the insert run in one transaction
+        run_write('add_ledger_entry', date=date, description=description, qty_in=qty_in, qty_out=qty_out,
+                  amount=float(amount), user=current_user.username)
         
         flash('Ledger entry added successfully', 'success')
         return redirect(url_for('ledger'))
@@ -2020,23 +5177,21 @@ def ping():
 @login_required
 @admin_required
 def admin_health():
-    db = get_db()
-    status = {"ok": True}
     checks = {
-        "products": "SELECT COUNT(*) as c FROM products",
-        "customers": "SELECT COUNT(*) as c FROM customers",
-        "sales": "SELECT COUNT(*) as c FROM sales",
-        "payments": "SELECT COUNT(*) as c FROM payments",
-        "raw_materials": "SELECT COUNT(*) as c FROM raw_materials"
+        "products": "total_products",
+        "customers": "total_customers",
+        "sales": "total_sales",
+        "payments": "total_payments",
+        "raw_materials": "total_raw_materials",
     }
-    for key, sql in checks.items():
-        try:
-            row = db.execute(sql).fetchone()
-            status[key] = int(row['c']) if row else 0
-        except Exception as e:
+    stats = get_dashboard_data(checks.values())
+    status = {"ok": not stats['errors']}
+    for key, counter in checks.items():
+        if counter in stats['errors']:
             status[key] = None
-            status.setdefault('errors', {})[key] = str(e)
-            status['ok'] = False
+            status.setdefault('errors', {})[key] = stats['errors'][counter]
+        else:
+            status[key] = stats[counter]
     return jsonify(status), (200 if status.get('ok') else 500)
 
 # Minimal admin-only endpoint to isolate decorator/auth vs DB/template issues
@@ -0,0 +1,166 @@
+"""
+Static asset pipeline: content-hashed file names and precompressed variants.
+
+build_assets() copies every file under static/ into static/build/ as
+<name>.<hash><ext>, writes .gz
+(and .br when the optional `brotli` package is installed) next to text
+assets, and records the mapping in static/build/manifest.json. The app
+rewrites url_for('static', filename=...) through that manifest, so a
+changed file gets a new URL and everything under /static/build/ can be
+cached forever.
+
+Rebuilding is incremental: unchanged sources keep their hashed files, and
+every write goes through a temp file + rename so several gunicorn workers
+can build at startup at the same time.
+
+Usage:
+    python assets.py [--static static] [--nginx deploy/nginx_static_assets.conf]
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+try:
+    import brotli
+except ImportError:  # optional: gzip variants are still produced
+    brotli = None
+
+BUILD_DIR = 'build'
+MANIFEST = 'manifest.json'
+HASH_LENGTH = 12
+# binary formats are already compressed; precompressing them only wastes disk
+COMPRESSIBLE = {'.css', '.js', '.svg', '.json', '.txt', '.html', '.map', '.xml', '.ico'}
+MIN_COMPRESS_BYTES = 256
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def hashed_name(rel_path, digest):
+    stem, ext = os.path.splitext(rel_path)
+    return f'{stem}.{digest[:HASH_LENGTH]}{ext}'
+
+
+def _atomic_write(path, data):
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _copy(src, dst):
+    # a copy, never a hard link: editors that save in place would otherwise
+    # rewrite the fingerprinted file (and every cached URL to it) as well
+    tmp = f'{dst}.{os.getpid()}.tmp'
+    shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+def _sources(static_dir):
+    for root, dirs, files in os.walk(static_dir):
+        if os.path.abspath(root) == os.path.abspath(static_dir):
+            dirs[:] = [d for d in dirs if d != BUILD_DIR]
+        for name in sorted(files):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(root, name)
+            yield os.path.relpath(path, static_dir).replace(os.sep, '/'), path
+
+
+def load_manifest(static_dir):
+    """Return {source name: hashed name} from the last build, or {}."""
+    try:
+        with open(os.path.join(static_dir, BUILD_DIR, MANIFEST), encoding='utf-8') as f:
+            return json.load(f).get('files', {})
+    except (OSError, ValueError):
+        return {}
+
+
+def build_assets(static_dir, compress=True):
+    """Fingerprint and precompress everything under static_dir. Returns the
+    {source name: hashed name} manifest (names relative to static_dir)."""
+    build_root = os.path.join(static_dir, BUILD_DIR)
+    os.makedirs(build_root, exist_ok=True)
+    files = {}
+    for rel, path in _sources(static_dir):
+        name = hashed_name(rel, file_digest(path))
+        target = os.path.join(build_root, name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # builds before copies were used left hard links behind; break them
+        if not os.path.exists(target) or os.path.samefile(path, target):
+            _copy(path, target)
+        ext = os.path.splitext(rel)[1].lower()
+        if compress and ext in COMPRESSIBLE and os.path.getsize(path) >= MIN_COMPRESS_BYTES:
+            data = None
+            if not os.path.exists(target + '.gz'):
+                with open(path, 'rb') as f:
+                    data = f.read()
+                # mtime=0 keeps the .gz byte-identical between builds
+                _atomic_write(target + '.gz', gzip.compress(data, compresslevel=9, mtime=0))
+            if brotli is not None and not os.path.exists(target + '.br'):
+                if data is None:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                _atomic_write(target + '.br', brotli.compress(data, quality=11))
+        files[rel] = f'{BUILD_DIR}/{name}'
+    if files != load_manifest(static_dir):
+        _atomic_write(os.path.join(build_root, MANIFEST),
+                      json.dumps({'files': files}, indent=2, sort_keys=True).encode('utf-8'))
+    return files
+
+
+def nginx_snippet(static_root):
+    """nginx locations serving the built assets straight from disk:
+    precompressed variants via gzip_static and immutable caching."""
+    static_root = static_root.rstrip('/') + '/'
+    return f'''# Generated by assets.py -- fingerprinted static assets
+# Hashed names change with their content, so they can be cached forever.
+location /static/{BUILD_DIR}/ {{
+    alias {static_root}{BUILD_DIR}/;
+    gzip_static on;
+    # brotli_static on;  # needs ngx_brotli; assets.py writes .br when `brotli` is installed
+    add_header Cache-Control "public, max-age={IMMUTABLE_MAX_AGE}, immutable";
+    add_header Vary Accept-Encoding;
+    access_log off;
+}}
+
+# Unhashed names (old links, direct references): short cache, revalidate.
+location /static/ {{
+    alias {static_root};
+    gzip_static on;
+    expires 1h;
+}}
+'''
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--static', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'))
+    parser.add_argument('--nginx', help='also write the nginx location snippet to this file')
+    parser.add_argument('--static-root', default='/opt/sam_blocks_inventory/static/',
+                        help='static/ path as nginx sees it (for --nginx)')
+    args = parser.parse_args()
+    files = build_assets(args.static)
+    for src, dst in sorted(files.items()):
+        print(f'{src} -> {dst}')
+    if brotli is None:
+        print('brotli not installed: wrote gzip variants only')
+    if args.nginx:
+        with open(args.nginx, 'w', encoding='utf-8') as f:
+            f.write(nginx_snippet(args.static_root))
+        print(f'nginx snippet written to {args.nginx}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,147 @@
+"""
+Benchmark: order placement latency during a burst of heavy reports
+
+Seeds a temporary SQLite database with a large sales table (so /sales is a
+slow full scan), starts gunicorn with 3 sync workers, then for --seconds runs
+--reporters threads requesting /sales back to back while one thread places
+orders through POST /orders/add. Run once with ADMISSION_CONTROL=0 and once
+with the defaults (heavy: 1 running + 1 queued); reports order latency
+percentiles and how many reports were served or shed (503).
+
+Usage:
+    python benchmarks/bench_admission.py [--sales 300000] [--reporters 6] [--seconds 10]
+"""
+import argparse
+import http.client
+import os
+import shutil
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def seed(path, sales):
+    os.environ['FORCE_SQLITE'] = '1'
+    import app as app_module
+    from werkzeug.security import generate_password_hash
+    app_module.app.config['DATABASE'] = path
+    with app_module.app.app_context():
+        app_module.init_db()
+        db = app_module.get_db()
+        db.execute("DELETE FROM users")
+        db.execute("INSERT INTO users (username, email, password, role) VALUES (?, ?, ?, ?)",
+                   ('bench', 'bench@example.com', generate_password_hash('bench'), 'admin'))
+        db.execute("DELETE FROM products")
+        db.execute("INSERT INTO customers (id, name, email, password) VALUES (1, 'Bench', 'bench-c@example.com', 'x')")
+        db.execute("INSERT INTO products (id, name, price, qty, reorder_level) VALUES (1, 'Block', 100, 10000000, 0)")
+        db.executemany("INSERT INTO sales (product_id, qty, amount, sale_date) VALUES (1, 1, ?, ?)",
+                       [(100 + i % 50, f'20{20 + i % 6}-{1 + i % 12:02d}-{1 + i % 28:02d}') for i in range(sales)])
+        db.commit()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def request(port, method, path, cookie=None, body=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+    headers = {'Cookie': cookie} if cookie else {}
+    if body:
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+    started = time.perf_counter()
+    conn.request(method, path, body=body, headers=headers)
+    resp = conn.getresponse()
+    resp.read()
+    conn.close()
+    return resp, time.perf_counter() - started
+
+
+def run_mode(db_path, enabled, args, tmpdir):
+    port = free_port()
+    env = dict(os.environ, FORCE_SQLITE='1', ADMISSION_CONTROL='1' if enabled else '0',
+               ADMISSION_LOCK_DIR=os.path.join(tmpdir, f'locks-{int(enabled)}'), RATE_LIMIT_ENABLED='0',
+               SAM_BENCH_DB=db_path)
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '--workers', '3', '--timeout', '120',
+                               '--bind', f'127.0.0.1:{port}', 'benchmarks.bench_admission:app'],
+                              cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for _ in range(200):
+            try:
+                resp, _ = request(port, 'POST', '/login', body='username=bench&password=bench')
+                break
+            except OSError:
+                time.sleep(0.1)
+        cookie = resp.getheader('Set-Cookie').split(';', 1)[0]
+        stop = time.monotonic() + args.seconds
+        reports = {'served': 0, 'shed': 0}
+        latencies = []
+
+        def reporter():
+            while time.monotonic() < stop:
+                resp, _ = request(port, 'GET', '/sales', cookie)
+                reports['served' if resp.status == 200 else 'shed'] += 1
+                if resp.status == 503:
+                    time.sleep(0.2)
+
+        def orderer():
+            time.sleep(0.5)
+            while time.monotonic() < stop:
+                resp, elapsed = request(port, 'POST', '/orders/add', cookie,
+                                        'customer_id=1&product_id=1&qty=1&account_number=REF')
+                assert resp.status == 302, resp.status
+                latencies.append(elapsed)
+                time.sleep(0.1)
+
+        threads = [threading.Thread(target=reporter) for _ in range(args.reporters)]
+        threads.append(threading.Thread(target=orderer))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        latencies.sort()
+        return latencies, reports
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sales', type=int, default=300000)
+    parser.add_argument('--reporters', type=int, default=6)
+    parser.add_argument('--seconds', type=float, default=10)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        db_path = os.path.join(tmpdir, 'bench.db')
+        seed(db_path, args.sales)
+        print(f'{args.sales} sales rows, {args.reporters} report clients, 3 sync workers, {args.seconds:g}s\n')
+        print(f"{'admission':10} {'orders':>6} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8} {'reports':>8} {'shed':>6}")
+        for enabled in (False, True):
+            lat, reports = run_mode(db_path, enabled, args, tmpdir)
+            p95 = lat[min(len(lat) - 1, int(len(lat) * 0.95))]
+            print(f"{'on' if enabled else 'off':10} {len(lat):6d} {statistics.median(lat) * 1000:8.0f} "
+                  f"{p95 * 1000:8.0f} {lat[-1] * 1000:8.0f} {reports['served']:8d} {reports['shed']:6d}")
+    finally:
+        shutil.rmtree(tmpdir)
+    return 0
+
+
+if 'SAM_BENCH_DB' in os.environ and __name__ != '__main__':
+    # imported by gunicorn as benchmarks.bench_admission:app
+    from app import app
+    app.config['DATABASE'] = os.environ['SAM_BENCH_DB']
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,73 @@
+"""
+Benchmark: /products throughput with and without the catalogue cache
+
+Builds a temporary SQLite database with a synthetic catalogue (default 300
+products) and drives /products through the Flask test client as an anonymous
+visitor in three modes:
+
+    uncached  CATALOGUE_CACHE off: query + full template render every hit
+    cached    cached body served as a 200 (first visit, or after max-age)
+    304       revalidation with If-None-Match, as nginx/browsers do
+
+Usage:
+    python benchmarks/bench_catalogue.py [--products 300] [--requests 2000]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def run(client, n, headers=None, expect=200):
+    started = time.perf_counter()
+    for _ in range(n):
+        rv = client.get('/products', headers=headers or {})
+        assert rv.status_code == expect, rv.status_code
+    return n / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--products', type=int, default=300)
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    os.environ['FORCE_SQLITE'] = '1'
+    import app as app_module
+    app = app_module.app
+    app.config['DATABASE'] = os.path.join(tmpdir, 'bench.db')
+    try:
+        with app.app_context():
+            app_module.init_db()
+            db = app_module.get_db()
+            db.executemany("INSERT INTO products (name, description, size, price, qty, reorder_level) VALUES (?, ?, ?, ?, ?, ?)",
+                           [(f'Block {i}', f'Interlocking paver, pattern {i % 12}', f'{4 + i % 6} inch', 250 + i, 100, 10)
+                            for i in range(args.products)])
+            db.commit()
+        client = app.test_client()
+        body_kb = len(client.get('/products').data) / 1024
+
+        app.config['CATALOGUE_CACHE'] = False
+        run(client, 50)
+        uncached = run(client, args.requests)
+        app.config['CATALOGUE_CACHE'] = True
+        etag = client.get('/products').headers['ETag']
+        cached = run(client, args.requests)
+        revalidated = run(client, args.requests, {'If-None-Match': etag}, expect=304)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print(f'{args.products} products, {body_kb:.0f} KB page, {args.requests} requests per mode\n')
+    print(f"{'mode':10} {'req/s':>8} {'speedup':>8}")
+    for name, rate in (('uncached', uncached), ('cached', cached), ('304', revalidated)):
+        print(f'{name:10} {rate:8.0f} {rate / uncached:7.1f}x')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,117 @@
+"""
+Benchmark: response size and time-to-last-byte with and without compression
+
+Seeds a temporary SQLite database with 500 rows each of orders, payments,
+ledger entries and product audit records, serves the app on a local socket
+and fetches the large admin pages (and the streamed products CSV export)
+with and without `Accept-Encoding: gzip`.
+
+Reports bytes on the wire, the measured time-to-last-byte on localhost (the
+server-side cost of compressing) and a modelled time-to-last-byte on a slow
+link: measured time + wire bytes / bandwidth.
+
+Usage:
+    python benchmarks/bench_compression.py [--rows 500] [--repeat 20] [--mbit 2]
+"""
+import argparse
+import http.client
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PAGES = ['/orders', '/payments', '/ledger', '/admin/audit', '/admin/products', '/admin/products/export']
+
+
+def seed(app_module, rows):
+    from werkzeug.security import generate_password_hash
+    with app_module.app.app_context():
+        app_module.init_db()
+        db = app_module.get_db()
+        db.execute("DELETE FROM users")
+        db.execute("INSERT INTO users (username, email, password, role) VALUES (?, ?, ?, ?)",
+                   ('bench', 'bench@example.com', generate_password_hash('bench'), 'admin'))
+        db.executemany("INSERT INTO customers (name, email, password) VALUES (?, ?, 'x')",
+                       [(f'Customer {i}', f'c{i}@example.com') for i in range(50)])
+        db.executemany("INSERT INTO products (name, description, size, price, qty, reorder_level) VALUES (?, ?, ?, ?, ?, ?)",
+                       [(f'Block {i}', 'Interlocking paver', '6 inch', 300 + i, 40, 5) for i in range(rows)])
+        db.executemany("INSERT INTO orders (customer_id, order_date, status, total) VALUES (?, ?, ?, ?)",
+                       [(1 + i % 50, f'2024-{1 + i % 12:02d}-{1 + i % 28:02d} 10:00:00', 'Pending', 1500 + i) for i in range(rows)])
+        db.executemany("INSERT INTO payments (order_id, amount, date_paid, status) VALUES (?, ?, ?, ?)",
+                       [(1 + i, 1500 + i, f'2024-{1 + i % 12:02d}-{1 + i % 28:02d} 11:00:00', 'Paid') for i in range(rows)])
+        db.executemany("INSERT INTO ledger (date, description, qty_in, qty_out, amount, balance, created_by) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       [(f'2024-{1 + i % 12:02d}-{1 + i % 28:02d}', f'Delivery {i} to site', 0, 20, 6000, 100000 - i, 'bench')
+                        for i in range(rows)])
+        db.executemany("INSERT INTO product_audit (product_id, user, action, field, old_value, new_value, reason) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       [(1 + i % 20, 'bench', 'update', 'qty', str(i), str(i + 5), 'count') for i in range(rows)])
+        db.commit()
+
+
+def fetch(port, path, cookie, encoding):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    headers = {'Cookie': cookie}
+    if encoding:
+        headers['Accept-Encoding'] = encoding
+    started = time.perf_counter()
+    conn.request('GET', path, headers=headers)
+    resp = conn.getresponse()
+    body = resp.read()
+    elapsed = time.perf_counter() - started
+    conn.close()
+    assert resp.status == 200, (path, resp.status)
+    return len(body), elapsed, resp.getheader('Content-Encoding')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--mbit', type=float, default=2.0, help='modelled link speed for TTLB')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    os.environ['FORCE_SQLITE'] = '1'
+    import app as app_module
+    from werkzeug.serving import make_server
+    app_module.app.config['DATABASE'] = os.path.join(tmpdir, 'bench.db')
+    try:
+        seed(app_module, args.rows)
+        server = make_server('127.0.0.1', 0, app_module.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        port = server.server_port
+
+        conn = http.client.HTTPConnection('127.0.0.1', port)
+        conn.request('POST', '/login', body='username=bench&password=bench',
+                     headers={'Content-Type': 'application/x-www-form-urlencoded'})
+        resp = conn.getresponse()
+        resp.read()
+        cookie = resp.getheader('Set-Cookie').split(';', 1)[0]
+
+        bytes_per_s = args.mbit * 1e6 / 8
+        print(f'{args.rows} rows per table, median of {args.repeat}, modelled link {args.mbit:g} Mbit/s\n')
+        print(f"{'page':24} {'identity KB':>11} {'gzip KB':>8} {'ratio':>6} "
+              f"{'local ms id/gz':>15} {'TTLB ms id/gz':>15}")
+        for path in PAGES:
+            results = {}
+            for encoding in (None, 'gzip'):
+                runs = [fetch(port, path, cookie, encoding) for _ in range(args.repeat)]
+                size = runs[-1][0]
+                assert (runs[-1][2] == 'gzip') == bool(encoding), path
+                local = statistics.median(r[1] for r in runs)
+                results[encoding] = (size, local, local + size / bytes_per_s)
+            (s0, l0, t0), (s1, l1, t1) = results[None], results['gzip']
+            print(f'{path:24} {s0 / 1024:11.1f} {s1 / 1024:8.1f} {s0 / s1:5.1f}x '
+                  f'{l0 * 1000:7.1f}/{l1 * 1000:<7.1f} {t0 * 1000:7.0f}/{t1 * 1000:<7.0f}')
+        server.shutdown()
+    finally:
+        shutil.rmtree(tmpdir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
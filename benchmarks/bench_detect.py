@@ -0,0 +1,107 @@
+"""
+Benchmark: CPU block detection latency and throughput
+
+Times ai_detection against the deployed model (models/block_detector.pt or
+$BLOCK_DETECTOR_MODEL): cold model load, single-image latency (p50/p95) and
+images/second when the same images go through one batched forward pass at
+several batch sizes, plus concurrent requests through the bounded pool.
+
+Needs ultralytics + a trained model. Uses photos from --images if given,
+otherwise synthetic 1280x960 JPEGs (fine for timing, not for counts).
+
+Usage:
+    python benchmarks/bench_detect.py [--images block_dataset/images] [--runs 20] [--batches 1,4,8,16]
+"""
+import argparse
+import io
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import ai_detection  # noqa: E402
+
+
+def load_blobs(folder, count):
+    if folder:
+        paths = sorted(Path(folder).glob('*.jpg'))[:count]
+        if paths:
+            return [p.read_bytes() for p in paths]
+    from PIL import Image
+    rng = np.random.default_rng(3)
+    blobs = []
+    for _ in range(count):
+        buf = io.BytesIO()
+        Image.fromarray(rng.integers(0, 255, (960, 1280, 3), dtype=np.uint8)).save(buf, 'JPEG', quality=85)
+        blobs.append(buf.getvalue())
+    return blobs
+
+
+def percentile(values, pct):
+    return sorted(values)[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', help='folder of .jpg photos to use')
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--batches', default='1,4,8,16')
+    parser.add_argument('--concurrency', type=int, default=4)
+    args = parser.parse_args()
+    batch_sizes = [int(b) for b in args.batches.split(',')]
+
+    try:
+        started = time.perf_counter()
+        ai_detection.get_model()
+    except ai_detection.DetectorUnavailable as e:
+        print(f'Cannot benchmark: {e}')
+        return 1
+    print(f'Model load: {(time.perf_counter() - started) * 1000:.0f} ms '
+          f'(backend={ai_detection.get_model().name}, threads={ai_detection.INTRA_OP_THREADS}, imgsz={ai_detection.IMAGE_SIZE})')
+
+    blobs = load_blobs(args.images, max(batch_sizes))
+    images = ai_detection.decode_images(blobs)
+    ai_detection.predict(images[:1])  # warm-up
+
+    latencies = []
+    for i in range(args.runs):
+        t = time.perf_counter()
+        ai_detection.predict([images[i % len(images)]])
+        latencies.append((time.perf_counter() - t) * 1000)
+    print(f'Single image: p50 {statistics.median(latencies):.0f} ms, p95 {percentile(latencies, 95):.0f} ms')
+
+    for size in batch_sizes:
+        batch = (images * size)[:size]
+        t = time.perf_counter()
+        ai_detection.predict(batch)
+        elapsed = time.perf_counter() - t
+        print(f'Batch {size:3d}: {elapsed * 1000:7.0f} ms  {size / elapsed:6.1f} images/s')
+
+    # concurrent callers through the bounded pool, as the web workers would
+    per_request = blobs[:4]
+    busy = 0
+
+    def call(_):
+        nonlocal busy
+        try:
+            ai_detection.detect(per_request)
+        except ai_detection.DetectorBusy:
+            busy += 1
+
+    t = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        list(pool.map(call, range(args.runs)))
+    elapsed = time.perf_counter() - t
+    done = args.runs - busy
+    print(f'{args.concurrency} concurrent callers: {done * len(per_request) / elapsed:.1f} images/s, '
+          f'{busy} of {args.runs} requests refused as busy')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
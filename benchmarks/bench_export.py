@@ -0,0 +1,122 @@
+"""
+Benchmark: PyTorch vs ONNX vs INT8 ONNX block counting on CPU
+
+Runs each deployed model variant in its own subprocess (so peak RSS covers
+only that backend's imports and weights) over every photo in
+block_dataset/images and reports per-image latency, peak RSS and count
+accuracy. Ground truth is the number of boxes in block_dataset/labels/<name>.txt;
+images without a label file are compared against the .pt model's count.
+
+Variants whose file is missing are skipped:
+    pt    models/block_detector.pt        (ultralytics + torch)
+    onnx  models/block_detector.onnx      (onnxruntime)
+    int8  models/block_detector.int8.onnx (onnxruntime)
+
+Usage:
+    python benchmarks/bench_export.py [--data-root block_dataset] [--threads 2] [--limit 0]
+"""
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VARIANTS = {
+    'pt': ('torch', os.path.join(ROOT, 'models', 'block_detector.pt')),
+    'onnx': ('onnx', os.path.join(ROOT, 'models', 'block_detector.onnx')),
+    'int8': ('onnx', os.path.join(ROOT, 'models', 'block_detector.int8.onnx')),
+}
+
+
+def run_child(variant, images):
+    """Measure one variant in this process and print a JSON result line."""
+    sys.path.insert(0, ROOT)
+    import ai_detection
+
+    started = time.perf_counter()
+    ai_detection.get_model()
+    load_ms = (time.perf_counter() - started) * 1000
+    latencies, counts = [], {}
+    for i, path in enumerate(images):
+        decoded = ai_detection.decode_images([Path(path).read_bytes()])
+        t = time.perf_counter()
+        result = ai_detection.predict(decoded)[0]
+        if i:  # the first call includes one-off graph setup
+            latencies.append((time.perf_counter() - t) * 1000)
+        counts[Path(path).stem] = result['count']
+    print(json.dumps({
+        'variant': variant,
+        'load_ms': load_ms,
+        'latencies': latencies,
+        'counts': counts,
+        # kilobytes on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }))
+
+
+def label_counts(data_root):
+    labels = Path(data_root) / 'labels'
+    return {p.stem: sum(1 for line in p.read_text().splitlines() if line.strip())
+            for p in labels.glob('*.txt') if p.stem != 'classes'}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data-root', default=os.path.join(ROOT, 'block_dataset'))
+    parser.add_argument('--threads', type=int, default=2, help='intra-op threads for every backend')
+    parser.add_argument('--limit', type=int, default=0, help='only use the first N images')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    images = sorted(str(p) for p in (Path(args.data_root) / 'images').glob('*.jpg'))
+    if args.limit:
+        images = images[:args.limit]
+    if args.child:
+        run_child(args.child, images)
+        return 0
+    if not images:
+        print(f'No images found under {args.data_root}/images')
+        return 1
+
+    results = {}
+    for variant, (backend, path) in VARIANTS.items():
+        if not os.path.exists(path):
+            print(f'{variant:5} skipped: {path} not found')
+            continue
+        env = dict(os.environ, AI_BACKEND=backend, AI_INTRA_OP_THREADS=str(args.threads))
+        env['BLOCK_DETECTOR_MODEL' if backend == 'torch' else 'BLOCK_DETECTOR_ONNX'] = path
+        cmd = [sys.executable, __file__, '--child', variant, '--data-root', args.data_root, '--limit', str(args.limit)]
+        proc = subprocess.run(cmd, env=env, capture_output=True, text=True)
+        if proc.returncode:
+            print(f'{variant:5} failed:\n{proc.stderr.strip()[-2000:]}')
+            continue
+        results[variant] = json.loads(proc.stdout.strip().splitlines()[-1])
+    if not results:
+        return 1
+
+    truth = label_counts(args.data_root)
+    reference = results.get('pt', {}).get('counts', {})
+    print(f'\n{len(images)} images, {args.threads} intra-op threads, '
+          f'{sum(1 for p in images if Path(p).stem in truth)} with labels\n')
+    print(f"{'variant':8} {'load ms':>8} {'p50 ms':>8} {'p95 ms':>8} {'peak RSS MB':>12} {'MAE':>6} {'exact %':>8}")
+    for variant, r in results.items():
+        lat = sorted(r['latencies']) or [0.0]
+        errors = []
+        for stem, count in r['counts'].items():
+            expected = truth.get(stem, reference.get(stem))
+            if expected is not None:
+                errors.append(abs(count - expected))
+        mae = statistics.mean(errors) if errors else float('nan')
+        exact = 100 * sum(1 for e in errors if e == 0) / len(errors) if errors else float('nan')
+        print(f"{variant:8} {r['load_ms']:8.0f} {statistics.median(lat):8.1f} {lat[int(len(lat) * 0.95) - 1 if len(lat) > 1 else 0]:8.1f} "
+              f"{r['peak_rss_mb']:12.0f} {mae:6.2f} {exact:8.1f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
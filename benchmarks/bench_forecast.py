@@ -0,0 +1,84 @@
+"""
+Benchmark: catalogue-wide demand forecast
+
+Builds a synthetic SQLite sales history (default 1,000 products x 3 years)
+and times the two phases of forecasting.forecast_catalogue separately:
+loading the (products x days) matrix with one query, and the vectorized
+forecast itself.
+
+Usage:
+    python benchmarks/bench_forecast.py [--products 1000] [--days 1095] [--density 0.3]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import forecasting  # noqa: E402
+
+
+def build_db(n_products, n_days, density, seed=7):
+    rng = np.random.default_rng(seed)
+    db = sqlite3.connect(':memory:')
+    db.row_factory = sqlite3.Row
+    db.execute('CREATE TABLE products (id INTEGER PRIMARY KEY, name TEXT, qty INTEGER, reorder_level INTEGER)')
+    db.execute('CREATE TABLE sales (id INTEGER PRIMARY KEY, sale_date TEXT, amount REAL, product_id INTEGER, qty INTEGER)')
+    db.executemany('INSERT INTO products VALUES (?, ?, 0, 0)', [(i, f'P{i}') for i in range(1, n_products + 1)])
+    end = datetime.utcnow().date()
+    start = end - timedelta(days=n_days - 1)
+    days = [(start + timedelta(days=d)).isoformat() for d in range(n_days)]
+    base = rng.gamma(2.0, 20.0, n_products)
+    weekly = np.array([1.1, 1.0, 1.0, 1.0, 1.2, 1.4, 0.3])
+    rows = []
+    for d, day in enumerate(days):
+        active = np.nonzero(rng.random(n_products) < density)[0]
+        wd = (start + timedelta(days=d)).weekday()
+        qty = rng.poisson(base[active] * weekly[wd])
+        rows.extend((day, 0.0, int(p) + 1, int(q)) for p, q in zip(active, qty))
+    db.executemany('INSERT INTO sales (sale_date, amount, product_id, qty) VALUES (?, ?, ?, ?)', rows)
+    db.commit()
+    return db, len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the demand forecast')
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--days', type=int, default=3 * 365)
+    parser.add_argument('--density', type=float, default=0.3, help='Fraction of products selling on a given day')
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    db, n_rows = build_db(args.products, args.days, args.density)
+    print(f"Built {n_rows:,} sales rows in {time.perf_counter() - t0:.1f}s")
+
+    t0 = time.perf_counter()
+    _, start, matrix = forecasting.load_daily_sales(db, days=args.days)
+    load_s = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    forecasting.forecast_matrix(matrix, start)
+    compute_s = time.perf_counter() - t0
+
+    forecasting.clear_cache()
+    t0 = time.perf_counter()
+    forecasting.forecast_catalogue(db, days=args.days)
+    total_s = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    forecasting.forecast_catalogue(db, days=args.days)
+    cached_s = time.perf_counter() - t0
+
+    print(f"Matrix {matrix.shape[0]} x {matrix.shape[1]}")
+    print(f"  load (1 query):     {load_s * 1000:8.1f} ms")
+    print(f"  forecast (NumPy):   {compute_s * 1000:8.1f} ms")
+    print(f"  end to end:         {total_s * 1000:8.1f} ms")
+    print(f"  cached repeat:      {cached_s * 1000:8.3f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Benchmark: order latency while reports scan the live database vs a snapshot
+
+Seeds a temporary SQLite database (rollback-journal mode, the default) with a
+large sales table, then for --seconds runs --reporters threads requesting
+/sales back to back while one thread places orders through the Flask test
+client, first with reports on the live file and then with REPORT_SNAPSHOT=1.
+A long report read holds a shared lock that stops order commits; against the
+snapshot the two never touch the same file.
+
+Usage:
+    python benchmarks/bench_report_snapshot.py [--sales 300000] [--reporters 2] [--seconds 8]
+"""
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def seed(app_module, sales):
+    from werkzeug.security import generate_password_hash
+    with app_module.app.app_context():
+        app_module.init_db()
+        db = app_module.get_db()
+        db.execute("DELETE FROM users")
+        db.execute("INSERT INTO users (username, email, password, role) VALUES (?, ?, ?, ?)",
+                   ('bench', 'bench@example.com', generate_password_hash('bench'), 'admin'))
+        db.execute("DELETE FROM products")
+        db.execute("INSERT INTO customers (id, name, email, password) VALUES (1, 'Bench', 'bench-c@example.com', 'x')")
+        db.execute("INSERT INTO products (id, name, price, qty, reorder_level) VALUES (1, 'Block', 100, 10000000, 0)")
+        db.executemany("INSERT INTO sales (product_id, qty, amount, sale_date) VALUES (1, 1, ?, ?)",
+                       [(100 + i % 50, f'20{20 + i % 6}-{1 + i % 12:02d}-{1 + i % 28:02d}') for i in range(sales)])
+        db.commit()
+
+
+def run(app_module, args):
+    stop = time.monotonic() + args.seconds
+    latencies, reports = [], [0]
+
+    def login():
+        client = app_module.app.test_client()
+        client.post('/login', data={'username': 'bench', 'password': 'bench'})
+        return client
+
+    def reporter():
+        client = login()
+        while time.monotonic() < stop:
+            assert client.get('/sales').status_code == 200
+            reports[0] += 1
+
+    def orderer():
+        client = login()
+        time.sleep(0.3)
+        while time.monotonic() < stop:
+            started = time.perf_counter()
+            resp = client.post('/orders/add', data={'customer_id': '1', 'product_id': '1', 'qty': '1',
+                                                    'account_number': 'REF'})
+            assert resp.status_code == 302, resp.status_code
+            latencies.append(time.perf_counter() - started)
+            time.sleep(0.05)
+
+    threads = [threading.Thread(target=reporter) for _ in range(args.reporters)] + [threading.Thread(target=orderer)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    latencies.sort()
+    return latencies, reports[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sales', type=int, default=300000)
+    parser.add_argument('--reporters', type=int, default=2)
+    parser.add_argument('--seconds', type=float, default=8)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    os.environ['FORCE_SQLITE'] = '1'
+    import app as app_module
+    app = app_module.app
+    app.config['DATABASE'] = os.path.join(tmpdir, 'bench.db')
+    app.config['ADMISSION_CONTROL'] = False
+    app.config['RATE_LIMIT_ENABLED'] = False
+    try:
+        seed(app_module, args.sales)
+        print(f'{args.sales} sales rows, {args.reporters} report clients, {args.seconds:g}s\n')
+        print(f"{'reports on':11} {'orders':>6} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8} {'reports':>8}")
+        for snapshot in (False, True):
+            app.config['REPORT_SNAPSHOT'] = snapshot
+            if snapshot:
+                app_module.refresh_report_snapshot(force=True)
+            lat, reports = run(app_module, args)
+            p95 = lat[min(len(lat) - 1, int(len(lat) * 0.95))]
+            print(f"{'snapshot' if snapshot else 'live':11} {len(lat):6d} {statistics.median(lat) * 1000:8.1f} "
+                  f"{p95 * 1000:8.1f} {lat[-1] * 1000:8.1f} {reports:8d}")
+    finally:
+        shutil.rmtree(tmpdir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
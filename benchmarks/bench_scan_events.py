@@ -0,0 +1,85 @@
+"""
+Benchmark: /api/v1/scan-events ingestion throughput on one worker
+
+Creates a temporary SQLite database with a catalogue of products and posts
+synthetic yard scans (loadouts, breakages, production, receipts) as JSON
+lines through the Flask test client, in requests of --batch events. Reports
+events/sec for fresh events and for a full resend (all duplicates), split
+into parse+validate and apply time.
+
+Usage:
+    python benchmarks/bench_scan_events.py [--events 50000] [--batch 2000] [--products 40]
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=50000)
+    parser.add_argument('--batch', type=int, default=2000)
+    parser.add_argument('--products', type=int, default=40)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    os.environ['FORCE_SQLITE'] = '1'
+    import app as app_module
+    from werkzeug.security import generate_password_hash
+    app = app_module.app
+    app.config['DATABASE'] = os.path.join(tmpdir, 'bench.db')
+    try:
+        with app.app_context():
+            app_module.init_db()
+            db = app_module.get_db()
+            db.execute("DELETE FROM users")
+            db.execute("INSERT INTO users (username, email, password, role) VALUES ('bench', 'b@example.com', ?, 'admin')",
+                       (generate_password_hash('bench'),))
+            db.executemany("INSERT INTO products (name, price, qty, reorder_level) VALUES (?, 300, 1000000, 10)",
+                           [(f'Block {i}',) for i in range(args.products)])
+            db.commit()
+            pids = [r['id'] for r in db.execute('SELECT id FROM products').fetchall()]
+        rng = random.Random(3)
+        types = ['loadout'] * 6 + ['breakage', 'production', 'production', 'receipt']
+        lines = [json.dumps({'client_event_id': f'tab{i % 8}-{i}', 'type': rng.choice(types),
+                             'product_id': rng.choice(pids), 'qty': rng.randint(1, 500),
+                             'scanned_at': '2024-05-01T09:00:00'}) for i in range(args.events)]
+        bodies = ['\n'.join(lines[i:i + args.batch]) for i in range(0, len(lines), args.batch)]
+
+        client = app.test_client()
+        client.post('/login', data={'username': 'bench', 'password': 'bench'})
+        print(f'{args.events} events, {args.batch} per request, {len(pids)} products\n')
+        print(f"{'pass':10} {'events/s':>9} {'accepted':>9} {'duplicates':>11}")
+        for label in ('fresh', 'resend'):
+            accepted = duplicates = 0
+            started = time.perf_counter()
+            for body in bodies:
+                rv = client.post('/api/v1/scan-events', data=body, content_type='application/x-ndjson')
+                assert rv.status_code == 200, rv.data
+                data = rv.get_json()
+                accepted += data['accepted']
+                duplicates += data['duplicates']
+            elapsed = time.perf_counter() - started
+            print(f'{label:10} {args.events / elapsed:9.0f} {accepted:9d} {duplicates:11d}')
+
+        with app.app_context():
+            db = app_module.get_db()
+            events = [json.loads(line) for line in lines[:args.batch]]
+            t = time.perf_counter()
+            app_module.validate_scan_events(db, [(i, e) for i, e in enumerate(events)])
+            per_event_us = (time.perf_counter() - t) / len(events) * 1e6
+        print(f'\nvalidation alone: {per_event_us:.1f} us/event')
+    finally:
+        shutil.rmtree(tmpdir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,113 @@
+"""
+Benchmark: streamed list pages vs rendering them whole
+
+Seeds a temporary SQLite database with N orders and renders the /orders page
+two ways, for each N:
+
+    whole    what the view used to do: fetchall() the rows, then
+             render_template() the page into one string
+    stream   the /orders view as it is now (stream_page + RowStream)
+
+Reports the peak Python memory allocated while producing the page
+(tracemalloc), the time until the first byte and until the last one, and the
+page size. The streamed page's peak stays flat as N grows; the whole page's
+grows with it (init_db puts the database in WAL mode; a database left in
+rollback-journal mode has its rows read at once and only the rendering
+streams).
+
+Usage:
+    python benchmarks/bench_streaming.py [--rows 1000 10000 50000]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+ORDERS_SQL = """
+    SELECT o.id, o.order_date, o.total, o.status, c.name as customer
+    FROM orders o LEFT JOIN customers c ON o.customer_id = c.id
+    ORDER BY o.order_date DESC
+"""
+
+
+def seed(app_module, rows):
+    from werkzeug.security import generate_password_hash
+    with app_module.app.app_context():
+        app_module.init_db()
+        db = app_module.get_db()
+        db.execute("DELETE FROM users")
+        db.execute("INSERT INTO users (username, email, password, role) VALUES (?, ?, ?, ?)",
+                   ('bench', 'bench@example.com', generate_password_hash('bench'), 'admin'))
+        db.executemany("INSERT INTO customers (name, email, password) VALUES (?, ?, 'x')",
+                       [(f'Customer {i}', f'c{i}@example.com') for i in range(50)])
+        db.executemany("INSERT INTO orders (customer_id, order_date, status, total) VALUES (?, ?, ?, ?)",
+                       [(1 + i % 50, f'2024-{1 + i % 12:02d}-{1 + i % 28:02d} {i % 24:02d}:00:00', 'Pending', 1500 + i)
+                        for i in range(rows)])
+        db.execute("CREATE INDEX IF NOT EXISTS idx_orders_order_date ON orders(order_date)")
+        db.commit()
+
+
+def measure(produce):
+    """Run produce() -> iterable of chunks; return (peak bytes, ttfb, ttlb, size)."""
+    tracemalloc.start()
+    started = time.perf_counter()
+    first = None
+    size = 0
+    for chunk in produce():
+        if first is None and chunk:
+            first = time.perf_counter() - started
+        size += len(chunk)
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak, first, elapsed, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 50000])
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    os.environ['FORCE_SQLITE'] = '1'
+    import app as app_module
+    from flask import render_template
+    app = app_module.app
+    try:
+        print(f"{'rows':>7} {'mode':7} {'peak MB':>8} {'TTFB ms':>8} {'TTLB ms':>8} {'page KB':>8}")
+        for rows in args.rows:
+            app.config['DATABASE'] = os.path.join(tmpdir, f'bench-{rows}.db')
+            seed(app_module, rows)
+            client = app.test_client()
+            client.post('/login', data={'username': 'bench', 'password': 'bench'})
+
+            def whole():
+                with app.test_request_context('/orders'):
+                    db = app_module.get_db()
+                    page = render_template('orders_list.html', orders=db.execute(ORDERS_SQL).fetchall())
+                    app_module.close_db()
+                return [page.encode('utf-8')]
+
+            def stream():
+                resp = client.get('/orders', buffered=False)
+                try:
+                    yield from resp.response
+                finally:
+                    resp.close()
+
+            for mode, produce in (('whole', whole), ('stream', stream)):
+                measure(produce)  # warm up template and page caches
+                peak, ttfb, ttlb, size = measure(produce)
+                print(f'{rows:7d} {mode:7} {peak / 1e6:8.2f} {ttfb * 1000:8.1f} {ttlb * 1000:8.1f} {size / 1024:8.0f}')
+    finally:
+        shutil.rmtree(tmpdir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,118 @@
+"""
+Benchmark: bytes a mobile client transfers per refresh, full pages vs delta sync
+
+Seeds a temporary SQLite database with N products, trips and ledger entries,
+then compares, for a refresh after `--changed` rows were edited and one
+deleted:
+
+    pages    re-downloading /admin/products, /trips and /ledger as HTML
+    full     GET /api/v1/sync?since=0, following pages (a fresh install)
+    delta    GET /api/v1/sync?since=<seq from the previous sync>
+
+and the server time for each.
+
+Usage:
+    python benchmarks/bench_sync.py [--rows 1000] [--changed 10] [--repeat 20]
+"""
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PAGES = ['/admin/products', '/trips', '/ledger']
+
+
+def seed(app_module, rows):
+    from werkzeug.security import generate_password_hash
+    with app_module.app.app_context():
+        app_module.init_db()
+        db = app_module.get_db()
+        db.execute("DELETE FROM users")
+        db.execute("INSERT INTO users (username, email, password, role) VALUES (?, ?, ?, ?)",
+                   ('bench', 'bench@example.com', generate_password_hash('bench'), 'admin'))
+        db.executemany("INSERT INTO products (name, description, size, price, qty, reorder_level) VALUES (?, ?, ?, ?, ?, ?)",
+                       [(f'Block {i}', 'Interlocking paver', '6 inch', 300 + i, 40, 5) for i in range(rows)])
+        db.executemany("INSERT INTO trips (vehicle_no, driver_name, date, amount, note) VALUES (?, ?, ?, ?, ?)",
+                       [(f'KJA{i:03d}', 'Driver', f'2024-{1 + i % 12:02d}-{1 + i % 28:02d}', 5000, 'site run') for i in range(rows)])
+        db.executemany("INSERT INTO ledger (date, description, qty_in, qty_out, amount, balance, created_by) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       [(f'2024-{1 + i % 12:02d}-{1 + i % 28:02d}', f'Delivery {i} to site', 0, 20, 6000, 100000 - i, 'bench')
+                        for i in range(rows)])
+        db.commit()
+
+
+def sync_all(client, since):
+    """Follow 'more' pages to the end; returns (bytes, last seq, last page)."""
+    total = 0
+    while True:
+        resp = client.get(f'/api/v1/sync?since={since}')
+        assert resp.status_code == 200, resp.status_code
+        total += len(resp.data)
+        page = resp.get_json()
+        since = page['seq']
+        if not page['more']:
+            return total, since, page
+
+
+def timed_sync(client, since, repeat):
+    runs = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        size, _, page = sync_all(client, since)
+        runs.append(time.perf_counter() - started)
+    return size, statistics.median(runs), page
+
+
+def timed(client, path, repeat):
+    runs = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        resp = client.get(path)
+        runs.append(time.perf_counter() - started)
+        assert resp.status_code == 200, (path, resp.status_code)
+    return len(resp.data), statistics.median(runs), resp
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--changed', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    os.environ['FORCE_SQLITE'] = '1'
+    import app as app_module
+    app_module.app.config['DATABASE'] = os.path.join(tmpdir, 'bench.db')
+    try:
+        seed(app_module, args.rows)
+        client = app_module.app.test_client()
+        client.post('/login', data={'username': 'bench', 'password': 'bench'})
+        since = sync_all(client, 0)[1]
+        with app_module.app.app_context():
+            db = app_module.get_db()
+            db.execute('UPDATE products SET price = price + 1 WHERE id IN (SELECT id FROM products LIMIT ?)', (args.changed,))
+            db.execute('DELETE FROM trips WHERE id = (SELECT MIN(id) FROM trips)')
+            db.commit()
+
+        print(f'{args.rows} rows per table, {args.changed} products edited + 1 trip deleted, median of {args.repeat}\n')
+        print(f"{'refresh':8} {'KB':>9} {'ms':>8}")
+        pages = [timed(client, p, args.repeat) for p in PAGES]
+        print(f"{'pages':8} {sum(p[0] for p in pages) / 1024:9.1f} {sum(p[1] for p in pages) * 1000:8.1f}")
+        size, elapsed, _ = timed_sync(client, 0, args.repeat)
+        print(f"{'full':8} {size / 1024:9.1f} {elapsed * 1000:8.1f}")
+        size, elapsed, page = timed_sync(client, since, args.repeat)
+        changes = page['changes']
+        assert len(changes['products']['rows']) == args.changed and len(changes['trips']['deleted']) == 1
+        print(f"{'delta':8} {size / 1024:9.1f} {elapsed * 1000:8.1f}")
+    finally:
+        shutil.rmtree(tmpdir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,132 @@
+"""
+Benchmark: concurrent order placement, per-request commits vs group commit
+
+Creates a temporary SQLite database, then starts N worker processes (like
+gunicorn workers), each running T threads that place M orders back to back
+through app.run_write('place_order', ...), and reports orders/sec:
+
+    direct   WRITE_COORDINATOR=off: every order takes the write lock and
+             commits (fsyncs) on its own connection, as today
+    wal      the same, but with the database already in WAL mode (what the
+             coordinator switches it to), to separate WAL's gain from batching
+    socket   WRITE_COORDINATOR=socket: orders go to one writer process that
+             commits whatever has queued up in a single transaction
+
+Usage:
+    python benchmarks/bench_write_coordinator.py [--workers 3] [--threads 4] [--orders 100]
+"""
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def run_child(db_path, threads, orders):
+    os.environ['FORCE_SQLITE'] = '1'
+    import app as app_module
+    app_module.app.config['DATABASE'] = db_path
+    failures = []
+
+    def work():
+        with app_module.app.app_context():
+            for _ in range(orders):
+                try:
+                    app_module.run_write('place_order', customer_id=1, product_id=1, qty=1, user='bench')
+                except Exception as e:
+                    failures.append(type(e).__name__)
+
+    pool = [threading.Thread(target=work) for _ in range(threads)]
+    started = time.time()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    print(json.dumps({'failures': len(failures), 'started': started, 'finished': time.time()}))
+
+
+def setup_db(path, wal):
+    os.environ['FORCE_SQLITE'] = '1'
+    import app as app_module
+    app_module.app.config['DATABASE'] = path
+    with app_module.app.app_context():
+        app_module.init_db()
+        db = app_module.get_db()
+        db.execute('DELETE FROM products')
+        db.execute("INSERT INTO customers (id, name, email, password) VALUES (1, 'Bench', 'bench@example.com', 'x')")
+        db.execute("INSERT INTO products (id, name, price, qty, reorder_level) VALUES (1, 'Block', 100, 10000000, 0)")
+        db.commit()
+    if wal:
+        sqlite3.connect(path).execute('PRAGMA journal_mode=WAL').close()
+    return app_module
+
+
+def run_mode(mode, args, tmpdir):
+    db_path = os.path.join(tmpdir, f'{mode}.db')
+    app_module = setup_db(db_path, wal=(mode == 'wal'))
+    env = dict(os.environ, FORCE_SQLITE='1', WRITE_COORDINATOR='socket' if mode == 'socket' else 'off',
+               WRITE_COORDINATOR_SOCKET=os.path.join(tmpdir, 'writer.sock'))
+    server = None
+    if mode == 'socket':
+        import write_coordinator
+        writer = app_module.make_group_commit_writer()
+        ready = threading.Event()
+        holder = []
+        threading.Thread(target=write_coordinator.serve, daemon=True,
+                         args=(env['WRITE_COORDINATOR_SOCKET'], writer,
+                               lambda s: (holder.append(s), ready.set()))).start()
+        ready.wait(5)
+        server = holder[0]
+    cmd = [sys.executable, __file__, '--child', db_path, '--threads', str(args.threads), '--orders', str(args.orders)]
+    procs = [subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+             for _ in range(args.workers)]
+    results = [json.loads(p.communicate()[0].strip().splitlines()[-1]) for p in procs]
+    failures = sum(r['failures'] for r in results)
+    # write phase only: first worker starting to last one finishing (process
+    # start-up and imports excluded)
+    elapsed = max(r['finished'] for r in results) - min(r['started'] for r in results)
+    if server is not None:
+        server.shutdown()
+        batches = writer.batches
+        writer.close()
+    else:
+        batches = None
+    placed = sqlite3.connect(db_path).execute('SELECT COUNT(*) FROM orders').fetchone()[0]
+    return placed, failures, elapsed, batches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=4, help='concurrent requests per worker')
+    parser.add_argument('--orders', type=int, default=100, help='orders per thread')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        run_child(args.child, args.threads, args.orders)
+        return 0
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        total = args.workers * args.threads * args.orders
+        print(f'{args.workers} workers x {args.threads} threads x {args.orders} orders = {total} orders\n')
+        print(f"{'mode':8} {'orders/s':>9} {'placed':>7} {'failed':>7} {'commits':>8}")
+        for mode in ('direct', 'wal', 'socket'):
+            placed, failures, elapsed, batches = run_mode(mode, args, tmpdir)
+            commits = batches if batches is not None else placed
+            print(f'{mode:8} {placed / elapsed:9.0f} {placed:7d} {failures:7d} {commits:8d}')
+    finally:
+        shutil.rmtree(tmpdir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
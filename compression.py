@@ -0,0 +1,259 @@
+"""
+WSGI response compression (gzip, and brotli when the `brotli` package is
+installed) for deployments without nginx in front -- Railway, Render, Fly.
+
+CompressionMiddleware negotiates an encoding from Accept-Encoding (q-values
+honoured, brotli preferred), then:
+
+* leaves alone responses that are already encoded, partial (206), bodiless
+  (204/304, HEAD), marked Cache-Control: no-transform, Server-Sent Events,
+  or of a content type not in the configured set;
+* compresses sized responses of at least min_size bytes in one go and sets
+  the new Content-Length;
+* compresses unsized (streamed) responses chunk by chunk, so a streamed CSV
+  export still starts arriving before the query finishes and never sits in
+  memory whole. An empty chunk from the app is a flush point: whatever the
+  compressor holds back is sync-flushed to the client there (a streamed page
+  uses this to send its head before it starts reading rows).
+
+Compressed responses get Vary: Accept-Encoding and a weak ETag (the bytes
+differ from the identity representation, but the app's If-None-Match checks
+still match because they compare weakly).
+"""
+import zlib
+
+from werkzeug.http import parse_accept_header
+
+try:
+    import brotli
+except ImportError:  # optional
+    brotli = None
+
+DEFAULT_MIMETYPES = {
+    'text/html': None,
+    'text/css': None,
+    'text/plain': None,
+    'text/csv': None,
+    'text/xml': None,
+    'text/javascript': None,
+    'application/javascript': None,
+    'application/json': None,
+    'application/x-ndjson': None,
+    'application/xml': None,
+    'image/svg+xml': None,
+}
+
+_SKIP_STATUS = {204, 206, 304}
+
+
+def parse_mimetypes(spec):
+    """Parse 'text/html,application/json,text/csv=1' into {mimetype: level};
+    a level after '=' overrides the default for that type (None = default)."""
+    types = {}
+    for item in (spec or '').split(','):
+        item = item.strip().lower()
+        if not item:
+            continue
+        name, _, level = item.partition('=')
+        types[name.strip()] = int(level) if level.strip() else None
+    return types
+
+
+def negotiate(accept_encoding, brotli_available=None):
+    """Return 'br', 'gzip' or None for an Accept-Encoding header value."""
+    if not accept_encoding:
+        return None
+    accept = parse_accept_header(accept_encoding)
+    available = brotli is not None if brotli_available is None else brotli_available
+    for name in (('br', 'gzip') if available else ('gzip',)):
+        if accept[name] > 0:
+            return name
+    return None
+
+
+class _Gzip:
+    def __init__(self, level):
+        self._z = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._z.compress(data)
+
+    def flush(self):
+        return self._z.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._z.flush()
+
+
+class _Brotli:
+    def __init__(self, level):
+        self._c = brotli.Compressor(quality=max(0, min(11, level)))
+
+    def compress(self, data):
+        return self._c.process(data)
+
+    def flush(self):
+        return self._c.flush()
+
+    def finish(self):
+        return self._c.finish()
+
+
+class CompressionMiddleware:
+    def __init__(self, app, min_size=500, level=6, mimetypes=None, brotli_level=4):
+        self.app = app
+        self.min_size = min_size
+        self.level = level
+        self.brotli_level = brotli_level
+        self.mimetypes = dict(DEFAULT_MIMETYPES if mimetypes is None else mimetypes)
+
+    def _compressor(self, encoding, mimetype):
+        level = self.mimetypes.get(mimetype)
+        if encoding == 'br':
+            return _Brotli(self.brotli_level if level is None else level)
+        return _Gzip(self.level if level is None else level)
+
+    def _plan(self, status, headers):
+        """Return the response's mimetype if it should be compressed, else None."""
+        try:
+            code = int(status.split(None, 1)[0])
+        except (ValueError, IndexError):
+            return None
+        if code < 200 or code in _SKIP_STATUS:
+            return None
+        values = {}
+        for name, value in headers:
+            values.setdefault(name.lower(), value)
+        if 'content-encoding' in values or 'content-range' in values:
+            return None
+        if 'no-transform' in values.get('cache-control', '').lower():
+            return None
+        mimetype = values.get('content-type', '').split(';', 1)[0].strip().lower()
+        # SSE must reach the client event by event; a compressor holds it back
+        if mimetype == 'text/event-stream' or mimetype not in self.mimetypes:
+            return None
+        length = values.get('content-length')
+        if length is not None and length.isdigit() and int(length) < self.min_size:
+            return None
+        return mimetype
+
+    @staticmethod
+    def _headers(headers, encoding, length):
+        out, vary = [], None
+        for name, value in headers:
+            lower = name.lower()
+            if lower == 'content-length':
+                continue
+            if lower == 'etag' and not value.startswith('W/'):
+                value = 'W/' + value
+            if lower == 'vary':
+                vary = value
+                continue
+            out.append((name, value))
+        if vary is None:
+            vary = 'Accept-Encoding'
+        elif 'accept-encoding' not in vary.lower() and vary.strip() != '*':
+            vary = f'{vary}, Accept-Encoding'
+        out.append(('Vary', vary))
+        out.append(('Content-Encoding', encoding))
+        if length is not None:
+            out.append(('Content-Length', str(length)))
+        return out
+
+    def __call__(self, environ, start_response):
+        encoding = negotiate(environ.get('HTTP_ACCEPT_ENCODING'))
+        if encoding is None or environ.get('REQUEST_METHOD') == 'HEAD':
+            return self.app(environ, start_response)
+
+        captured = []
+
+        def capture(status, headers, exc_info=None):
+            if exc_info and captured:
+                raise exc_info[1].with_traceback(exc_info[2])
+            captured[:] = [status, headers, exc_info]
+            return _no_write
+
+        app_iter = self.app(environ, capture)
+        if not captured:
+            # start_response deferred to the first chunk: decide after it
+            return self._deferred(app_iter, captured, encoding, start_response)
+        status, headers, exc_info = captured
+        mimetype = self._plan(status, headers)
+        if mimetype is None:
+            # untouched, so wsgi.file_wrapper/sendfile still applies
+            start_response(status, headers, exc_info)
+            return app_iter
+        sized = any(name.lower() == 'content-length' for name, _ in headers)
+        if sized:
+            return self._compress_whole(app_iter, status, headers, exc_info, encoding, mimetype, start_response)
+        return self._compress_stream(app_iter, status, headers, exc_info, encoding, mimetype, start_response)
+
+    def _compress_whole(self, app_iter, status, headers, exc_info, encoding, mimetype, start_response):
+        try:
+            body = b''.join(app_iter)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+        comp = self._compressor(encoding, mimetype)
+        data = comp.compress(body) + comp.finish()
+        start_response(status, self._headers(headers, encoding, len(data)), exc_info)
+        return [data]
+
+    def _compress_stream(self, app_iter, status, headers, exc_info, encoding, mimetype, start_response,
+                         chunks=None):
+        comp = self._compressor(encoding, mimetype)
+        start_response(status, self._headers(headers, encoding, None), exc_info)
+        try:
+            # only whatever zlib/brotli emits is yielded: flushing every tiny
+            # chunk (one CSV row, say) would wreck the ratio. The app asks for
+            # a flush explicitly with an empty chunk.
+            pending = False
+            for chunk in (app_iter if chunks is None else chunks):
+                if chunk:
+                    out = comp.compress(chunk)
+                    pending = True
+                elif pending:
+                    out = comp.flush()
+                    pending = False
+                else:
+                    continue
+                if out:
+                    yield out
+            yield comp.finish()
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+    def _deferred(self, app_iter, captured, encoding, start_response):
+        iterator = iter(app_iter)
+        first = b''
+        try:
+            for first in iterator:
+                if first:
+                    break
+        except BaseException:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+            raise
+        status, headers, exc_info = captured
+        mimetype = self._plan(status, headers)
+
+        def rest():
+            if first:
+                yield first
+            yield from iterator
+
+        if mimetype is None:
+            start_response(status, headers, exc_info)
+            try:
+                yield from rest()
+            finally:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+            return
+        yield from self._compress_stream(app_iter, status, headers, exc_info, encoding, mimetype,
+                                         start_response, chunks=rest())
+
+
+def _no_write(data):
+    raise RuntimeError('CompressionMiddleware does not support the WSGI write() callable')
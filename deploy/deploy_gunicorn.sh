@@ -23,6 +23,9 @@ python3 -m venv .venv
 pip install --upgrade pip
 pip install -r requirements.txt
 
+echo "Fingerprinting and precompressing static assets"
+python assets.py --static static
+
 echo "Initializing DB (FORCE_SQLITE=1)"
 export FORCE_SQLITE=1
 flask --app app init-db
@@ -0,0 +1,13 @@
+# Gunicorn settings shared by every start command (Procfile, start.sh,
+# railway.json, the systemd unit). Gunicorn picks this file up automatically
+# from the working directory; command-line flags still win.
+import os
+
+# The default sync worker holds one request at a time, so the app only serves
+# /admin/notifications/stream (Server-Sent Events) when this is gevent or
+# eventlet (pip install gevent); with sync workers the notifications page
+# polls instead. With an async class, raise SSE_MAX_STREAM_SECONDS as well so
+# streams don't reconnect every 25s.
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'sync')
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', '1000'))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '30'))
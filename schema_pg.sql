@@ -151,3 +151,165 @@ CREATE TABLE IF NOT EXISTS generic_audit (
     details TEXT,
     timestamp TIMESTAMP WITH TIME ZONE DEFAULT now()
 );
+
+-- In-app admin notifications; dedupe_key suppresses repeat alerts while unread
+CREATE TABLE IF NOT EXISTS notifications (
+    id SERIAL PRIMARY KEY,
+    title TEXT NOT NULL,
+    message TEXT,
+    level TEXT DEFAULT 'info',
+    is_read INTEGER DEFAULT 0,
+    dedupe_key TEXT,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT now()
+);
+ALTER TABLE notifications ADD COLUMN IF NOT EXISTS dedupe_key TEXT;
+CREATE INDEX IF NOT EXISTS idx_notifications_dedupe ON notifications (dedupe_key) WHERE is_read = 0;
+
+-- Partial indexes: low-stock lookups scan only the rows at or below reorder level
+CREATE INDEX IF NOT EXISTS idx_products_low_stock ON products (qty) WHERE qty <= reorder_level;
+CREATE INDEX IF NOT EXISTS idx_raw_materials_low_stock ON raw_materials (qty) WHERE qty <= reorder_level;
+
+-- Append-only stock journal; products.qty is the materialized current value
+CREATE TABLE IF NOT EXISTS stock_movements (
+    id SERIAL PRIMARY KEY,
+    product_id INTEGER NOT NULL,
+    movement_type TEXT NOT NULL,
+    qty_delta INTEGER NOT NULL,
+    qty_after INTEGER NOT NULL,
+    ref_entity TEXT,
+    ref_id INTEGER,
+    created_by TEXT,
+    created_at TIMESTAMP DEFAULT (now() AT TIME ZONE 'utc')
+);
+CREATE INDEX IF NOT EXISTS idx_stock_movements_product ON stock_movements (product_id, id);
+CREATE INDEX IF NOT EXISTS idx_stock_movements_created ON stock_movements (created_at);
+CREATE OR REPLACE RULE stock_movements_no_update AS ON UPDATE TO stock_movements DO INSTEAD NOTHING;
+CREATE OR REPLACE RULE stock_movements_no_delete AS ON DELETE TO stock_movements DO INSTEAD NOTHING;
+
+-- Per-product checkpoints: qty after all movements with id <= movement_id
+CREATE TABLE IF NOT EXISTS stock_snapshots (
+    id SERIAL PRIMARY KEY,
+    product_id INTEGER NOT NULL,
+    movement_id INTEGER NOT NULL DEFAULT 0,
+    qty INTEGER NOT NULL,
+    taken_at TIMESTAMP DEFAULT (now() AT TIME ZONE 'utc')
+);
+CREATE INDEX IF NOT EXISTS idx_stock_snapshots_product ON stock_snapshots (product_id, movement_id);
+
+-- Production: bill of materials (material qty per 100 blocks) and batches
+CREATE TABLE IF NOT EXISTS bom_recipes (
+    id SERIAL PRIMARY KEY,
+    product_id INTEGER NOT NULL REFERENCES products(id),
+    material_id INTEGER NOT NULL REFERENCES raw_materials(id),
+    qty_per_100 NUMERIC NOT NULL,
+    UNIQUE (product_id, material_id)
+);
+
+CREATE TABLE IF NOT EXISTS production_batches (
+    id SERIAL PRIMARY KEY,
+    product_id INTEGER NOT NULL REFERENCES products(id),
+    qty INTEGER NOT NULL,
+    shift TEXT,
+    produced_on DATE NOT NULL,
+    finished_block_id INTEGER,
+    recorded_by TEXT,
+    note TEXT,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS idx_production_batches_day ON production_batches (produced_on);
+
+-- Password reset tokens: only the sha256 of each token is stored
+CREATE TABLE IF NOT EXISTS password_reset_tokens (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    account TEXT,
+    token TEXT NOT NULL UNIQUE,
+    expires_at TIMESTAMP NOT NULL,
+    used INTEGER DEFAULT 0,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS idx_password_reset_tokens_expires ON password_reset_tokens (expires_at);
+
+-- Token buckets for login/register/forgot_password rate limits; updated_at is unix time
+CREATE TABLE IF NOT EXISTS rate_limits (
+    bucket TEXT PRIMARY KEY,
+    tokens DOUBLE PRECISION NOT NULL,
+    updated_at DOUBLE PRECISION NOT NULL
+);
+
+-- Stored responses for idempotent POSTs (orders, sales, payments); status_code NULL = still running
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    id SERIAL PRIMARY KEY,
+    scope TEXT NOT NULL,
+    idem_key TEXT NOT NULL,
+    request_hash TEXT NOT NULL,
+    status_code INTEGER,
+    location TEXT,
+    content_type TEXT,
+    body TEXT,
+    flashes TEXT,
+    created_at TIMESTAMP NOT NULL,
+    expires_at TIMESTAMP NOT NULL,
+    UNIQUE (scope, idem_key)
+);
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires ON idempotency_keys (expires_at);
+
+-- Catalogue version: bumped on every catalogue-visible product write, used for ETags
+CREATE TABLE IF NOT EXISTS catalogue_version (
+    id INTEGER PRIMARY KEY,
+    version INTEGER NOT NULL DEFAULT 1,
+    updated_at TIMESTAMP
+);
+INSERT INTO catalogue_version (id, version, updated_at) VALUES (1, 1, now() AT TIME ZONE 'utc') ON CONFLICT (id) DO NOTHING;
+
+-- Yard tablet scans (/api/v1/scan-events); client_event_id makes retries idempotent
+CREATE TABLE IF NOT EXISTS scan_batches (
+    id SERIAL PRIMARY KEY,
+    device_id TEXT,
+    events INTEGER NOT NULL DEFAULT 0,
+    created_by TEXT,
+    received_at TIMESTAMP WITH TIME ZONE DEFAULT now()
+);
+CREATE TABLE IF NOT EXISTS scan_events (
+    id SERIAL PRIMARY KEY,
+    client_event_id TEXT NOT NULL UNIQUE,
+    batch_id INTEGER NOT NULL REFERENCES scan_batches(id),
+    event_type TEXT NOT NULL,
+    product_id INTEGER NOT NULL,
+    qty INTEGER NOT NULL,
+    scanned_at TEXT
+);
+
+-- /ai/detect runs in the background; the page polls its row for the result
+CREATE TABLE IF NOT EXISTS ai_jobs (
+    id SERIAL PRIMARY KEY,
+    status TEXT NOT NULL DEFAULT 'pending',
+    product_id INTEGER,
+    result TEXT,
+    error TEXT,
+    created_by TEXT,
+    created_at TEXT NOT NULL,
+    expires_at TEXT NOT NULL,
+    finished_at TEXT
+);
+
+-- Offline sync change tracking: one row per (table, row id), seq bumped on every
+-- change by the log_row_change() trigger installed from app.install_change_tracking
+CREATE TABLE IF NOT EXISTS change_log (
+    seq BIGSERIAL PRIMARY KEY,
+    table_name TEXT NOT NULL,
+    row_id INTEGER NOT NULL,
+    op TEXT NOT NULL,
+    changed_at TIMESTAMP NOT NULL DEFAULT now(),
+    UNIQUE (table_name, row_id)
+);
+CREATE TABLE IF NOT EXISTS sync_meta (
+    id INTEGER PRIMARY KEY,
+    purged_through BIGINT NOT NULL DEFAULT 0
+);
+INSERT INTO sync_meta (id, purged_through) VALUES (1, 0) ON CONFLICT (id) DO NOTHING;
+CREATE TABLE IF NOT EXISTS sync_uploads (
+    client_change_id TEXT PRIMARY KEY,
+    result TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
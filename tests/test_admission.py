@@ -0,0 +1,107 @@
+import os
+import subprocess
+import sys
+import tempfile
+import shutil
+import threading
+import time
+import pytest
+
+import admission
+import app as app_module
+from werkzeug.security import generate_password_hash
+
+@pytest.fixture()
+def client(monkeypatch):
+    tmpdir = tempfile.mkdtemp()
+    app = app_module.app
+    app.config['DATABASE'] = os.path.join(tmpdir, 'test.db')
+    os.environ['FORCE_SQLITE'] = '1'
+    locks = os.path.join(tmpdir, 'locks')
+    monkeypatch.setattr(app_module, 'ADMISSION_CLASSES', {
+        'critical': admission.AdmissionClass('critical', locks),
+        'normal': admission.AdmissionClass('normal', locks),
+        'heavy': admission.AdmissionClass('heavy', locks, slots=1, queue=1, timeout=0.5),
+    })
+    with app.test_client() as client:
+        with app.app_context():
+            app_module.init_db()
+            db = app_module.get_db()
+            db.execute("DELETE FROM users")
+            db.execute("INSERT INTO users (username, email, password, role) VALUES (?, ?, ?, ?)",
+                       ('admin', 'admin@example.com', generate_password_hash('admin123'), 'admin'))
+            db.commit()
+        client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+        yield client
+    shutil.rmtree(tmpdir)
+
+
+def test_heavy_routes_are_shed_while_critical_ones_run(client):
+    heavy = app_module.ADMISSION_CLASSES['heavy']
+    ticket = heavy.acquire()
+    try:
+        refused = client.get('/admin/audit')
+        assert refused.status_code == 503
+        assert refused.headers['Retry-After'] == '1'
+        assert client.get('/orders/add').status_code == 200
+        metrics = client.get('/admin/metrics/admission').get_json()['classes']
+        assert metrics['heavy']['in_flight'] == 1
+        assert metrics['heavy']['timed_out'] == 1
+        assert metrics['critical']['admitted'] >= 1
+    finally:
+        ticket.release()
+    assert client.get('/admin/audit').status_code == 200
+    # the GET form of the import page isn't heavy
+    ticket = heavy.acquire()
+    try:
+        assert client.get('/admin/products/import').status_code == 200
+    finally:
+        ticket.release()
+
+
+def test_anonymous_requests_do_not_take_heavy_slots(client):
+    client.get('/logout')
+    heavy = app_module.ADMISSION_CLASSES['heavy']
+    ticket = heavy.acquire()
+    try:
+        for path in ('/admin/audit', '/sales', '/admin/products/export'):
+            assert client.get(path).status_code == 302
+        stats = heavy.stats()
+        assert (stats['in_flight'], stats['rejected'], stats['timed_out']) == (1, 0, 0)
+    finally:
+        ticket.release()
+    client.get('/admin/audit')
+    assert heavy.stats()['in_flight'] == 0 and heavy.stats()['admitted'] == 1
+
+
+def test_queued_request_gets_slot_freed_by_another_worker(client):
+    heavy = app_module.ADMISSION_CLASSES['heavy']
+    lock_path = heavy._slots.paths[0]
+    holder = subprocess.Popen([sys.executable, '-c', (
+        'import fcntl, os, sys, time\n'
+        f'fd = os.open({lock_path!r}, os.O_RDWR | os.O_CREAT)\n'
+        'fcntl.flock(fd, fcntl.LOCK_EX)\n'
+        'print("locked", flush=True)\n'
+        'time.sleep(0.2)\n')], stdout=subprocess.PIPE, text=True)
+    assert holder.stdout.readline().strip() == 'locked'
+    # a second waiter finds the one queue place taken and is refused at once
+    blocked = []
+    waiter = threading.Thread(target=lambda: blocked.append(heavy.acquire()))
+    waiter.start()
+    time.sleep(0.05)
+    with pytest.raises(admission.Rejected):
+        heavy.acquire()
+    waiter.join()
+    holder.wait()
+    assert blocked and blocked[0].waited > 0.05
+    blocked[0].release()
+    assert heavy.stats()['in_flight'] == 0
+
+
+def test_streamed_export_keeps_slot_until_body_is_read(client):
+    heavy = app_module.ADMISSION_CLASSES['heavy']
+    resp = client.get('/admin/products/export', buffered=False)
+    assert heavy.stats()['in_flight'] == 1
+    resp.get_data()
+    resp.close()
+    assert heavy.stats()['in_flight'] == 0
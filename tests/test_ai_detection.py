@@ -0,0 +1,193 @@
+import io
+import os
+import tempfile
+import shutil
+import threading
+import time
+import pytest
+
+import app as app_module
+import ai_detection
+from werkzeug.security import generate_password_hash
+
+@pytest.fixture()
+def client():
+    tmpdir = tempfile.mkdtemp()
+    app = app_module.app
+    app.config['DATABASE'] = os.path.join(tmpdir, 'test.db')
+    os.environ['FORCE_SQLITE'] = '1'
+    with app.test_client() as client:
+        with app.app_context():
+            app_module.init_db()
+            db = app_module.get_db()
+            db.execute("DELETE FROM users")
+            db.execute("INSERT INTO users (username, email, password, role) VALUES (?, ?, ?, ?)",
+                       ('admin', 'admin@example.com', generate_password_hash('admin123'), 'admin'))
+            db.execute("INSERT INTO products (name, price, qty, reorder_level) VALUES (?, ?, ?, ?)",
+                       ('Paver', 100.0, 40, 5))
+            db.commit()
+        client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+        yield client
+    shutil.rmtree(tmpdir)
+
+
+def test_detect_without_model_is_unavailable(client, monkeypatch, tmp_path):
+    monkeypatch.setattr(ai_detection, 'MODEL_PATH', str(tmp_path / 'missing.pt'))
+    status = client.get('/ai/status').get_json()
+    assert status['model_available'] is False and status['status'] == 'missing'
+    assert client.post('/ai/detect', data={}).status_code == 400
+    resp = client.post('/ai/detect', data={'image': (io.BytesIO(b'not an image'), 'a.jpg')},
+                       content_type='multipart/form-data')
+    assert resp.status_code == 503
+    assert resp.get_json()['success'] is False
+
+
+def test_detect_returns_job_to_poll(client, monkeypatch):
+    release = threading.Event()
+
+    def run(blobs, confidence, tiled=False):
+        release.wait(5)
+        if blobs[0] == b'broken':
+            raise ValueError('Image 1 could not be read')
+        return [{'count': 12}, {'count': 9}]
+
+    monkeypatch.setattr(ai_detection, '_model', object())
+    monkeypatch.setattr(ai_detection, '_run', run)
+    with app_module.app.app_context():
+        pid = app_module.get_db().execute("SELECT id FROM products WHERE name = 'Paver'").fetchone()['id']
+    resp = client.post('/ai/detect', data={'image': [(io.BytesIO(b'a'), 'a.jpg'), (io.BytesIO(b'b'), 'b.jpg')],
+                                           'product_id': str(pid)}, content_type='multipart/form-data')
+    # the request returns while detection is still running
+    assert resp.status_code == 202
+    poll_url = resp.get_json()['poll_url']
+    assert client.get(poll_url).get_json()['status'] == 'pending'
+    release.set()
+    for _ in range(100):
+        data = client.get(poll_url).get_json()
+        if data['status'] != 'pending':
+            break
+        time.sleep(0.05)
+    assert data['status'] == 'done' and data['count'] == 21
+    assert [i['filename'] for i in data['images']] == ['a.jpg', 'b.jpg']
+    assert (data['proposal']['current_qty'], data['proposal']['counted_qty']) == (40, 21)
+
+    resp = client.post('/ai/detect', data={'image': (io.BytesIO(b'broken'), 'c.jpg')},
+                       content_type='multipart/form-data')
+    poll_url = resp.get_json()['poll_url']
+    for _ in range(100):
+        data = client.get(poll_url).get_json()
+        if data['status'] != 'pending':
+            break
+        time.sleep(0.05)
+    assert (data['status'], data['success'], data['error']) == ('failed', False, 'Image 1 could not be read')
+    assert client.get('/ai/detect/99999').status_code == 404
+
+
+def test_emails_queued_by_a_job_are_sent(client, monkeypatch):
+    sent = []
+    propose = app_module.propose_stock_count
+
+    def propose_and_notify(db, product_id, counted, **kw):
+        notification_id = app_module.insert_returning_id(
+            db, "INSERT INTO notifications (title, message, level) VALUES (?, ?, ?)", ('Count', 'AI count', 'info'))
+        app_module.email_after_commit(notification_id, 'Count', 'AI count', ['admin@example.com'])
+        return propose(db, product_id, counted, **kw)
+
+    monkeypatch.setattr(ai_detection, '_model', object())
+    monkeypatch.setattr(ai_detection, '_run', lambda blobs, confidence, tiled=False: [{'count': 3}])
+    monkeypatch.setattr(app_module, 'propose_stock_count', propose_and_notify)
+    monkeypatch.setattr(app_module, 'enqueue_email', lambda subject, body, to: sent.append(subject))
+    with app_module.app.app_context():
+        pid = app_module.get_db().execute("SELECT id FROM products WHERE name = 'Paver'").fetchone()['id']
+    client.post('/ai/detect', data={'image': (io.BytesIO(b'a'), 'a.jpg'), 'product_id': str(pid)},
+                content_type='multipart/form-data')
+    for _ in range(100):
+        if sent:
+            break
+        time.sleep(0.05)
+    assert sent == ['Count']
+
+
+def test_old_jobs_are_purged(client):
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        old = app_module._utc_timestamp(app_module.datetime.utcnow() - app_module.timedelta(hours=25))
+        new = app_module._utc_timestamp()
+        for created in (old, old, old, new):
+            db.execute("INSERT INTO ai_jobs (status, created_at, expires_at) VALUES ('done', ?, ?)", (created, created))
+        db.commit()
+        assert app_module.purge_ai_jobs(db, batch_size=2, max_batches=1) == 2
+        assert app_module.purge_ai_jobs(db, batch_size=2) == 1
+        assert [r['created_at'] for r in db.execute('SELECT created_at FROM ai_jobs')] == [new]
+
+
+def test_proposed_count_is_audited_not_applied(client):
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        pid = db.execute("SELECT id FROM products WHERE name = 'Paver'").fetchone()['id']
+        proposal = app_module.propose_stock_count(db, pid, 37, images=2, user='admin')
+        db.commit()
+        assert proposal['delta'] == -3
+        audit = db.execute("SELECT * FROM product_audit WHERE product_id = ? AND action = 'ai_proposed'", (pid,)).fetchone()
+        qty = db.execute("SELECT qty FROM products WHERE id = ?", (pid,)).fetchone()['qty']
+        assert app_module.propose_stock_count(db, 99999, 1) is None
+    assert (audit['old_value'], audit['new_value']) == ('40', '37')
+    assert qty == 40
+
+
+def test_onnx_postprocess_decodes_and_suppresses_boxes():
+    import numpy as np
+    detector = ai_detection.OnnxDetector.__new__(ai_detection.OnnxDetector)
+    detector.names = {0: 'block'}
+    # (4 + 1 class + 2 mask coefficients, 4 anchors) in letterboxed pixels
+    pred = np.array([
+        [110, 112, 300, 50],   # cx
+        [110, 110, 300, 50],   # cy
+        [40, 40, 40, 10],      # w
+        [40, 40, 40, 10],      # h
+        [0.9, 0.8, 0.6, 0.1],  # class score
+        [0, 0, 0, 0],
+        [0, 0, 0, 0],
+    ], dtype=np.float32)
+    boxes = detector._boxes(pred, scale=0.5, pad_x=0, pad_y=20, confidence=0.25)
+    # anchor 1 overlaps anchor 0, anchor 3 is below the threshold
+    assert [b['confidence'] for b in boxes] == [0.9, 0.6]
+    assert boxes[0]['bbox'] == [180.0, 140.0, 260.0, 220.0]
+    assert boxes[0]['class'] == 'block'
+
+
+def test_tiles_cover_image_and_cross_tile_duplicates_merge():
+    tiles = ai_detection.tile_grid(1500, 700, tile=640, overlap=0.25)
+    assert tiles[0] == (0, 0, 640, 640)
+    assert {t[2] for t in tiles} == {640, 1120, 1500} and {t[3] for t in tiles} == {640, 700}
+    assert all(t[2] - t[0] == 640 and t[3] - t[1] == 640 for t in tiles)
+    assert ai_detection.tile_grid(300, 200, tile=640) == [(0, 0, 300, 200)]
+
+    # one block straddles the seam: tile A sees all of it, tile B the right half
+    seen_a = [{'class': 'block', 'confidence': 0.9, 'bbox': [600.0, 100.0, 660.0, 160.0]}]
+    seen_b = [{'class': 'block', 'confidence': 0.7, 'bbox': [0.0, 100.0, 40.0, 160.0]},
+              {'class': 'block', 'confidence': 0.8, 'bbox': [200.0, 100.0, 260.0, 160.0]}]
+    merged = ai_detection.merge_tile_detections([(0, 0, 640, 640), (620, 0, 1260, 640)], [seen_a, seen_b])
+    assert [d['bbox'] for d in merged] == [[600.0, 100.0, 660.0, 160.0], [820.0, 100.0, 880.0, 160.0]]
+
+
+def test_memmap_tiles_match_source_pixels():
+    Image = pytest.importorskip('PIL.Image')
+    import numpy as np
+    pixels = np.random.default_rng(1).integers(0, 255, (900, 1300, 3), dtype=np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(pixels).save(buf, 'PNG')
+    with ai_detection.MemmapImage(buf.getvalue(), strip_rows=256) as image:
+        assert (image.width, image.height) == (1300, 900)
+        tile = np.asarray(image.tile((640, 260, 1280, 900)))
+        path = image.path
+    assert (tile == pixels[260:900, 640:1280]).all()
+    assert not os.path.exists(path)
+
+    # non-RGB photos are converted strip by strip
+    gray = pixels[..., 0]
+    buf = io.BytesIO()
+    Image.fromarray(gray, 'L').save(buf, 'PNG')
+    with ai_detection.MemmapImage(buf.getvalue(), strip_rows=256) as image:
+        tile = np.asarray(image.tile((0, 512, 640, 900)))
+    assert (tile == gray[512:900, 0:640, None]).all()
@@ -0,0 +1,46 @@
+import os
+import tempfile
+import shutil
+import pytest
+
+import app as app_module
+from werkzeug.security import generate_password_hash
+
+@pytest.fixture()
+def client():
+    tmpdir = tempfile.mkdtemp()
+    app = app_module.app
+    app.config['DATABASE'] = os.path.join(tmpdir, 'test.db')
+    os.environ['FORCE_SQLITE'] = '1'
+    with app.test_client() as client:
+        with app.app_context():
+            app_module.init_db()
+            db = app_module.get_db()
+            db.execute("DELETE FROM users")
+            db.execute("INSERT INTO users (username, email, password, role) VALUES (?, ?, ?, ?)",
+                       ('admin', 'admin@example.com', generate_password_hash('admin123'), 'admin'))
+            db.commit()
+        yield client
+    shutil.rmtree(tmpdir)
+
+
+def test_anonymous_catalogue_is_conditional_and_invalidated_by_edits(client):
+    rv = client.get('/products')
+    assert rv.status_code == 200
+    etag = rv.headers['ETag']
+    assert not etag.startswith('W/') and rv.headers['Last-Modified']
+    assert rv.headers['Cache-Control'].startswith('public')
+
+    assert client.get('/products', headers={'If-None-Match': etag}).status_code == 304
+
+    client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+    assert client.get('/products').headers['Cache-Control'] == 'private, no-cache'
+    with app_module.app.app_context():
+        pid = app_module.get_db().execute("SELECT id FROM products ORDER BY id LIMIT 1").fetchone()['id']
+    client.post(f'/admin/products/edit/{pid}', data={'name': 'Renamed Block', 'price': '450', 'qty': '3', 'reorder_level': '0'})
+    client.get('/logout')
+    client.get('/products')  # consumes the flashed messages
+
+    rv = client.get('/products', headers={'If-None-Match': etag})
+    assert rv.status_code == 200 and rv.headers['ETag'] != etag
+    assert b'Renamed Block' in rv.data
@@ -0,0 +1,84 @@
+import gzip
+import os
+import tempfile
+import shutil
+import pytest
+
+import app as app_module
+import compression
+from werkzeug.security import generate_password_hash
+
+@pytest.fixture()
+def client():
+    tmpdir = tempfile.mkdtemp()
+    app = app_module.app
+    app.config['DATABASE'] = os.path.join(tmpdir, 'test.db')
+    os.environ['FORCE_SQLITE'] = '1'
+    with app.test_client() as client:
+        with app.app_context():
+            app_module.init_db()
+            db = app_module.get_db()
+            db.execute("DELETE FROM users")
+            db.execute("INSERT INTO users (username, email, password, role) VALUES (?, ?, ?, ?)",
+                       ('admin', 'admin@example.com', generate_password_hash('admin123'), 'admin'))
+            db.executemany("INSERT INTO products (name, size, price, qty, reorder_level) VALUES (?, ?, ?, ?, ?)",
+                           [(f'Block {i}', '6 inch', 300 + i, 50, 5) for i in range(1200)])
+            db.commit()
+        client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+        yield client
+    shutil.rmtree(tmpdir)
+
+
+def _call(middleware, accept='gzip'):
+    captured = {}
+
+    def start_response(status, headers, exc_info=None):
+        captured['status'], captured['headers'] = status, dict(headers)
+
+    body = b''.join(middleware({'REQUEST_METHOD': 'GET', 'HTTP_ACCEPT_ENCODING': accept}, start_response))
+    return captured['headers'], body
+
+
+def test_middleware_negotiates_and_respects_thresholds():
+    assert compression.negotiate('br;q=1, gzip;q=0.5', brotli_available=False) == 'gzip'
+    assert compression.negotiate('gzip;q=0, identity') is None
+    assert compression.parse_mimetypes('text/html, text/csv=1') == {'text/html': None, 'text/csv': 1}
+
+    def app(body, content_type, sized=True):
+        def wsgi(environ, start_response):
+            headers = [('Content-Type', content_type), ('ETag', '"abc"')]
+            if sized:
+                headers.append(('Content-Length', str(len(body))))
+            start_response('200 OK', headers)
+            return [body[:10], body[10:]]
+        return compression.CompressionMiddleware(wsgi, min_size=100)
+
+    html = b'<tr><td>row</td></tr>' * 50
+    headers, body = _call(app(html, 'text/html; charset=utf-8'))
+    assert headers['Content-Encoding'] == 'gzip' and headers['ETag'] == 'W/"abc"'
+    assert headers['Vary'] == 'Accept-Encoding' and int(headers['Content-Length']) == len(body)
+    assert gzip.decompress(body) == html
+
+    headers, body = _call(app(b'tiny', 'text/html'))
+    assert 'Content-Encoding' not in headers and body == b'tiny'
+    headers, body = _call(app(html, 'image/png'))
+    assert 'Content-Encoding' not in headers
+    headers, body = _call(app(b'data: x\n\n' * 50, 'text/event-stream', sized=False))
+    assert 'Content-Encoding' not in headers
+
+    headers, body = _call(app(html, 'text/csv', sized=False))
+    assert 'Content-Length' not in headers and gzip.decompress(body) == html
+
+
+def test_large_pages_and_streamed_export_are_compressed(client):
+    rv = client.get('/admin/products', headers={'Accept-Encoding': 'gzip, deflate'})
+    assert rv.headers['Content-Encoding'] == 'gzip'
+    assert b'Block 1199' in gzip.decompress(rv.data)
+
+    rv = client.get('/admin/products/export', headers={'Accept-Encoding': 'gzip'})
+    assert rv.headers['Content-Encoding'] == 'gzip' and 'Content-Length' not in rv.headers
+    lines = gzip.decompress(rv.data).decode().splitlines()
+    assert lines[0].startswith('id,name') and len(lines) == 1201 + 4  # schema.sql seeds 4 products
+
+    plain = client.get('/admin/products/export')
+    assert 'Content-Encoding' not in plain.headers and plain.data.decode().splitlines() == lines
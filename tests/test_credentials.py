@@ -0,0 +1,115 @@
+import os
+import tempfile
+import shutil
+import threading
+import pytest
+
+import app as app_module
+from werkzeug.security import generate_password_hash
+
+@pytest.fixture()
+def client():
+    tmpdir = tempfile.mkdtemp()
+    app = app_module.app
+    app.config['DATABASE'] = os.path.join(tmpdir, 'test.db')
+    os.environ['FORCE_SQLITE'] = '1'
+    with app.test_client() as client:
+        with app.app_context():
+            app_module.init_db()
+            db = app_module.get_db()
+            db.execute("DELETE FROM users")
+            # an old, cheaper hash that should be upgraded on login
+            db.execute("INSERT INTO users (username, email, password, role) VALUES (?, ?, ?, ?)",
+                       ('manager', 'manager@example.com', generate_password_hash('admin123', 'pbkdf2:sha256:1000'), 'admin'))
+            db.execute("INSERT INTO customers (name, email, password) VALUES (?, ?, ?)",
+                       ('Ada', 'ada@example.com', generate_password_hash('pw123456')))
+            db.commit()
+        yield client
+    shutil.rmtree(tmpdir)
+
+
+def _stored(table, email):
+    with app_module.app.app_context():
+        return app_module.get_db().execute(f"SELECT password FROM {table} WHERE email = ?", (email,)).fetchone()['password']
+
+
+def test_login_rehashes_outdated_hash_and_checks_both_tables(client):
+    rv = client.post('/login', data={'username': 'manager', 'password': 'wrong'}, follow_redirects=True)
+    assert b'Invalid credentials' in rv.data
+    assert _stored('users', 'manager@example.com').startswith('pbkdf2:sha256:1000$')
+
+    rv = client.post('/login', data={'username': 'manager@example.com', 'password': 'admin123'})
+    assert rv.status_code == 302
+    assert _stored('users', 'manager@example.com').startswith('scrypt:')
+    client.get('/logout')
+
+    before = _stored('customers', 'ada@example.com')
+    assert client.post('/login', data={'username': 'ada@example.com', 'password': 'pw123456'}).status_code == 302
+    assert _stored('customers', 'ada@example.com') == before  # already current
+
+
+def test_hashing_fails_fast_when_pool_is_saturated(client, monkeypatch, tmp_path):
+    service = app_module.CredentialService('scrypt', workers=1, max_pending=0, lock_dir=str(tmp_path))
+    monkeypatch.setattr(app_module, 'credentials', service)
+    assert service.verify(service.hash('x'), 'x') is True
+    assert service.verify(None, 'x') is False
+
+    # the slot is a lock file, so a hash in another worker process holds it too
+    other_worker = app_module.CredentialService('scrypt', workers=1, max_pending=0, lock_dir=str(tmp_path))
+    ticket = other_worker._slots.acquire()
+    with pytest.raises(app_module.CredentialsBusy):
+        service.hash('x')
+    rv = client.post('/login', data={'username': 'manager', 'password': 'admin123'})
+    assert rv.status_code == 503 and rv.headers['Retry-After']
+    ticket.release()
+    assert service.verify(None, 'x') is False
+
+
+def test_slow_hash_answers_busy_not_500(client, monkeypatch, tmp_path):
+    release = threading.Event()
+    service = app_module.CredentialService('scrypt', workers=1, max_pending=0, timeout=0.05, lock_dir=str(tmp_path))
+    monkeypatch.setattr(app_module, 'credentials', service)
+    monkeypatch.setattr(app_module, 'check_password_hash', lambda stored, password: release.wait(5))
+    rv = client.post('/login', data={'username': 'manager', 'password': 'admin123'})
+    release.set()
+    assert rv.status_code == 503 and rv.headers['Retry-After']
+
+
+def test_reset_token_is_hashed_single_use_and_purged(client):
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        cid = db.execute("SELECT id FROM customers WHERE email = 'ada@example.com'").fetchone()['id']
+        token = app_module.issue_reset_token(db, 'customers', cid)
+        # expired tokens to sweep
+        for i in range(7):
+            db.execute("INSERT INTO password_reset_tokens (user_id, account, token, expires_at) VALUES (?, ?, ?, ?)",
+                       (cid, 'customers', f'old{i}', '2020-01-01 00:00:00'))
+        db.commit()
+        stored = db.execute("SELECT token FROM password_reset_tokens WHERE expires_at > '2021'").fetchone()['token']
+        assert stored != token and stored == app_module._token_digest(token)
+        assert app_module.purge_reset_tokens(db, batch_size=3) == 7
+
+    rv = client.post(f'/reset_password/{token}', data={'password': 'newpass1', 'confirm_password': 'newpass1'})
+    assert rv.status_code == 302
+    assert client.post('/login', data={'username': 'ada@example.com', 'password': 'newpass1'}).status_code == 302
+    client.get('/logout')
+    assert client.get(f'/reset_password/{token}').headers['Location'].endswith('/forgot_password')
+    with app_module.app.app_context():
+        assert app_module.get_db().execute("SELECT COUNT(*) AS c FROM password_reset_tokens").fetchone()['c'] == 0
+
+
+def test_forgot_password_matches_email_not_username(client, monkeypatch):
+    sent = []
+    monkeypatch.setattr(app_module, 'send_email', lambda subject, body, to: sent.append(to))
+
+    def tokens():
+        with app_module.app.app_context():
+            return app_module.get_db().execute(
+                "SELECT account, COUNT(*) AS c FROM password_reset_tokens GROUP BY account").fetchall()
+
+    client.post('/forgot_password', data={'email': 'manager'})
+    assert tokens() == [] and sent == []
+    client.post('/forgot_password', data={'email': 'manager@example.com'})
+    client.post('/forgot_password', data={'email': 'ada@example.com'})
+    assert [(r['account'], r['c']) for r in tokens()] == [('customers', 1), ('users', 1)]
+    assert sent == [['manager@example.com'], ['ada@example.com']]
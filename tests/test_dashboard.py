@@ -0,0 +1,62 @@
+import os
+import tempfile
+import shutil
+import pytest
+
+import app as app_module
+from werkzeug.security import generate_password_hash
+
+@pytest.fixture()
+def client():
+    tmpdir = tempfile.mkdtemp()
+    app = app_module.app
+    app.config['DATABASE'] = os.path.join(tmpdir, 'test.db')
+    os.environ['FORCE_SQLITE'] = '1'
+    with app.test_client() as client:
+        with app.app_context():
+            app_module.init_db()
+            db = app_module.get_db()
+            db.execute("DELETE FROM users")
+            db.execute("INSERT INTO users (username, email, password, role) VALUES (?, ?, ?, ?)",
+                       ('admin', 'admin@example.com', generate_password_hash('admin123'), 'admin'))
+            db.execute("INSERT INTO products (name, price, qty, reorder_level) VALUES (?, ?, ?, ?)",
+                       ('Block A', 100.0, 50, 5))
+            db.execute("INSERT INTO products (name, price, qty, reorder_level) VALUES (?, ?, ?, ?)",
+                       ('Block B', 100.0, 2, 10))
+            db.execute("INSERT INTO raw_materials (name, qty, reorder_level) VALUES (?, ?, ?)",
+                       ('Cement', 1, 20))
+            db.commit()
+        client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+        yield client
+    shutil.rmtree(tmpdir)
+
+
+def test_dashboard_json_counts_and_low_stock(client):
+    data = client.get('/admin/dashboard.json').get_json()
+    assert data['ok'] is True
+    with app_module.app.app_context():
+        total = app_module.get_db().execute("SELECT COUNT(*) AS c FROM products").fetchone()['c']
+    assert data['total_products'] == total
+    assert data['pending_payments'] == 0
+    low_names = [p['name'] for p in data['low_products']]
+    assert 'Block B' in low_names and 'Block A' not in low_names
+    assert [m['name'] for m in data['low_materials']] == ['Cement']
+
+
+def test_dashboard_falls_back_per_section(client):
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        db.execute("DROP TABLE raw_materials")
+        db.commit()
+        stats = app_module.get_dashboard_data(('total_products', 'total_raw_materials'), low_stock=True)
+    assert stats['total_products'] > 0
+    assert 'total_raw_materials' in stats['errors']
+    assert 'Block B' in [p['name'] for p in stats['low_products']]
+    assert 'low_materials' in stats['errors']
+
+
+def test_dashboard_page_title_and_refresh_script(client):
+    page = client.get('/admin').get_data(as_text=True)
+    title = page.split('<title>', 1)[1].split('</title>', 1)[0]
+    assert 'Admin Dashboard' in title and '<script' not in title
+    assert page.count('/admin/dashboard.json') == 1
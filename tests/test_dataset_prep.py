@@ -0,0 +1,43 @@
+import pytest
+
+import train_block_detector as tbd
+
+Image = pytest.importorskip('PIL.Image')
+
+
+def _make_dataset(root, count):
+    (root / 'images').mkdir(parents=True)
+    (root / 'labels').mkdir()
+    for i in range(count):
+        Image.new('RGB', (1600, 1200), (i * 10 % 255, 80, 80)).save(root / 'images' / f'yard_{i}.jpg')
+        (root / 'labels' / f'yard_{i}.txt').write_text('0 0.5 0.5 0.2 0.2\n')
+    Image.new('RGB', (64, 64)).save(root / 'images' / 'unlabeled.jpg')
+    Image.new('RGB', (64, 64)).save(root / 'images' / 'broken.jpg')
+    (root / 'labels' / 'broken.txt').write_text('3 0.5 0.5 1.7 0.2\n')
+
+
+def test_prepare_dataset_splits_resizes_and_caches(tmp_path):
+    _make_dataset(tmp_path, 12)
+    yaml_path = tbd.prepare_dataset(str(tmp_path), img_size=320, val_fraction=0.25, workers=2)
+    cache = tmp_path / 'cache' / '320'
+    assert yaml_path == str(cache / 'data.yaml')
+    train = (cache / 'train.txt').read_text().split()
+    val = (cache / 'val.txt').read_text().split()
+    assert len(train) + len(val) == 12 and val
+    assert not set(train) & set(val)
+    with Image.open(train[0]) as img:
+        assert max(img.size) == 320
+    assert (cache / 'labels' / (train[0].rsplit('/', 1)[1][:-4] + '.txt')).exists()
+
+    # a second run reuses the cached files and gives the same split
+    stamp = {p: p.stat().st_mtime_ns for p in (cache / 'images').iterdir()}
+    tbd.prepare_dataset(str(tmp_path), img_size=320, val_fraction=0.25, workers=2)
+    assert {p: p.stat().st_mtime_ns for p in (cache / 'images').iterdir()} == stamp
+    assert (cache / 'val.txt').read_text().split() == val
+
+
+def test_validate_label_reports_problems(tmp_path):
+    label = tmp_path / 'a.txt'
+    label.write_text('0 0.1 0.1 0.2 0.2\n0 0.1 0.1 0.5 0.1 0.5 0.5\n1 0.5 0.5 0.2\nx 1 1 1 1\n')
+    problems = tbd.validate_label(label)
+    assert problems == ['line 3: class 1 out of range', 'line 3: 3 coordinates', 'line 4: not numeric']
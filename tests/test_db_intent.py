@@ -0,0 +1,109 @@
+import os
+import sqlite3
+import tempfile
+import shutil
+import pytest
+
+import app as app_module
+from werkzeug.security import generate_password_hash
+
+@pytest.fixture()
+def client():
+    tmpdir = tempfile.mkdtemp()
+    app = app_module.app
+    app.config['DATABASE'] = os.path.join(tmpdir, 'test.db')
+    os.environ['FORCE_SQLITE'] = '1'
+    with app.test_client() as client:
+        with app.app_context():
+            app_module.init_db()
+            db = app_module.get_db()
+            db.execute("DELETE FROM users")
+            db.execute("INSERT INTO users (username, email, password, role) VALUES (?, ?, ?, ?)",
+                       ('admin', 'admin@example.com', generate_password_hash('admin123'), 'admin'))
+            db.execute("INSERT INTO notes (content) VALUES ('first')")
+            db.commit()
+        client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+        yield client
+    shutil.rmtree(tmpdir)
+
+
+@app_module.app.route('/_test/intent', methods=['GET', 'POST'])
+@app_module.db_intent('read')
+def _intent_view():
+    db = app_module.get_db()
+    result = {'read_only': None, 'same_as_primary': db is app_module.get_db('write')}
+    try:
+        db.execute("INSERT INTO notes (content) VALUES ('via read connection')")
+        result['read_only'] = False
+    except sqlite3.OperationalError:
+        result['read_only'] = True
+    with app_module.transaction() as tx:
+        tx.execute("INSERT INTO notes (content) VALUES ('via transaction')")
+        # helpers calling get_db() inside the block join the same transaction
+        result['joined'] = app_module.get_db() is tx
+    try:
+        with app_module.transaction() as tx:
+            tx.execute("INSERT INTO notes (content) VALUES ('rolled back')")
+            raise ValueError('boom')
+    except ValueError:
+        pass
+    result['notes'] = [r['content'] for r in db.execute('SELECT content FROM notes ORDER BY id')]
+    return result
+
+
+def test_get_uses_query_only_connection_and_transactions_use_primary(client):
+    data = client.get('/_test/intent').get_json()
+    assert data['read_only'] is True
+    assert data['same_as_primary'] is False
+    assert data['joined'] is True
+    assert data['notes'] == ['first', 'via transaction']
+
+
+def test_post_to_read_view_uses_primary(client):
+    data = client.post('/_test/intent').get_json()
+    assert data['read_only'] is False and data['same_as_primary'] is True
+
+
+def test_read_pages_still_render(client):
+    for path in ('/orders', '/payments', '/my/orders', '/admin/customers', '/products', '/ledger'):
+        assert client.get(path).status_code == 200, path
+
+
+def test_reads_after_a_write_stay_on_the_primary(client, monkeypatch):
+    class Conn:
+        def __init__(self, url):
+            self.url = url
+
+        def execute(self, sql, params=()):
+            pass
+
+        def commit(self):
+            pass
+
+        def close(self):
+            pass
+
+    monkeypatch.setitem(app_module.app.config, 'READ_DATABASE_URLS', ['postgresql://replica/db'])
+    monkeypatch.setattr(app_module, 'database_key', lambda: 'postgres:postgresql://primary/db')
+    monkeypatch.setattr(app_module, 'connect_db', lambda database_url=None: Conn(database_url or 'primary'))
+
+    def read_url():
+        with client.session_transaction() as sess:
+            wrote_at = sess.get('_wrote_at')
+        with app_module.app.app_context(), app_module.app.test_request_context():
+            if wrote_at:
+                app_module.session['_wrote_at'] = wrote_at
+            return app_module.connect_read_db().url
+
+    assert read_url() == 'postgresql://replica/db'
+    # a successful POST (the redirect-after-POST case) pins the next reads
+    assert client.post('/_test/pin').status_code == 200
+    assert read_url() == 'primary'
+    with client.session_transaction() as sess:
+        sess['_wrote_at'] -= app_module.app.config['READ_AFTER_WRITE_SECONDS'] + 1
+    assert read_url() == 'postgresql://replica/db'
+
+
+@app_module.app.route('/_test/pin', methods=['POST'])
+def _pin_view():
+    return 'saved'
@@ -0,0 +1,86 @@
+import os
+import tempfile
+import shutil
+from datetime import date, timedelta
+import pytest
+
+import app as app_module
+import forecasting
+from werkzeug.security import generate_password_hash
+
+@pytest.fixture()
+def client():
+    tmpdir = tempfile.mkdtemp()
+    app = app_module.app
+    app.config['DATABASE'] = os.path.join(tmpdir, 'test.db')
+    os.environ['FORCE_SQLITE'] = '1'
+    forecasting.clear_cache()
+    with app.test_client() as client:
+        with app.app_context():
+            app_module.init_db()
+            db = app_module.get_db()
+            db.execute("DELETE FROM users")
+            db.execute("INSERT INTO users (username, email, password, role) VALUES (?, ?, ?, ?)",
+                       ('admin', 'admin@example.com', generate_password_hash('admin123'), 'admin'))
+            db.execute("INSERT INTO products (name, price, qty, reorder_level) VALUES (?, ?, ?, ?)",
+                       ('Paver', 100.0, 500, 1))
+            db.commit()
+        client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+        yield client
+    shutil.rmtree(tmpdir)
+
+
+def test_weekly_pattern_is_learned():
+    start = date(2024, 1, 1)  # a Monday
+    weeks = 52
+    # sells 10 a day on weekdays, nothing at weekends
+    pattern = [10, 10, 10, 10, 10, 0, 0] * weeks
+    import numpy as np
+    matrix = np.array([pattern], dtype=float)
+    result = forecasting.forecast_matrix(matrix, start, horizon=7, lead_time=7)
+    season = result['season'][0]
+    assert season[5] == 0 and season[6] == 0
+    assert season[:5].round(2).tolist() == [1.4] * 5
+    # next 7 days start on a Monday again: five selling days, two idle
+    forecast = result['forecast'][0]
+    assert forecast[5] == 0 and forecast[6] == 0
+    assert abs(forecast[:5].sum() - 50) < 1
+    assert abs(result['ma7'][0] - 50 / 7) < 1e-9
+
+
+def test_forecast_endpoint_recommends_reorder_level(client):
+    today = date.today()
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        pid = db.execute("SELECT id FROM products WHERE name = 'Paver'").fetchone()['id']
+        for d in range(1, 120):
+            day = (today - timedelta(days=d)).isoformat()
+            # two rows on the same day are summed
+            db.execute("INSERT INTO sales (sale_date, amount, product_id, qty) VALUES (?, ?, ?, ?)", (day, 1000, pid, 6))
+            db.execute("INSERT INTO sales (sale_date, amount, product_id, qty) VALUES (?, ?, ?, ?)", (day, 1000, pid, 4))
+        db.commit()
+    data = client.get('/admin/forecast.json?days=90&lead_time=7').get_json()
+    assert data['ok'] is True
+    paver = next(p for p in data['products'] if p['product_id'] == pid)
+    assert abs(paver['ma28'] - 10) < 0.5
+    assert 60 <= paver['recommended_reorder_level'] <= 90
+
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        changed = app_module.apply_forecast_reorder_levels(db, [paver])
+        db.commit()
+        level = db.execute("SELECT reorder_level FROM products WHERE id = ?", (pid,)).fetchone()['reorder_level']
+    assert changed == 1
+    assert level == paver['recommended_reorder_level']
+
+    # a second --apply on the same day reuses the cached forecast, whose
+    # reorder_level is stale; nothing has changed, so nothing is rewritten
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        assert app_module.apply_forecast_reorder_levels(db, [paver]) == 0
+        db.commit()
+        audits = db.execute("SELECT COUNT(*) AS n FROM product_audit WHERE product_id = ? AND action = 'forecast'",
+                            (pid,)).fetchone()['n']
+    assert audits == 1
+
+    assert client.get('/admin/forecast.json?days=abc').status_code == 400
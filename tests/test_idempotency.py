@@ -0,0 +1,102 @@
+import os
+import re
+import tempfile
+import shutil
+import pytest
+
+import app as app_module
+from werkzeug.security import generate_password_hash
+
+@pytest.fixture()
+def client():
+    tmpdir = tempfile.mkdtemp()
+    app = app_module.app
+    app.config['DATABASE'] = os.path.join(tmpdir, 'test.db')
+    os.environ['FORCE_SQLITE'] = '1'
+    with app.test_client() as client:
+        with app.app_context():
+            app_module.init_db()
+            db = app_module.get_db()
+            db.execute("DELETE FROM users")
+            db.execute("INSERT INTO users (username, email, password, role) VALUES (?, ?, ?, ?)",
+                       ('admin', 'admin@example.com', generate_password_hash('admin123'), 'admin'))
+            db.execute("INSERT INTO customers (id, name, email, password) VALUES (1, 'Buyer', 'buyer@example.com', 'x')")
+            db.execute("DELETE FROM products")
+            db.execute("INSERT INTO products (id, name, price, qty, reorder_level) VALUES (1, 'Idem Block', 100, 50, 0)")
+            db.commit()
+        client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+        yield client
+    shutil.rmtree(tmpdir)
+
+
+def _count(sql):
+    with app_module.app.app_context():
+        return app_module.get_db().execute(sql).fetchone()[0]
+
+
+def test_form_renders_key_and_duplicate_post_is_replayed(client):
+    page = client.get('/orders/add').get_data(as_text=True)
+    key = re.search(r'name="_idempotency_key" value="([^"]+)"', page).group(1)
+    form = {'customer_id': '1', 'product_id': '1', 'qty': '3', 'account_number': 'REF1', '_idempotency_key': key}
+    first = client.post('/orders/add', data=form)
+    second = client.post('/orders/add', data=form)
+    assert first.status_code == second.status_code == 302
+    assert second.headers['Location'] == first.headers['Location']
+    assert second.headers.get('Idempotent-Replayed') == 'true'
+    assert _count('SELECT COUNT(*) FROM orders') == 1
+    assert _count('SELECT COUNT(*) FROM payments') == 1
+    assert _count('SELECT qty FROM products WHERE id = 1') == 47
+    # the replay carries the original flash message
+    assert 'Order created' in client.get('/orders').get_data(as_text=True)
+
+    # a fresh form gets a fresh key
+    assert key not in client.get('/orders/add').get_data(as_text=True)
+
+
+def test_header_key_reused_with_different_body_is_rejected(client):
+    headers = {'Idempotency-Key': 'sale-1'}
+    sale = {'product_id': '1', 'qty': '2', 'amount': '200'}
+    client.post('/admin/sales', data=sale, headers=headers)
+    client.post('/admin/sales', data=sale, headers=headers)
+    assert _count('SELECT COUNT(*) FROM sales') == 1
+    clash = client.post('/admin/sales', data=dict(sale, qty='5'), headers=headers)
+    assert clash.status_code == 422
+    assert _count('SELECT COUNT(*) FROM sales') == 1
+    # without a key the route behaves as before
+    client.post('/admin/sales', data=sale)
+    assert _count('SELECT COUNT(*) FROM sales') == 2
+
+
+def test_failed_request_releases_key_and_expired_keys_are_purged(client, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'PROPAGATE_EXCEPTIONS', True)
+    headers = {'Idempotency-Key': 'bad-order'}
+    with pytest.raises(ValueError):
+        client.post('/orders/add', data={'customer_id': '1', 'product_id': '1', 'qty': 'lots'}, headers=headers)
+    assert _count('SELECT COUNT(*) FROM idempotency_keys') == 0
+
+    client.post('/payments/mark_paid/1', headers={'Idempotency-Key': 'pay-1'})
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        db.execute("UPDATE idempotency_keys SET expires_at = '2000-01-01 00:00:00'")
+        db.commit()
+        assert app_module.purge_idempotency_keys(db) == 1
+
+
+def test_refused_form_post_goes_back_to_a_page_that_answers_get(client, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'IDEMPOTENCY_WAIT_SECONDS', 0)
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        uid = db.execute("SELECT id FROM users WHERE username = 'admin'").fetchone()['id']
+        # the same key still in flight, from a submission with other details
+        db.execute("INSERT INTO idempotency_keys (scope, idem_key, request_hash, created_at, expires_at) "
+                   "VALUES (?, 'pay-form', 'other', '2030-01-01 00:00:00', '2030-01-02 00:00:00')", (f'{uid}:mark_paid',))
+        db.commit()
+    form = {'_idempotency_key': 'pay-form'}
+    rv = client.post('/payments/mark_paid/1', data=form, headers={'Referer': 'http://localhost/payments?page=2'})
+    assert rv.status_code == 302 and rv.headers['Location'] == '/payments?page=2'
+    # mark_paid is POST-only, so without a referrer it must not redirect to itself
+    rv = client.post('/payments/mark_paid/1', data=form)
+    assert rv.headers['Location'] == '/'
+    rv = client.post('/payments/mark_paid/1', data=form, headers={'Referer': 'https://elsewhere.example/x'})
+    assert rv.headers['Location'] == '/'
+    assert client.get(rv.headers['Location']).status_code == 200
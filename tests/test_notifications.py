@@ -57,3 +57,84 @@ def test_order_creates_notification(client):
     notif_page = client.get('/admin/notifications')
     assert notif_page.status_code == 200
     assert b'New order #' in notif_page.data
+
+
+def test_low_stock_alert_is_raised_once(client):
+    login(client)
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        prod_id = db.execute("SELECT id FROM products WHERE name = ?", ('Block A',)).fetchone()['id']
+    # 50 -> 10 stays above the reorder level of 5, 10 -> 4 crosses it, 4 -> 3 is already low
+    for qty in (40, 6, 1):
+        client.post('/admin/sales', data={'product_id': prod_id, 'qty': qty, 'amount': 100})
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        rows = db.execute("SELECT * FROM notifications WHERE dedupe_key = ?",
+                          (f'low_stock:product:{prod_id}',)).fetchall()
+        qty = db.execute("SELECT qty FROM products WHERE id = ?", (prod_id,)).fetchone()['qty']
+    assert qty == 3
+    assert len(rows) == 1
+    assert 'Block A' in rows[0]['title']
+
+
+def test_low_stock_email_waits_for_commit(client, monkeypatch):
+    sent = []
+    monkeypatch.setattr(app_module, 'enqueue_email', lambda subject, body, to: sent.append(subject))
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        prod_id = db.execute("SELECT id FROM products WHERE name = ?", ('Block A',)).fetchone()['id']
+    # rolled back: the alert row disappears and no email goes out
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        app_module.change_product_stock(db, prod_id, -48, source='sale')
+        assert sent == []
+        db.rollback()
+    assert sent == []
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        app_module.change_product_stock(db, prod_id, -48, source='sale')
+        db.commit()
+        assert sent == []  # not before the work is over
+    assert sent == ['Low stock: Block A']
+
+
+def test_notification_stream_and_batch_mark_read(client, monkeypatch):
+    login(client)
+    monkeypatch.setitem(app_module.app.config, 'SSE_ENABLED', True)
+    app_module.app.config['SSE_MAX_STREAM_SECONDS'] = 0.5
+    app_module.notification_feed = app_module.NotificationFeed(poll_seconds=0.1)
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        for i in range(3):
+            db.execute("INSERT INTO notifications (title, message) VALUES (?, ?)", (f'Note {i}', ''))
+        db.commit()
+        ids = [r['id'] for r in db.execute("SELECT id FROM notifications ORDER BY id").fetchall()]
+    resp = client.get(f'/admin/notifications/stream?since={ids[0]}')
+    body = resp.get_data(as_text=True)
+    assert resp.mimetype == 'text/event-stream'
+    assert 'Note 0' not in body and 'Note 1' in body and 'Note 2' in body
+    assert '"unread": 3' in body
+
+    rv = client.post('/admin/notifications/mark_read', json={'ids': ids[:2]})
+    assert rv.get_json() == {'ok': True, 'unread': 1}
+    assert client.get('/admin/notifications/unread').get_json() == {'unread': 1}
+
+
+def test_sync_workers_poll_instead_of_streaming(client, monkeypatch):
+    login(client)
+    monkeypatch.setitem(app_module.app.config, 'SSE_ENABLED', False)
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        db.execute("INSERT INTO notifications (title, message) VALUES ('Old', '')")
+        db.commit()
+        old_id = db.execute("SELECT MAX(id) AS m FROM notifications").fetchone()['m']
+    page = client.get('/admin/notifications').get_data(as_text=True)
+    assert 'EventSource' not in page and f'var since = {old_id};' in page
+    # a stream request doesn't hold a worker: EventSource gets 204 and stops
+    assert client.get('/admin/notifications/stream').status_code == 204
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        db.execute("INSERT INTO notifications (title, message) VALUES ('New', '')")
+        db.commit()
+    data = client.get(f'/admin/notifications/unread?since={old_id}').get_json()
+    assert data['unread'] == 2 and [n['title'] for n in data['notifications']] == ['New']
@@ -0,0 +1,118 @@
+import os
+import tempfile
+import shutil
+import pytest
+
+import app as app_module
+from werkzeug.security import generate_password_hash
+
+@pytest.fixture()
+def client():
+    tmpdir = tempfile.mkdtemp()
+    app = app_module.app
+    app.config['DATABASE'] = os.path.join(tmpdir, 'test.db')
+    os.environ['FORCE_SQLITE'] = '1'
+    with app.test_client() as client:
+        with app.app_context():
+            app_module.init_db()
+            db = app_module.get_db()
+            db.execute("DELETE FROM users")
+            db.execute("INSERT INTO users (username, email, password, role) VALUES (?, ?, ?, ?)",
+                       ('admin', 'admin@example.com', generate_password_hash('admin123'), 'admin'))
+            db.execute("INSERT INTO products (name, price, qty, reorder_level) VALUES ('Block A', 100, 10, 5)")
+            db.execute("INSERT INTO raw_materials (name, qty, reorder_level) VALUES ('Cement', 20, 2)")
+            db.execute("INSERT INTO raw_materials (name, qty, reorder_level) VALUES ('Sand', 5, 1)")
+            db.commit()
+        client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+        yield client
+    shutil.rmtree(tmpdir)
+
+
+def _ids():
+    db = app_module.get_db()
+    pid = db.execute("SELECT id FROM products WHERE name = 'Block A'").fetchone()['id']
+    cement = db.execute("SELECT id FROM raw_materials WHERE name = 'Cement'").fetchone()['id']
+    sand = db.execute("SELECT id FROM raw_materials WHERE name = 'Sand'").fetchone()['id']
+    return pid, cement, sand
+
+
+def test_day_of_shifts_is_all_or_nothing(client):
+    with app_module.app.app_context():
+        pid, cement, sand = _ids()
+    client.post('/admin/production/recipes', data={'product_id': pid, 'material_id': cement, 'qty_per_100': 4})
+    client.post('/admin/production/recipes', data={'product_id': pid, 'material_id': sand, 'qty_per_100': 1})
+
+    rv = client.post('/api/v1/production/batches', json={'produced_on': '2025-06-01', 'batches': [
+        {'product_id': pid, 'qty': 200, 'shift': 'morning'},
+        {'product_id': pid, 'qty': 100, 'shift': 'evening'},
+    ]})
+    assert rv.status_code == 201
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        assert db.execute("SELECT qty FROM products WHERE id = ?", (pid,)).fetchone()['qty'] == 310
+        assert db.execute("SELECT qty FROM raw_materials WHERE id = ?", (cement,)).fetchone()['qty'] == 8
+        assert db.execute("SELECT SUM(qty) AS s FROM finished_blocks").fetchone()['s'] == 300
+
+    # second shift needs more sand (3) than is left (2): nothing from this day is kept
+    rv = client.post('/api/v1/production/batches', json={'batches': [
+        {'product_id': pid, 'qty': 100}, {'product_id': pid, 'qty': 300}]})
+    assert rv.status_code == 400 and rv.get_json()['index'] == 1
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        assert db.execute("SELECT qty FROM products WHERE id = ?", (pid,)).fetchone()['qty'] == 310
+        assert db.execute("SELECT qty FROM raw_materials WHERE id = ?", (sand,)).fetchone()['qty'] == 2
+        assert db.execute("SELECT COUNT(*) AS c FROM production_batches").fetchone()['c'] == 2
+
+
+def test_material_plan_uses_sales_velocity(client):
+    with app_module.app.app_context():
+        pid, cement, sand = _ids()
+        db = app_module.get_db()
+        db.execute("INSERT INTO bom_recipes (product_id, material_id, qty_per_100) VALUES (?, ?, 10)", (pid, cement))
+        today = app_module.datetime.utcnow().date().isoformat()
+        db.execute("INSERT INTO sales (sale_date, amount, product_id, qty) VALUES (?, 0, ?, 56)", (today, pid))
+        db.commit()
+    plan = client.get('/admin/production/plan.json').get_json()['materials']
+    assert plan[0]['name'] == 'Cement'
+    assert plan[0]['daily_use'] == 0.2        # 56 blocks / 28 days * 10 per 100
+    assert plan[0]['days_of_cover'] == 100.0
+    assert plan[1]['days_of_cover'] is None   # sand isn't in any recipe
+
+
+class _PostgresLike:
+    """Runs on SQLite but, like psycopg2, has no usable lastrowid."""
+    dialect = 'postgres'
+
+    class _Cursor:
+        lastrowid = None
+
+        def __init__(self, cur):
+            self._cur = cur
+            self.rowcount = cur.rowcount
+
+        def fetchone(self):
+            return self._cur.fetchone()
+
+        def fetchall(self):
+            return self._cur.fetchall()
+
+    def __init__(self, db):
+        self._db = db
+
+    def execute(self, sql, params=()):
+        return self._Cursor(self._db.execute(sql, params))
+
+
+def test_batch_ids_come_from_returning_on_postgres(client):
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        pid, cement, _ = _ids()
+        db.execute("INSERT INTO bom_recipes (product_id, material_id, qty_per_100) VALUES (?, ?, 10)", (pid, cement))
+        first = app_module.record_production_batch(_PostgresLike(db), pid, 20, shift='morning')
+        second = app_module.record_production_batch(_PostgresLike(db), pid, 10, shift='night')
+        db.commit()
+        batches = db.execute("SELECT id, qty, finished_block_id FROM production_batches ORDER BY id").fetchall()
+        assert [(b['id'], b['qty']) for b in batches] == [(first, 20), (second, 10)]
+        assert all(b['finished_block_id'] is not None for b in batches)
+        refs = db.execute("SELECT ref_id FROM stock_movements WHERE movement_type = 'production' ORDER BY id").fetchall()
+        assert [r['ref_id'] for r in refs] == [first, second]
@@ -0,0 +1,79 @@
+import logging
+import os
+import tempfile
+import shutil
+import pytest
+
+import app as app_module
+from werkzeug.security import generate_password_hash
+
+@pytest.fixture()
+def client():
+    tmpdir = tempfile.mkdtemp()
+    app = app_module.app
+    app.config['DATABASE'] = os.path.join(tmpdir, 'test.db')
+    os.environ['FORCE_SQLITE'] = '1'
+    with app.test_client() as client:
+        with app.app_context():
+            app_module.init_db()
+            db = app_module.get_db()
+            db.execute("DELETE FROM users")
+            db.execute("INSERT INTO users (username, email, password, role) VALUES (?, ?, ?, ?)",
+                       ('admin', 'admin@example.com', generate_password_hash('admin123'), 'admin'))
+            db.commit()
+        client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+        yield client
+    shutil.rmtree(tmpdir)
+
+
+SLOW_SQL = ('WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?) '
+            'SELECT SUM(i) AS s FROM n')
+
+
+@app_module.app.route('/_test/slow_report')
+@app_module.query_budget(0.05)
+def _slow_report():
+    return {'s': app_module.get_db().execute(SLOW_SQL, (10 ** 9,)).fetchone()['s']}
+
+
+@app_module.app.route('/_test/swallowing_report')
+@app_module.query_budget(0.05)
+def _swallowing_report():
+    try:
+        app_module.get_db().execute(SLOW_SQL, (10 ** 9,)).fetchone()
+    except Exception:
+        pass
+    return 'partial'
+
+
+def test_slow_query_is_cancelled_with_narrow_range_page(client, caplog):
+    with caplog.at_level(logging.WARNING):
+        resp = client.get('/_test/slow_report')
+    assert resp.status_code == 503
+    assert b'narrow the date range' in resp.data
+    logged = [r.getMessage() for r in caplog.records if 'Query budget' in r.getMessage()]
+    assert logged and 'i < 1000000000' in logged[0]
+
+
+def test_view_swallowing_the_interrupt_still_gets_timeout_page(client):
+    assert client.get('/_test/swallowing_report').status_code == 503
+
+
+def test_budget_overrun_is_raised_and_handled_in_one_place(client, monkeypatch):
+    # the decorator raises; only the error handler builds the response, and it
+    # does so even when exceptions would otherwise propagate
+    monkeypatch.setitem(app_module.app.config, 'PROPAGATE_EXCEPTIONS', True)
+    resp = client.get('/_test/slow_report', headers={'Accept': 'application/json'})
+    assert resp.status_code == 503 and 'narrow the date range' in resp.get_json()['error']
+    with app_module.app.app_context(), app_module.app.test_request_context('/_test/slow_report'):
+        with pytest.raises(app_module.QueryBudgetExceeded) as exc:
+            _slow_report()
+    assert exc.value.seconds == 0.05 and 'i < 1000000000' in exc.value.statement
+
+
+def test_report_within_budget_and_handler_removed(client):
+    assert client.get('/admin/reconciliation?start=2024-01-01&end=2024-12-31').status_code == 200
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        # outside a budget nothing interrupts long statements
+        assert db.execute(SLOW_SQL, (200000,)).fetchone()['s'] == 200000 * 200001 // 2
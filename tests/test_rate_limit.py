@@ -0,0 +1,60 @@
+import os
+import tempfile
+import shutil
+import pytest
+
+import app as app_module
+from werkzeug.security import generate_password_hash
+
+@pytest.fixture()
+def client():
+    tmpdir = tempfile.mkdtemp()
+    app = app_module.app
+    app.config['DATABASE'] = os.path.join(tmpdir, 'test.db')
+    os.environ['FORCE_SQLITE'] = '1'
+    with app.test_client() as client:
+        with app.app_context():
+            app_module.init_db()
+            db = app_module.get_db()
+            db.execute("DELETE FROM users")
+            db.execute("INSERT INTO users (username, email, password, role) VALUES (?, ?, ?, ?)",
+                       ('admin', 'admin@example.com', generate_password_hash('admin123'), 'admin'))
+            db.commit()
+        yield client
+    shutil.rmtree(tmpdir)
+
+
+def test_token_bucket_refills_continuously(client):
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        assert [app_module.take_token(db, 't', 3, 30, now=100) for _ in range(3)] == [0, 0, 0]
+        wait = app_module.take_token(db, 't', 3, 30, now=100)
+        assert wait == pytest.approx(10)
+        # one token back after 10s, not a whole new window
+        assert app_module.take_token(db, 't', 3, 30, now=110) == 0
+        assert app_module.take_token(db, 't', 3, 30, now=110) == pytest.approx(10)
+
+
+def test_login_is_limited_per_account_before_hashing(client, monkeypatch):
+    hashes = []
+    real_verify = app_module.credentials.verify
+    monkeypatch.setattr(app_module.credentials, 'verify', lambda *a: hashes.append(1) or real_verify(*a))
+    for _ in range(5):
+        assert client.post('/login', data={'username': 'admin', 'password': 'wrong'}).status_code == 200
+    limited = client.post('/login', data={'username': 'ADMIN', 'password': 'admin123'})
+    assert limited.status_code == 429
+    assert int(limited.headers['Retry-After']) >= 1
+    assert len(hashes) == 5
+    # other accounts from the same address still get through
+    assert client.post('/login', data={'username': 'someone', 'password': 'x'}).status_code == 200
+
+
+def test_limits_are_per_client_ip_behind_proxy(client, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'TRUSTED_PROXIES', 1)
+    monkeypatch.setitem(app_module.app.config, 'RATE_LIMITS', {'register': app_module.parse_rate_rules('ip:2/600')})
+    form = {'name': 'N', 'email': 'dup@example.com', 'password': 'pw'}
+    first = {'X-Forwarded-For': '203.0.113.5'}
+    assert client.post('/register', data=form, headers=first).status_code == 302
+    assert client.post('/register', data=form, headers=first).status_code == 302
+    assert client.post('/register', data=form, headers=first).status_code == 429
+    assert client.post('/register', data=form, headers={'X-Forwarded-For': '198.51.100.7'}).status_code == 302
@@ -0,0 +1,72 @@
+import os
+import sqlite3
+import tempfile
+import shutil
+import pytest
+
+import app as app_module
+from werkzeug.security import generate_password_hash
+
+@pytest.fixture()
+def client(monkeypatch):
+    tmpdir = tempfile.mkdtemp()
+    app = app_module.app
+    app.config['DATABASE'] = os.path.join(tmpdir, 'test.db')
+    os.environ['FORCE_SQLITE'] = '1'
+    monkeypatch.setitem(app.config, 'REPORT_SNAPSHOT', True)
+    monkeypatch.setitem(app.config, 'REPORT_SNAPSHOT_MAX_AGE', 3600)
+    with app.test_client() as client:
+        with app.app_context():
+            app_module.init_db()
+            db = app_module.get_db()
+            db.execute("DELETE FROM users")
+            db.execute("INSERT INTO users (username, email, password, role) VALUES (?, ?, ?, ?)",
+                       ('admin', 'admin@example.com', generate_password_hash('admin123'), 'admin'))
+            db.execute("INSERT INTO ledger (date, description, amount, balance) VALUES ('2024-01-01', 'Opening float', 100, 100)")
+            db.commit()
+        client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+        yield client
+    shutil.rmtree(tmpdir)
+
+
+def _add_ledger(description):
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        db.execute("INSERT INTO ledger (date, description, amount, balance) VALUES ('2024-01-02', ?, 5, 105)", (description,))
+        db.commit()
+
+
+def test_reports_read_snapshot_until_refreshed(client):
+    first = client.get('/ledger').get_data(as_text=True)
+    assert 'Opening float' in first and 'Data as of' in first
+    assert os.path.exists(app_module.report_snapshot_path())
+
+    _add_ledger('Late delivery')
+    assert 'Late delivery' not in client.get('/ledger').get_data(as_text=True)
+    # writes still go to the live database, and non-report pages read it
+    assert 'Data as of' not in client.get('/orders').get_data(as_text=True)
+
+    assert app_module.refresh_report_snapshot() is False  # still fresh
+    assert app_module.refresh_report_snapshot(force=True) is True
+    assert 'Late delivery' in client.get('/ledger').get_data(as_text=True)
+
+
+def test_snapshot_connection_is_read_only(client):
+    client.get('/ledger')
+    with app_module.app.test_request_context('/ledger'):
+        conn, as_of = app_module.open_report_db()
+        try:
+            assert as_of is not None
+            with pytest.raises(sqlite3.OperationalError):
+                conn.execute("DELETE FROM ledger")
+        finally:
+            conn.close()
+
+
+def test_stale_snapshot_falls_back_to_live(client, monkeypatch):
+    client.get('/ledger')
+    os.utime(app_module.report_snapshot_path(), (1, 1))
+    monkeypatch.setitem(app_module.app.config, 'REPORT_SNAPSHOT_MAX_STALENESS', 60)
+    _add_ledger('Fresh entry')
+    page = client.get('/ledger').get_data(as_text=True)
+    assert 'Fresh entry' in page and 'Data as of' not in page
@@ -0,0 +1,110 @@
+import json
+import os
+import tempfile
+import shutil
+import pytest
+
+import app as app_module
+from werkzeug.security import generate_password_hash
+
+@pytest.fixture()
+def client():
+    tmpdir = tempfile.mkdtemp()
+    app = app_module.app
+    app.config['DATABASE'] = os.path.join(tmpdir, 'test.db')
+    os.environ['FORCE_SQLITE'] = '1'
+    with app.test_client() as client:
+        with app.app_context():
+            app_module.init_db()
+            db = app_module.get_db()
+            db.execute("DELETE FROM users")
+            db.execute("INSERT INTO users (username, email, password, role) VALUES (?, ?, ?, ?)",
+                       ('admin', 'admin@example.com', generate_password_hash('admin123'), 'admin'))
+            db.execute("INSERT INTO products (name, price, qty, reorder_level) VALUES ('Block A', 100, 1000, 5)")
+            db.execute("INSERT INTO products (name, price, qty, reorder_level) VALUES ('Block B', 100, 50, 5)")
+            db.commit()
+        client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+        yield client
+    shutil.rmtree(tmpdir)
+
+
+def _products():
+    with app_module.app.app_context():
+        rows = app_module.get_db().execute("SELECT id, name, qty FROM products WHERE name LIKE 'Block _'").fetchall()
+        return {r['name']: (r['id'], r['qty']) for r in rows}
+
+
+def _post(client, events, extra=''):
+    body = '\n'.join(json.dumps(e) for e in events) + extra
+    return client.post('/api/v1/scan-events', data=body, content_type='application/x-ndjson')
+
+
+def test_scan_batch_is_validated_deduplicated_and_applied_in_chunks(client, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'SCAN_CHUNK_SIZE', 3)
+    (a, _), (b, _) = _products()['Block A'], _products()['Block B']
+    events = [{'client_event_id': f'tab1-{i}', 'type': 'loadout', 'product_id': a, 'qty': 10} for i in range(5)]
+    events += [
+        {'client_event_id': 'tab1-5', 'type': 'production', 'product_id': a, 'qty': 200},
+        {'client_event_id': 'tab1-6', 'type': 'breakage', 'product_id': b, 'qty': 3},
+        {'client_event_id': 'tab1-0', 'type': 'loadout', 'product_id': a, 'qty': 10},   # repeated in batch
+        {'client_event_id': 'tab1-7', 'type': 'theft', 'product_id': a, 'qty': 1},
+        {'client_event_id': 'tab1-8', 'type': 'receipt', 'product_id': 999, 'qty': 1},
+        {'client_event_id': 'tab1-9', 'type': 'receipt', 'product_id': a, 'qty': -4},
+    ]
+    rv = _post(client, events, extra='\n{not json')
+    data = rv.get_json()
+    assert rv.status_code == 200 and data['accepted'] == 7 and data['duplicates'] == 0
+    assert sorted(r['line'] for r in data['rejected']) == [8, 9, 10, 11, 12]
+    assert _products() == {'Block A': (a, 1000 - 50 + 200), 'Block B': (b, 47)}
+
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        moves = db.execute("SELECT movement_type, qty_delta, qty_after FROM stock_movements WHERE product_id = ? ORDER BY id",
+                           (a,)).fetchall()
+        assert sum(m['qty_delta'] for m in moves) == 150 and moves[-1]['qty_after'] == 1150
+        assert db.execute('SELECT COUNT(*) AS c FROM scan_batches').fetchone()['c'] == 3
+
+    # a resend after a timeout changes nothing
+    rv = _post(client, events[:7])
+    assert rv.get_json()['accepted'] == 0 and rv.get_json()['duplicates'] == 7
+    assert _products()['Block A'][1] == 1150
+
+
+def test_scan_ingestion_signals_backpressure(client):
+    app_module._scan_slots.acquire()
+    try:
+        rv = _post(client, [{'client_event_id': 'x', 'type': 'receipt', 'product_id': 1, 'qty': 1}])
+        assert rv.status_code == 429 and rv.headers['Retry-After']
+    finally:
+        app_module._scan_slots.release()
+    assert client.post('/api/v1/scan-events', data='[{"broken"', content_type='application/json').status_code == 400
+
+
+def test_scan_batch_id_comes_from_returning_on_postgres(client):
+    class PostgresLike:
+        # psycopg2 cursors have no usable lastrowid
+        dialect = 'postgres'
+
+        def __init__(self, db):
+            self.db = db
+
+        def execute(self, sql, params=()):
+            cur = self.db.execute(sql, params)
+            return type('Cursor', (), {'lastrowid': None, 'rowcount': cur.rowcount,
+                                       'fetchone': lambda s: cur.fetchone(), 'fetchall': lambda s: cur.fetchall(),
+                                       '__iter__': lambda s: iter(cur)})()
+
+        def executemany(self, sql, rows):
+            return self.db.executemany(sql, rows)
+
+    a = _products()['Block A'][0]
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        db.execute("INSERT INTO scan_batches (device_id, events) VALUES ('older', 0)")
+        chunk = [{'client_event_id': f'pg-{i}', 'type': 'receipt', 'product_id': a, 'qty': 1, 'scanned_at': None}
+                 for i in range(2)]
+        assert app_module.apply_scan_chunk(PostgresLike(db), chunk, device_id='tab2') == (2, [])
+        db.commit()
+        batch = db.execute("SELECT id FROM scan_batches WHERE device_id = 'tab2'").fetchone()['id']
+        linked = db.execute("SELECT batch_id FROM scan_events WHERE client_event_id LIKE 'pg-%'").fetchall()
+        assert [r['batch_id'] for r in linked] == [batch, batch]
@@ -0,0 +1,81 @@
+import gzip
+import os
+import shutil
+
+import pytest
+
+import app as app_module
+import assets
+
+
+@pytest.fixture()
+def client():
+    with app_module.app.test_client() as client:
+        yield client
+
+
+def test_build_is_content_addressed_and_incremental(tmp_path):
+    (tmp_path / 'site.css').write_text('body { color: #333; }\n' * 40)
+    (tmp_path / 'logo.png').write_bytes(b'\x89PNG' + b'\0' * 600)
+    files = assets.build_assets(str(tmp_path))
+    css = files['site.css']
+    assert css.startswith('build/site.') and css.endswith('.css')
+    assert gzip.decompress((tmp_path / (css + '.gz')).read_bytes()) == (tmp_path / 'site.css').read_bytes()
+    assert not (tmp_path / (files['logo.png'] + '.gz')).exists()
+    assert assets.build_assets(str(tmp_path)) == files
+
+    # saving the source in place must not touch the fingerprinted copy
+    (tmp_path / 'site.css').write_text('body { color: #000; }\n' * 40)
+    assert (tmp_path / css).read_text() == 'body { color: #333; }\n' * 40
+    assert assets.build_assets(str(tmp_path))['site.css'] != css
+
+    # a hard link left by an older build is replaced with a copy
+    logo = tmp_path / files['logo.png']
+    logo.unlink()
+    os.link(tmp_path / 'logo.png', logo)
+    assets.build_assets(str(tmp_path))
+    assert not logo.samefile(tmp_path / 'logo.png') and logo.read_bytes() == (tmp_path / 'logo.png').read_bytes()
+    assert 'gzip_static on;' in assets.nginx_snippet('/srv/static')
+
+
+@pytest.fixture()
+def built_static(tmp_path):
+    """A copy of static/ with a fresh asset build, as the deploy step leaves it."""
+    app = app_module.app
+    original = app.static_folder
+    static = tmp_path / 'static'
+    shutil.copytree(original, static, ignore=shutil.ignore_patterns(assets.BUILD_DIR))
+    assets.build_assets(str(static))
+    app.static_folder = str(static)
+    app_module.load_asset_manifest()
+    yield static
+    app.static_folder = original
+    app_module.load_asset_manifest()
+
+
+def test_loading_the_manifest_never_builds(tmp_path, monkeypatch):
+    monkeypatch.setattr(app_module.app, 'static_folder', str(tmp_path))
+    (tmp_path / 'style.css').write_text('body {}\n')
+    assert app_module.load_asset_manifest() == {}
+    assert list(tmp_path.iterdir()) == [tmp_path / 'style.css']
+    with app_module.app.test_request_context():
+        assert app_module.url_for('static', filename='style.css') == '/static/style.css'
+    monkeypatch.undo()
+    app_module.load_asset_manifest()
+
+
+def test_static_urls_are_fingerprinted_and_served_immutable(client, built_static):
+    with app_module.app.test_request_context():
+        url = app_module.url_for('static', filename='style.css')
+    assert url.startswith('/static/build/style.') and url.endswith('.css')
+
+    rv = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert rv.status_code == 200
+    assert rv.headers['Content-Encoding'] == 'gzip' and rv.mimetype == 'text/css'
+    assert 'immutable' in rv.headers['Cache-Control'] and 'Accept-Encoding' in rv.headers['Vary']
+    assert b'body' in gzip.decompress(rv.data)
+    assert client.get(url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': rv.headers['ETag']}).status_code == 304
+
+    plain = client.get(url)
+    assert 'Content-Encoding' not in plain.headers and b'body' in plain.data
+    assert client.get('/static/build/../app.py').status_code == 404
@@ -0,0 +1,95 @@
+import os
+import tempfile
+import shutil
+import sqlite3
+import pytest
+
+import app as app_module
+from werkzeug.security import generate_password_hash
+
+@pytest.fixture()
+def client():
+    tmpdir = tempfile.mkdtemp()
+    app = app_module.app
+    app.config['DATABASE'] = os.path.join(tmpdir, 'test.db')
+    os.environ['FORCE_SQLITE'] = '1'
+    with app.test_client() as client:
+        with app.app_context():
+            app_module.init_db()
+            db = app_module.get_db()
+            db.execute("DELETE FROM users")
+            db.execute("INSERT INTO users (username, email, password, role) VALUES (?, ?, ?, ?)",
+                       ('admin', 'admin@example.com', generate_password_hash('admin123'), 'admin'))
+            db.execute("INSERT INTO products (name, price, qty, reorder_level) VALUES (?, ?, ?, ?)",
+                       ('Block A', 100.0, 50, 5))
+            db.commit()
+        client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+        yield client
+    shutil.rmtree(tmpdir)
+
+
+def _product_id():
+    return app_module.get_db().execute("SELECT id FROM products WHERE name = 'Block A'").fetchone()['id']
+
+
+def test_mutations_are_journaled(client):
+    with app_module.app.app_context():
+        pid = _product_id()
+    client.post('/admin/sales', data={'product_id': pid, 'qty': 10, 'amount': 1000})
+    client.post('/admin/breakages', data={'product_id': pid, 'qty': 2})
+    client.post(f'/admin/products/adjust/{pid}', data={'delta': 7, 'reason': 'count'})
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        moves = db.execute("SELECT movement_type, qty_delta, qty_after FROM stock_movements WHERE product_id = ? ORDER BY id",
+                           (pid,)).fetchall()
+        assert [tuple(m) for m in moves] == [('sale', -10, 40), ('breakage', -2, 38), ('adjustment', 7, 45)]
+        assert db.execute("SELECT qty FROM products WHERE id = ?", (pid,)).fetchone()['qty'] == 45
+        assert app_module.stock_qty_at(db, pid, '9999-01-01 00:00:00') == 45
+        assert app_module.stock_qty_at(db, pid, '2000-01-01 00:00:00') == 50
+        with pytest.raises(sqlite3.DatabaseError):
+            db.execute("DELETE FROM stock_movements")
+
+
+def test_snapshots_bound_history_reads(client, monkeypatch):
+    monkeypatch.setattr(app_module, 'STOCK_SNAPSHOT_INTERVAL', 3)
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        pid = _product_id()
+        for _ in range(7):
+            app_module.change_product_stock(db, pid, -1, source='sale')
+        db.commit()
+        snaps = db.execute("SELECT movement_id, qty FROM stock_snapshots WHERE product_id = ? ORDER BY movement_id",
+                           (pid,)).fetchall()
+        assert [s['qty'] for s in snaps] == [50, 47, 44]
+        assert app_module.stock_qty_at(db, pid, '9999-01-01 00:00:00') == 43
+
+    rv = client.get('/admin/reconciliation?start=2000-01-01&end=9998-12-31')
+    assert rv.status_code == 200
+
+
+def test_reconciliation_counts_pre_journal_history(client):
+    from flask import template_rendered
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        pid = _product_id()
+        # recorded before the journal existed: stock went 57 -> 47 -> 45 -> 50
+        db.execute("INSERT INTO sales (sale_date, amount, product_id, qty) VALUES ('2023-05-10', 1000, ?, 10)", (pid,))
+        db.execute("INSERT INTO breakages (product_id, qty, date) VALUES (?, 2, '2023-05-11T09:00:00')", (pid,))
+        db.execute("INSERT INTO product_audit (product_id, user, action, field, old_value, new_value, reason, timestamp) "
+                   "VALUES (?, 'admin', 'adjust', 'qty', '45', '50', 'count', '2023-05-12 10:00:00')", (pid,))
+        db.commit()
+    client.post('/admin/sales', data={'product_id': pid, 'qty': 3, 'amount': 300})
+
+    def reconcile(start, end):
+        seen = []
+
+        def capture(sender, template, context, **extra):
+            seen.append(context['result'])
+        with template_rendered.connected_to(capture, app_module.app):
+            assert client.get(f'/admin/reconciliation?start={start}&end={end}').status_code == 200
+        row = [r for r in seen[0] if r['id'] == pid][0]
+        return row['opening'], row['sold'], row['broken'], row['adjustments'], row['closing']
+
+    assert reconcile('2023-05-01', '2023-05-31') == (57, 10, 2, 5, 50)
+    assert reconcile('2023-05-11', '2023-05-11') == (47, 0, 2, 0, 45)
+    assert reconcile('2000-01-01', '9998-12-31') == (57, 13, 2, 5, 47)
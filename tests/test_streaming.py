@@ -0,0 +1,156 @@
+import os
+import sqlite3
+import tempfile
+import shutil
+import zlib
+import pytest
+
+import app as app_module
+from werkzeug.security import generate_password_hash
+
+@pytest.fixture()
+def client(monkeypatch):
+    tmpdir = tempfile.mkdtemp()
+    app = app_module.app
+    app.config['DATABASE'] = os.path.join(tmpdir, 'test.db')
+    os.environ['FORCE_SQLITE'] = '1'
+    monkeypatch.setitem(app.config, 'STREAM_FETCH_SIZE', 50)
+    monkeypatch.setitem(app.config, 'STREAM_CHUNK_BYTES', 4096)
+    with app.test_client() as client:
+        with app.app_context():
+            app_module.init_db()
+            db = app_module.get_db()
+            db.execute("DELETE FROM users")
+            db.execute("INSERT INTO users (username, email, password, role) VALUES (?, ?, ?, ?)",
+                       ('admin', 'admin@example.com', generate_password_hash('admin123'), 'admin'))
+            db.executemany("INSERT INTO orders (customer_id, order_date, status, total) VALUES (NULL, ?, 'Pending', ?)",
+                           [(f'2024-01-01 10:{i // 60:02d}:{i % 60:02d}', 1000 + i) for i in range(1000)])
+            db.commit()
+        client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+        yield client
+    shutil.rmtree(tmpdir)
+
+
+def test_list_page_streams_head_before_rows(client):
+    rv = client.get('/orders', buffered=False)
+    assert rv.status_code == 200 and rv.is_streamed
+    chunks = [c for c in rv.response if c]
+    rv.close()
+    head = chunks[0].decode()
+    assert '<html' in head.lower() and '₦1999' not in head
+    page = b''.join(chunks).decode()
+    assert page.count('<tr>') == 1001 and '₦1999' in page and page.rstrip().endswith('</html>')
+    # rows arrive in pieces of about STREAM_CHUNK_BYTES, not as one string
+    assert len(chunks) > 10 and max(len(c) for c in chunks) < 3 * 4096
+
+
+def test_rows_are_read_in_batches(client):
+    fetched = []
+
+    class Cursor:
+        def __init__(self, cur):
+            self.cur = cur
+
+        def fetchone(self):
+            return self.cur.fetchone()
+
+        def fetchmany(self, size):
+            rows = self.cur.fetchmany(size)
+            fetched.append(len(rows))
+            return rows
+
+        def close(self):
+            self.cur.close()
+
+    # a default database, no write coordinator: init_db has put it in WAL mode
+    assert app_module.app.config['WRITE_COORDINATOR'] == 'off'
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        assert db.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        stream = app_module.RowStream(db, 'SELECT id FROM orders ORDER BY id')
+        db_execute = db.execute
+        stream.db = type('DB', (), {'execute': lambda self, sql, params=(): Cursor(db_execute(sql, params))})()
+        assert not stream.started
+        ids = [r['id'] for r in stream]
+        assert len(ids) == 1000 and fetched[:2] == [50, 50] and fetched[-1] == 0
+        with pytest.raises(RuntimeError):
+            iter(stream)
+
+
+def test_ledger_streams_with_current_balance(client):
+    page = client.get('/ledger').get_data(as_text=True)
+    assert 'No ledger entries yet' in page
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        db.execute("INSERT INTO ledger (date, description, amount, balance) VALUES ('2024-01-01', 'Opening float', 100, 100)")
+        db.execute("INSERT INTO ledger (date, description, amount, balance) VALUES ('2024-01-02', 'Cement', -40, 60)")
+        db.commit()
+    page = client.get('/ledger').get_data(as_text=True)
+    assert 'Opening float' in page and 'Cement' in page
+    assert '₦60.00' in page.split('Current Balance:')[1]
+
+
+def test_streamed_page_flushes_head_through_compression(client):
+    rv = client.get('/orders', headers={'Accept-Encoding': 'gzip'}, buffered=False)
+    assert rv.headers['Content-Encoding'] == 'gzip'
+    inflate = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    seen = ''
+    chunks = iter(rv.response)
+    for chunk in chunks:
+        seen += inflate.decompress(chunk).decode()
+        if '<h3>Orders</h3>' in seen:
+            break
+    # the head decodes on its own, long before the last row is produced
+    assert '2024-01-01 10:00:00<' not in seen
+    seen += (inflate.decompress(b''.join(chunks)) + inflate.flush()).decode()
+    rv.close()
+    assert '2024-01-01 10:00:00<' in seen and '</html>' in seen
+
+    for path in ('/payments', '/trips', '/admin/breakages'):
+        assert client.get(path).status_code == 200
+
+
+def test_flash_is_shown_once_on_a_streamed_page(client):
+    rv = client.post('/trips', data={'vehicle_no': 'KJA-123', 'driver_name': 'Sule', 'amount': '500'})
+    assert rv.status_code == 302
+    assert 'Trip recorded' in client.get('/trips').get_data(as_text=True)
+    # popped for real: the session saved after the view no longer carries it
+    assert 'Trip recorded' not in client.get('/trips').get_data(as_text=True)
+
+
+def test_slow_download_does_not_block_writers(client):
+    rv = client.get('/orders', buffered=False)
+    chunks = iter(rv.response)
+    seen = ''
+    while '2024-01-01 10:16' not in seen:  # well into the rows
+        seen += next(chunks).decode()
+    writer = sqlite3.connect(app_module.app.config['DATABASE'], timeout=0)
+    try:
+        writer.execute("INSERT INTO orders (customer_id, order_date, status, total) VALUES (NULL, '2024-02-01', 'Pending', 1)")
+        writer.commit()
+    finally:
+        writer.close()
+    page = seen + b''.join(chunks).decode()
+    rv.close()
+    assert page.count('<tr>') == 1001
+
+
+def test_rollback_journal_database_is_read_up_front(tmp_path):
+    # WAL unavailable: an open cursor would hold writers off, so don't keep one
+    path = str(tmp_path / 'journal.db')
+    db = sqlite3.connect(path)
+    db.row_factory = sqlite3.Row
+    assert db.execute('PRAGMA journal_mode').fetchone()[0] == 'delete'
+    db.execute('CREATE TABLE t (id INTEGER PRIMARY KEY)')
+    db.executemany('INSERT INTO t (id) VALUES (?)', [(i,) for i in range(1000)])
+    db.commit()
+    rows = iter(app_module.RowStream(db, 'SELECT id FROM t ORDER BY id', size=10))
+    assert next(rows)['id'] == 0
+    writer = sqlite3.connect(path, timeout=0)
+    try:
+        writer.execute('INSERT INTO t (id) VALUES (1000)')
+        writer.commit()
+    finally:
+        writer.close()
+    assert len(list(rows)) == 999
+    db.close()
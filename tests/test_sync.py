@@ -0,0 +1,97 @@
+import os
+import tempfile
+import shutil
+import pytest
+
+import app as app_module
+from werkzeug.security import generate_password_hash
+
+@pytest.fixture()
+def client():
+    tmpdir = tempfile.mkdtemp()
+    app = app_module.app
+    app.config['DATABASE'] = os.path.join(tmpdir, 'test.db')
+    os.environ['FORCE_SQLITE'] = '1'
+    with app.test_client() as client:
+        with app.app_context():
+            app_module.init_db()
+            db = app_module.get_db()
+            db.execute("DELETE FROM users")
+            db.execute("INSERT INTO users (username, email, password, role) VALUES (?, ?, ?, ?)",
+                       ('admin', 'admin@example.com', generate_password_hash('admin123'), 'admin'))
+            db.execute("INSERT INTO products (name, price, qty, reorder_level) VALUES ('Sync Block', 100, 40, 5)")
+            db.commit()
+        client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+        yield client
+    shutil.rmtree(tmpdir)
+
+
+def _product_id():
+    with app_module.app.app_context():
+        return app_module.get_db().execute("SELECT id FROM products WHERE name = 'Sync Block'").fetchone()['id']
+
+
+def test_sync_returns_only_changes_since_seq(client):
+    full = client.get('/api/v1/sync?since=0').get_json()
+    assert full['ok'] and not full['more']
+    products = full['changes']['products']
+    assert products['columns'][:3] == ['_seq', 'id', 'name']
+    assert any(r[2] == 'Sync Block' for r in products['rows'])
+
+    assert client.get(f"/api/v1/sync?since={full['seq']}").get_json()['changes'] == {}
+
+    pid = _product_id()
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        db.execute('UPDATE products SET price = 120 WHERE id = ?', (pid,))
+        db.commit()
+    delta = client.get(f"/api/v1/sync?since={full['seq']}").get_json()
+    rows = delta['changes']['products']['rows']
+    assert len(rows) == 1 and rows[0][1] == pid and rows[0][5] == 120
+    assert delta['seq'] > full['seq']
+
+
+def test_deletes_sync_as_tombstones_and_purge_forces_reset(client):
+    client.post('/trips', data={'vehicle_no': 'ABC123', 'driver_name': 'Ade', 'amount': '5000'})
+    start = client.get('/api/v1/sync?since=0&tables=trips').get_json()
+    trip_id = start['changes']['trips']['rows'][0][1]
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        db.execute('DELETE FROM trips WHERE id = ?', (trip_id,))
+        db.commit()
+    delta = client.get(f"/api/v1/sync?since={start['seq']}&tables=trips").get_json()
+    assert delta['changes']['trips']['deleted'] == [trip_id]
+
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        assert app_module.purge_sync_tombstones(db, days=-1) == 1
+        db.commit()
+    stale = client.get(f"/api/v1/sync?since={start['seq']}&tables=trips").get_json()
+    assert stale['reset'] is True
+
+
+def test_upload_applies_detects_conflicts_and_dedupes(client):
+    pid = _product_id()
+    base = client.get('/api/v1/sync?since=0').get_json()['seq']
+    upload = {'changes': [
+        {'client_change_id': 'c1', 'table': 'products', 'op': 'update', 'id': pid, 'base_seq': base,
+         'values': {'price': 150}},
+        {'client_change_id': 'c2', 'table': 'trips', 'op': 'insert', 'values': {'vehicle_no': 'KJA1', 'amount': 900}},
+        {'table': 'products', 'op': 'update', 'id': pid, 'base_seq': base, 'values': {'qty': 999}},
+    ]}
+    results = client.post('/api/v1/sync', json=upload).get_json()['results']
+    assert [r['status'] for r in results] == ['applied', 'applied', 'rejected']
+
+    # a second device still holding the old base_seq loses
+    stale = client.post('/api/v1/sync', json={'changes': [
+        {'table': 'products', 'op': 'update', 'id': pid, 'base_seq': base, 'values': {'price': 90}}]}).get_json()
+    conflict = stale['results'][0]
+    assert conflict['status'] == 'conflict' and conflict['current']['price'] == 150
+
+    # retrying the same upload doesn't insert the trip twice
+    again = client.post('/api/v1/sync', json={'changes': upload['changes'][1:2]}).get_json()['results']
+    assert again[0]['id'] == results[1]['id']
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        assert db.execute("SELECT COUNT(*) AS c FROM trips WHERE vehicle_no = 'KJA1'").fetchone()['c'] == 1
+        assert db.execute('SELECT qty FROM products WHERE id = ?', (pid,)).fetchone()['qty'] == 40
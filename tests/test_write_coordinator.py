@@ -0,0 +1,151 @@
+import os
+import tempfile
+import shutil
+import threading
+import pytest
+
+import app as app_module
+import write_coordinator
+from werkzeug.security import generate_password_hash
+
+@pytest.fixture()
+def client():
+    tmpdir = tempfile.mkdtemp()
+    app = app_module.app
+    app.config['DATABASE'] = os.path.join(tmpdir, 'test.db')
+    os.environ['FORCE_SQLITE'] = '1'
+    with app.test_client() as client:
+        with app.app_context():
+            app_module.init_db()
+            db = app_module.get_db()
+            db.execute("DELETE FROM users")
+            db.execute("INSERT INTO users (username, email, password, role) VALUES (?, ?, ?, ?)",
+                       ('admin', 'admin@example.com', generate_password_hash('admin123'), 'admin'))
+            db.execute("INSERT INTO customers (name, email, password) VALUES ('Ada', 'ada@example.com', 'x')")
+            db.execute("INSERT INTO products (name, price, qty, reorder_level) VALUES ('Block A', 100, 1000, 5)")
+            db.commit()
+        client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+        yield client
+    app.config['WRITE_COORDINATOR'] = 'off'
+    for coordinator in app_module._write_coordinators.values():
+        if hasattr(coordinator, 'close'):
+            coordinator.close()
+    app_module._write_coordinators.clear()
+    shutil.rmtree(tmpdir)
+
+
+def _ids():
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        return (db.execute("SELECT id FROM customers WHERE email = 'ada@example.com'").fetchone()['id'],
+                db.execute("SELECT id FROM products WHERE name = 'Block A'").fetchone()['id'])
+
+
+def _stock_and_orders(pid):
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        return (db.execute('SELECT qty FROM products WHERE id = ?', (pid,)).fetchone()['qty'],
+                db.execute('SELECT COUNT(*) AS c FROM orders').fetchone()['c'])
+
+
+def test_concurrent_orders_share_commits_and_fail_alone(client):
+    cid, pid = _ids()
+    writer = app_module.make_group_commit_writer()
+    writer.max_wait = 0.02
+    results, errors = [], []
+
+    def place(qty):
+        try:
+            results.append(writer.submit('place_order', {'customer_id': cid, 'product_id': pid, 'qty': qty}))
+        except ValueError as e:
+            errors.append(str(e))
+
+    threads = [threading.Thread(target=place, args=(5000 if i == 7 else 10,)) for i in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    writer.close()
+    assert len(results) == 19 and len(errors) == 1 and 'exceeds available stock' in errors[0]
+    assert writer.operations_done == 20 and writer.batches < 20
+    assert len({r['order_id'] for r in results}) == 19
+    assert _stock_and_orders(pid) == (1000 - 190, 19)
+
+
+def test_routes_write_through_thread_and_socket_coordinators(client, tmp_path):
+    cid, pid = _ids()
+    app_module.app.config['WRITE_COORDINATOR'] = 'thread'
+    rv = client.post('/orders/add', data={'customer_id': cid, 'product_id': pid, 'qty': 3})
+    assert rv.status_code == 302 and rv.headers['Location'].endswith('/orders')
+    rv = client.post('/orders/add', data={'customer_id': cid, 'product_id': pid, 'qty': 99999}, follow_redirects=True)
+    assert b'exceeds available stock' in rv.data
+    assert _stock_and_orders(pid) == (997, 1)
+
+    # socket mode with no coordinator running falls back to writing directly
+    app_module.app.config['WRITE_COORDINATOR'] = 'socket'
+    app_module.app.config['WRITE_COORDINATOR_SOCKET'] = str(tmp_path / 'writer.sock')
+    client.post('/admin/sales', data={'product_id': pid, 'qty': 2, 'amount': 200})
+    assert _stock_and_orders(pid)[0] == 995
+
+    writer = app_module.make_group_commit_writer()
+    servers = []
+    started = threading.Event()
+    thread = threading.Thread(target=write_coordinator.serve, daemon=True,
+                              args=(str(tmp_path / 'writer.sock'), writer, lambda s: (servers.append(s), started.set())))
+    thread.start()
+    assert started.wait(5)
+    try:
+        client.post('/admin/breakages', data={'product_id': pid, 'qty': 5, 'reason': 'dropped'})
+        rv = client.post('/orders/add', data={'customer_id': cid, 'product_id': pid, 'qty': 99999}, follow_redirects=True)
+        assert b'exceeds available stock' in rv.data
+        assert writer.operations_done == 2
+    finally:
+        servers[0].shutdown()
+        writer.close()
+    assert _stock_and_orders(pid) == (990, 1)
+
+
+class _PostgresLike:
+    """Runs on SQLite but, like psycopg2, has no usable lastrowid."""
+    dialect = 'postgres'
+
+    class _Cursor:
+        lastrowid = None
+
+        def __init__(self, cur):
+            self._cur = cur
+            self.rowcount = cur.rowcount
+
+        def fetchone(self):
+            return self._cur.fetchone()
+
+        def fetchall(self):
+            return self._cur.fetchall()
+
+    def __init__(self, db):
+        self._db = db
+
+    def execute(self, sql, params=()):
+        return self._Cursor(self._db.execute(sql, params))
+
+
+def test_write_operations_take_ids_from_returning_on_postgres(client):
+    cid, pid = _ids()
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        db.execute("INSERT INTO orders (customer_id, total, status) VALUES (?, 1, 'Pending')", (cid,))  # the new order is not id 1
+        pg = _PostgresLike(db)
+        order = app_module.place_order(pg, cid, pid, 2, user='admin')
+        sale_id = app_module.record_sale(pg, pid, 3, 300, user='admin')
+        breakage_id = app_module.record_breakage(pg, pid, 1, user='admin')
+        trip_id = app_module.record_trip(pg, 'KJA-1', user='admin')
+        db.commit()
+        assert order['order_id'] == db.execute('SELECT MAX(id) AS id FROM orders').fetchone()['id']
+        assert db.execute('SELECT order_id FROM order_items').fetchone()['order_id'] == order['order_id']
+        assert db.execute('SELECT order_id FROM payments').fetchone()['order_id'] == order['order_id']
+        refs = db.execute("SELECT ref_entity, ref_id FROM stock_movements WHERE product_id = ? AND ref_entity IN "
+                          "('orders', 'sales', 'breakages') ORDER BY id", (pid,)).fetchall()
+        assert [(r['ref_entity'], r['ref_id']) for r in refs] == [
+            ('orders', order['order_id']), ('sales', sale_id), ('breakages', breakage_id)]
+        audit = db.execute("SELECT entity_id FROM audit WHERE entity = 'trips'").fetchone()
+        assert trip_id is not None and audit['entity_id'] == trip_id
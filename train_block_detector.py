@@ -9,33 +9,170 @@ Author: Development Team
 Date: November 7, 2025
 """
 
-from ultralytics import YOLO
+import hashlib
+import io
 import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
-def create_data_yaml():
-    """Create YOLO dataset configuration file"""
-    data_yaml_content = """# Block Detection Dataset Configuration
-path: block_dataset
-train: images
-val: images
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+CLASS_NAMES = {0: 'block'}
+
+
+def validate_label(path, num_classes=len(CLASS_NAMES)):
+    """
+    Check a YOLO label file (boxes or segmentation polygons)
+    
+    Args:
+        path (Path): Label .txt file
+        num_classes (int): Number of classes in the dataset
+    
+    Returns:
+        List of problems found (empty if the file is valid)
+    """
+    problems = []
+    for n, line in enumerate(path.read_text().splitlines(), 1):
+        parts = line.split()
+        if not parts:
+            continue
+        try:
+            cls = int(parts[0])
+            coords = [float(v) for v in parts[1:]]
+        except ValueError:
+            problems.append(f"line {n}: not numeric")
+            continue
+        if not 0 <= cls < num_classes:
+            problems.append(f"line {n}: class {cls} out of range")
+        # 4 values for a box, or an x/y polygon of at least 3 points
+        if len(coords) != 4 and (len(coords) < 6 or len(coords) % 2):
+            problems.append(f"line {n}: {len(coords)} coordinates")
+        elif any(v < 0 or v > 1 for v in coords):
+            problems.append(f"line {n}: coordinates outside 0-1")
+    return problems
+
+
+def split_for(stem, val_fraction):
+    """Deterministic train/val assignment from the file name, so adding
+    photos never moves existing ones between splits."""
+    bucket = int(hashlib.sha1(stem.encode()).hexdigest()[:8], 16) / 0xFFFFFFFF
+    return 'val' if bucket < val_fraction else 'train'
+
+
+def _resize_to_cache(src, img_size, cache_dir):
+    """Worker: store `src` with its longest side at most img_size under a
+    name derived from its content. Returns (cached path, was cache hit)."""
+    data = Path(src).read_bytes()
+    digest = hashlib.sha1(data + str(img_size).encode()).hexdigest()
+    dest = Path(cache_dir) / 'images' / f"{digest}.jpg"
+    if dest.exists():
+        return str(dest), True
+    from PIL import Image, ImageOps
+    img = Image.open(io.BytesIO(data))
+    # let the JPEG decoder scale down by 1/2..1/8 instead of decoding full size
+    img.draft('RGB', (img_size, img_size))
+    img = ImageOps.exif_transpose(img).convert('RGB')
+    img.thumbnail((img_size, img_size), Image.LANCZOS)
+    tmp = dest.with_suffix('.tmp')
+    img.save(tmp, 'JPEG', quality=95)
+    os.replace(tmp, dest)
+    return str(dest), False
+
+
+def prepare_dataset(data_root='block_dataset', img_size=640, val_fraction=0.2, workers=None):
+    """
+    Validate labels, split train/val and pre-resize images into a cache
+    
+    Images are resized once, in parallel, into <data_root>/cache/<img_size>/
+    under a hash of their contents, so later runs reuse them instead of
+    decoding the full-resolution photos again. Images without a label file,
+    or with an invalid one, are left out.
+    
+    Args:
+        data_root (str): Folder containing images/ and labels/
+        img_size (int): Longest side of the cached images
+        val_fraction (float): Share of images held out for validation
+        workers (int): Resize processes (default: CPU count)
+    
+    Returns:
+        Path to the generated data.yaml
+    """
+    root = Path(data_root).resolve()
+    image_dir, label_dir = root / 'images', root / 'labels'
+    if not image_dir.exists():
+        raise FileNotFoundError(
+            f"Dataset not found! Ensure '{image_dir}' exists.\n"
+            "Current directory: " + os.getcwd()
+        )
+    cache_dir = root / 'cache' / str(img_size)
+    (cache_dir / 'images').mkdir(parents=True, exist_ok=True)
+    (cache_dir / 'labels').mkdir(parents=True, exist_ok=True)
+
+    images = sorted(p for p in image_dir.iterdir() if p.suffix.lower() in IMAGE_EXTENSIONS)
+    usable, unlabeled, invalid = [], 0, {}
+    for img in images:
+        label = label_dir / f"{img.stem}.txt"
+        if not label.exists():
+            unlabeled += 1
+            continue
+        problems = validate_label(label)
+        if problems:
+            invalid[img.name] = problems
+            continue
+        usable.append((img, label))
+    print(f"✓ Found {len(images)} images: {len(usable)} usable, {unlabeled} unlabeled, {len(invalid)} with invalid labels")
+    for name, problems in invalid.items():
+        print(f"  ✗ {name}: {'; '.join(problems[:3])}")
+    if not usable:
+        raise ValueError(f"No labeled images under {root}")
+
+    workers = workers or os.cpu_count() or 1
+    print(f"⏳ Preparing {len(usable)} images at {img_size}px with {workers} workers...")
+    started = time.perf_counter()
+    splits = {'train': [], 'val': []}
+    hits = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        jobs = pool.map(_resize_to_cache, [str(img) for img, _ in usable],
+                        [img_size] * len(usable), [str(cache_dir)] * len(usable), chunksize=4)
+        for done, ((img, label), (cached, hit)) in enumerate(zip(usable, jobs), 1):
+            hits += hit
+            # ultralytics finds the label by swapping /images/ for /labels/
+            shutil.copyfile(label, cache_dir / 'labels' / f"{Path(cached).stem}.txt")
+            splits[split_for(img.stem, val_fraction)].append(cached)
+            if done % 50 == 0 or done == len(usable):
+                rate = done / max(time.perf_counter() - started, 1e-9)
+                print(f"  {done}/{len(usable)} images ({rate:.1f} images/sec)")
+    elapsed = time.perf_counter() - started
+    print(f"✓ Prepared in {elapsed:.1f}s ({len(usable) / max(elapsed, 1e-9):.1f} images/sec, {hits} from cache)")
+
+    if not splits['val']:
+        # tiny datasets: make sure validation has something to score
+        splits['val'].append(splits['train'].pop())
+    for name, paths in splits.items():
+        (cache_dir / f"{name}.txt").write_text("\n".join(paths) + "\n")
+    print(f"✓ Split: {len(splits['train'])} train / {len(splits['val'])} val")
+
+    names = "\n".join(f"  {i}: {n}" for i, n in CLASS_NAMES.items())
+    yaml_path = cache_dir / 'data.yaml'
+    yaml_path.write_text(f"""# Block Detection Dataset Configuration (generated by prepare_dataset)
+path: {cache_dir}
+train: train.txt
+val: val.txt
 
 # Classes
 names:
-  0: block
+{names}
 
 # Number of classes
-nc: 1
-"""
-    
-    yaml_path = Path('block_dataset/data.yaml')
-    with open(yaml_path, 'w') as f:
-        f.write(data_yaml_content)
+nc: {len(CLASS_NAMES)}
+""")
     print(f"✓ Created {yaml_path}")
     return str(yaml_path)
 
 
-def train_model(epochs=100, img_size=640, batch_size=8, device='cpu'):
+def train_model(epochs=100, img_size=640, batch_size=8, device='cpu',
+                data_root='block_dataset', workers=None, cache='disk'):
     """
     Train YOLO block detection model
     
@@ -44,11 +181,16 @@ def train_model(epochs=100, img_size=640, batch_size=8, device='cpu'):
         img_size (int): Image size for training (default: 640)
         batch_size (int): Batch size (default: 8, reduce if out of memory)
         device (str): Device to train on - 'cpu' or 'cuda' (default: 'cpu')
+        data_root (str): Dataset folder with images/ and labels/ (default: block_dataset)
+        workers (int): Preparation and data loading workers (default: CPU count)
+        cache (str): Decoded image cache during training - 'ram', 'disk' or 'none'
     
     Returns:
         Path to best model weights
     """
-    
+    from ultralytics import YOLO
+
+    workers = workers or os.cpu_count() or 1
     print("\n" + "="*60)
     print("  S.A.M BLOCKS AI DETECTION - TRAINING")
     print("="*60)
@@ -57,21 +199,13 @@ def train_model(epochs=100, img_size=640, batch_size=8, device='cpu'):
     print(f"  - Image Size: {img_size}px")
     print(f"  - Batch Size: {batch_size}")
     print(f"  - Device: {device}")
+    print(f"  - Dataset: {data_root}")
+    print(f"  - Workers: {workers}")
+    print(f"  - Cache: {cache}")
     print("="*60 + "\n")
     
-    # Create data.yaml
-    data_path = create_data_yaml()
-    
-    # Check if dataset exists
-    if not os.path.exists('block_dataset/images'):
-        raise FileNotFoundError(
-            "Dataset not found! Ensure 'block_dataset/images' exists.\n"
-            "Current directory: " + os.getcwd()
-        )
-    
-    # Count images
-    image_count = len(list(Path('block_dataset/images').glob('*.jpg')))
-    print(f"✓ Found {image_count} training images")
+    # Validate, split and pre-resize the dataset
+    data_path = prepare_dataset(data_root, img_size=img_size, workers=workers)
     
     # Initialize YOLO model (segmentation variant)
     print("\n⏳ Loading YOLOv8 nano segmentation model...")
@@ -95,8 +229,8 @@ def train_model(epochs=100, img_size=640, batch_size=8, device='cpu'):
         plots=True,         # Generate training plots
         val=True,           # Validate during training
         verbose=True,       # Show detailed logs
-        workers=4,          # Data loading workers
-        cache=False,        # Don't cache (saves memory)
+        workers=workers,    # Data loading workers
+        cache=False if cache == 'none' else cache,  # Keep decoded images in RAM or as .npy files
         exist_ok=True,      # Overwrite existing run
     )
     
@@ -112,14 +246,17 @@ def train_model(epochs=100, img_size=640, batch_size=8, device='cpu'):
     return best_weights
 
 
-def test_model(model_path, test_image=None):
+def test_model(model_path, test_image=None, data_root='block_dataset'):
     """
     Test the trained model on a sample image
     
     Args:
         model_path (str): Path to trained model weights
         test_image (str): Path to test image (optional)
+        data_root (str): Dataset folder to pick a test image from
     """
+    from ultralytics import YOLO
+
     print("\n🔍 Testing trained model...")
     
     # Load model
@@ -127,7 +264,7 @@ def test_model(model_path, test_image=None):
     
     # Find a test image if not provided
     if test_image is None:
-        images = list(Path('block_dataset/images').glob('*.jpg'))
+        images = list((Path(data_root) / 'images').glob('*.jpg'))
         if images:
             test_image = str(images[0])
         else:
@@ -147,15 +284,49 @@ def test_model(model_path, test_image=None):
     print("\n✅ Testing complete!")
 
 
-def deploy_model(model_path):
+def export_onnx(model_path, img_size=640, int8=False):
+    """
+    Export deployed weights to ONNX for the onnxruntime counting backend
+    
+    Args:
+        model_path (str): Path to the deployed .pt weights
+        img_size (int): Inference image size baked into the export
+        int8 (bool): Also write an INT8 dynamically quantized copy
+    
+    Returns:
+        List of exported file paths
+    """
+    from ultralytics import YOLO
+
+    model = YOLO(model_path)
+    # dynamic axes so the service can batch several photos per run
+    onnx_path = model.export(format='onnx', imgsz=img_size, dynamic=True, simplify=True)
+    exported = [onnx_path]
+    print(f"✓ ONNX exported to: {onnx_path} ({os.path.getsize(onnx_path) / (1024*1024):.2f} MB)")
+
+    int8_path = os.path.splitext(onnx_path)[0] + '.int8.onnx'
+    if int8:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(onnx_path, int8_path, weight_type=QuantType.QUInt8)
+        exported.append(int8_path)
+        print(f"✓ INT8 model written to: {int8_path} ({os.path.getsize(int8_path) / (1024*1024):.2f} MB)")
+    elif os.path.exists(int8_path):
+        # the service prefers the INT8 file; don't leave one from an older model
+        os.remove(int8_path)
+        print(f"✓ Removed stale {int8_path}")
+    return exported
+
+
+def deploy_model(model_path, onnx=True, int8=False, img_size=640):
     """
     Copy trained model to deployment folder
     
     Args:
         model_path (str): Path to best model weights
+        onnx (bool): Also export ONNX for CPU serving (default: True)
+        int8 (bool): Also write an INT8 quantized ONNX model (default: False)
+        img_size (int): Image size for the ONNX export (default: 640)
     """
-    import shutil
-    
     deploy_path = 'models/block_detector.pt'
     
     # Create models directory if it doesn't exist
@@ -166,17 +337,20 @@ def deploy_model(model_path):
     
     print(f"\n✓ Model deployed to: {deploy_path}")
     print(f"✓ Model size: {os.path.getsize(deploy_path) / (1024*1024):.2f} MB")
+
+    if onnx:
+        export_onnx(deploy_path, img_size=img_size, int8=int8)
     
     print("\n📝 Next steps:")
     print("1. Update requirements.txt:")
     print("   - Add: ultralytics>=8.0.0")
     print("   - Add: opencv-python-headless>=4.5.0")
-    print("\n2. Uncomment YOLO code in ai_detection.py")
-    print("\n3. Test locally:")
+    print("   (or, to serve the ONNX export only: onnxruntime>=1.16 and Pillow)")
+    print("\n2. Test locally (the model loads on the first detection):")
     print("   python app.py")
     print("   Visit: http://localhost:5000/ai/detect")
-    print("\n4. Deploy to Railway:")
-    print("   git add models/block_detector.pt requirements.txt ai_detection.py")
+    print("\n3. Deploy to Railway:")
+    print("   git add models/ requirements.txt")
     print("   git commit -m 'Deploy trained block detection model'")
     print("   git push origin main")
 
@@ -189,27 +363,39 @@ if __name__ == "__main__":
     parser.add_argument('--img-size', type=int, default=640, help='Training image size')
     parser.add_argument('--batch', type=int, default=8, help='Batch size')
     parser.add_argument('--device', type=str, default='cpu', help='Training device (cpu/cuda)')
+    parser.add_argument('--data-root', type=str, default='block_dataset', help='Dataset folder with images/ and labels/')
+    parser.add_argument('--workers', type=int, default=None, help='Preparation and data loading workers (default: CPU count)')
+    parser.add_argument('--cache', choices=['ram', 'disk', 'none'], default='disk', help='Decoded image cache during training')
+    parser.add_argument('--prepare-only', action='store_true', help='Prepare the dataset cache and exit')
     parser.add_argument('--skip-test', action='store_true', help='Skip model testing')
     parser.add_argument('--deploy', action='store_true', help='Deploy model after training')
+    parser.add_argument('--no-onnx', action='store_true', help='Skip the ONNX export when deploying')
+    parser.add_argument('--int8', action='store_true', help='Also deploy an INT8 quantized ONNX model')
     
     args = parser.parse_args()
     
     try:
-        # Train model
-        best_model = train_model(
-            epochs=args.epochs,
-            img_size=args.img_size,
-            batch_size=args.batch,
-            device=args.device
-        )
+        if args.prepare_only:
+            prepare_dataset(args.data_root, img_size=args.img_size, workers=args.workers)
+        else:
+            # Train model
+            best_model = train_model(
+                epochs=args.epochs,
+                img_size=args.img_size,
+                batch_size=args.batch,
+                device=args.device,
+                data_root=args.data_root,
+                workers=args.workers,
+                cache=args.cache,
+            )
         
-        # Test model
-        if not args.skip_test:
-            test_model(best_model)
+            # Test model
+            if not args.skip_test:
+                test_model(best_model, data_root=args.data_root)
         
-        # Deploy model
-        if args.deploy:
-            deploy_model(best_model)
+            # Deploy model
+            if args.deploy:
+                deploy_model(best_model, onnx=not args.no_onnx, int8=args.int8, img_size=args.img_size)
         
         print("\n✅ All done! Check the documentation for next steps.")
         
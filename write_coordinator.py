@@ -0,0 +1,262 @@
+"""
+Single-writer group commit for SQLite.
+
+With several gunicorn workers on one SQLite file, every write route takes the
+database write lock and pays an fsync on its own; under load workers queue
+on the lock (or fail with "database is locked"). GroupCommitWriter funnels
+named write operations through one connection instead: it takes whatever
+operations are waiting (up to max_batch, waiting at most max_wait for more),
+runs them in a single BEGIN IMMEDIATE ... COMMIT, and hands each caller its
+own result. Every operation runs inside its own SAVEPOINT, so one failing
+operation rolls back alone and raises in its caller while the rest of the
+batch commits.
+
+Two ways to reach the writer:
+
+* in-process: GroupCommitWriter.submit() from any thread;
+* across processes: serve() exposes a writer on a Unix socket (run it as a
+  sidecar, see `flask write-coordinator`) and SocketClient submits to it.
+  The protocol is one JSON object per line each way:
+  {"op": name, "args": {...}} -> {"ok": true, "result": ...} or
+  {"ok": false, "type": "ValueError", "error": "..."}.
+
+Operations are plain functions `op(db, **args)` that must not commit; their
+arguments and results must be JSON-serialisable for the socket transport.
+`after_batch`, if given, is called in the writer thread once each batch has
+committed or failed (to send what the batch's operations deferred).
+"""
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+
+
+class CoordinatorUnavailable(RuntimeError):
+    """The writer could not be reached; nothing was submitted."""
+
+
+class WriteError(RuntimeError):
+    """An operation failed in the writer and its exception type isn't known
+    to the client."""
+
+    def __init__(self, kind, message):
+        super().__init__(f'{kind}: {message}')
+        self.kind = kind
+        self.message = message
+
+
+class _Pending:
+    __slots__ = ('op', 'args', 'done', 'result', 'error')
+
+    def __init__(self, op, args):
+        self.op = op
+        self.args = args
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class GroupCommitWriter:
+    def __init__(self, connect, operations, max_batch=64, max_wait=0.002, timeout=30.0, after_batch=None):
+        self._connect = connect
+        self._operations = operations
+        self._after_batch = after_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.operations_done = 0
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name='group-commit-writer', daemon=True)
+                self._thread.start()
+
+    def submit(self, op, args=None, timeout=None):
+        """Run operation `op` in the next batch and return its result (or
+        raise its exception) once that batch has committed."""
+        if op not in self._operations:
+            raise KeyError(f'Unknown write operation {op!r}')
+        self._ensure_thread()
+        pending = _Pending(op, dict(args or {}))
+        self._queue.put(pending)
+        if not pending.done.wait(self.timeout if timeout is None else timeout):
+            raise TimeoutError(f'Write operation {op!r} did not complete in time')
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def close(self):
+        """Stop the writer thread once the queued operations are done."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None and thread.is_alive():
+            self._queue.put(None)
+            thread.join(self.timeout)
+
+    def _loop(self):
+        db = self._connect()
+        stopping = False
+        while not stopping:
+            first = self._queue.get()
+            if first is None:
+                break
+            batch = [first]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    remaining = deadline - time.monotonic()
+                    pending = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if pending is None:
+                    stopping = True
+                    break
+                batch.append(pending)
+            try:
+                self._apply(db, batch)
+            except Exception as e:
+                # the connection itself failed: fail the batch, start afresh
+                for pending in batch:
+                    if not pending.done.is_set():
+                        pending.result, pending.error = None, e
+                        pending.done.set()
+                try:
+                    db.close()
+                except Exception:
+                    pass
+                db = self._connect()
+            if self._after_batch is not None:
+                try:
+                    self._after_batch()
+                except Exception:
+                    pass
+        db.close()
+
+    def _apply(self, db, batch):
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            for pending in batch:
+                db.execute('SAVEPOINT write_op')
+                try:
+                    pending.result = self._operations[pending.op](db, **pending.args)
+                    db.execute('RELEASE write_op')
+                except Exception as e:
+                    db.execute('ROLLBACK TO write_op')
+                    db.execute('RELEASE write_op')
+                    pending.error = e
+            db.execute('COMMIT')
+        except Exception:
+            try:
+                db.execute('ROLLBACK')
+            except Exception:
+                pass
+            raise
+        self.batches += 1
+        self.operations_done += len(batch)
+        for pending in batch:
+            pending.done.set()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        writer = self.server.writer
+        for line in self.rfile:
+            try:
+                message = json.loads(line)
+                result = writer.submit(message['op'], message.get('args'))
+                reply = {'ok': True, 'result': result}
+            except Exception as e:
+                reply = {'ok': False, 'type': e.__class__.__name__, 'error': str(e)}
+            self.wfile.write(json.dumps(reply, default=str).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(path, writer, ready=None):
+    """Serve `writer` on Unix socket `path` until interrupted."""
+    if os.path.exists(path):
+        os.unlink(path)
+    server = _Server(path, _Handler)
+    server.writer = writer
+    os.chmod(path, 0o660)
+    if ready is not None:
+        ready(server)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+class SocketClient:
+    """Submit operations to a writer served by serve(). One connection per
+    thread; `exceptions` maps exception class names from the writer back to
+    local classes so callers can catch them as usual."""
+
+    def __init__(self, path, timeout=30.0, exceptions=None):
+        self.path = path
+        self.timeout = timeout
+        self.exceptions = dict(exceptions or {})
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.path)
+            except OSError as e:
+                sock.close()
+                raise CoordinatorUnavailable(f'write coordinator at {self.path} unreachable: {e}') from e
+            conn = self._local.conn = (sock, sock.makefile('rb'))
+        return conn
+
+    def _reset(self):
+        conn = getattr(self._local, 'conn', None)
+        self._local.conn = None
+        if conn:
+            for part in reversed(conn):
+                try:
+                    part.close()
+                except Exception:
+                    pass
+
+    def submit(self, op, args=None):
+        payload = json.dumps({'op': op, 'args': args or {}}).encode('utf-8') + b'\n'
+        sock, rfile = self._connection()
+        try:
+            sock.sendall(payload)
+        except OSError:
+            # a stale pooled connection (writer restarted): nothing was
+            # delivered, so retrying once on a fresh one is safe
+            self._reset()
+            sock, rfile = self._connection()
+            sock.sendall(payload)
+        try:
+            line = rfile.readline()
+        except OSError:
+            self._reset()
+            raise
+        if not line:
+            self._reset()
+            raise ConnectionError('write coordinator closed the connection mid-request')
+        reply = json.loads(line)
+        if reply.get('ok'):
+            return reply.get('result')
+        cls = self.exceptions.get(reply.get('type'))
+        if cls is not None:
+            raise cls(reply.get('error'))
+        raise WriteError(reply.get('type'), reply.get('error'))